@@ -2,7 +2,9 @@ from flask import Flask, jsonify
 from flask_cors import CORS
 from flask_restful import Api
 from extensions import db, socketio, scheduler
-from resources import ReservationListResource, ReservationResource, MaintenanceNeededResource, SuggestDeviceResource, DeviceMaintenancePredictionResource, DevicesReplacementResource, FutureNeedsResource
+from jobs import register_jobs
+from migrations import run_migrations
+from resources import ReservationListResource, ReservationResource, ReservationBulkResource, ReservationRecurringResource, ReservationAttemptsResource, AlertsResource, LabFreeSlotsResource, DeviceFreeSlotsResource, MaintenanceNeededResource, SuggestDeviceResource, DeviceMaintenancePredictionResource, DevicesReplacementResource, FutureNeedsResource, SparePartMovementsResource
 import signal
 import sys
 import urllib.parse
@@ -55,22 +57,92 @@ def create_app(config_name='default'):
     # تعيين ترميز JSON إلى UTF-8
     app.config['JSON_AS_ASCII'] = False
     
+    # التحقق من تداخل الحجوزات من فهرس في الذاكرة (يمكن تعطيله عند تشغيل أكثر من عملية)
+    app.config['RESERVATION_INDEX_ENABLED'] = os.environ.get('RESERVATION_INDEX_ENABLED', 'true').lower() == 'true'
+    
+    # إعادة حساب عدادات الساعات من الحجوزات دورياً (0 لتعطيلها)
+    app.config['HOURS_RECONCILIATION_INTERVAL_HOURS'] = int(os.environ.get('HOURS_RECONCILIATION_INTERVAL_HOURS', 0))
+    
+    # عدد محاولات معاملة الحجز عند تعارض الأقفال بين الطلبات المتزامنة
+    app.config['RESERVATION_LOCK_RETRIES'] = int(os.environ.get('RESERVATION_LOCK_RETRIES', 3))
+    
+    # ساعات اليوم التي يبحث فيها عن الفترات الحرة
+    app.config['FREE_SLOTS_DAY_START'] = os.environ.get('FREE_SLOTS_DAY_START', '08:00')
+    app.config['FREE_SLOTS_DAY_END'] = os.environ.get('FREE_SLOTS_DAY_END', '22:00')
+    
+    # مدة الاحتفاظ بمحاولات الحجز المرفوضة قبل ضغطها، وفترة تشغيل الضغط (0 لتعطيله)
+    app.config['RESERVATION_ATTEMPTS_RETENTION_DAYS'] = int(os.environ.get('RESERVATION_ATTEMPTS_RETENTION_DAYS', 30))
+    app.config['RESERVATION_ATTEMPTS_COMPACTION_INTERVAL_HOURS'] = int(os.environ.get('RESERVATION_ATTEMPTS_COMPACTION_INTERVAL_HOURS', 24))
+    
+    # نافذة معدل الاستخدام اليومي للأجهزة في توقعات الصيانة (عدد الأسابيع ومعامل تضاؤل وزن الأسابيع الأقدم)
+    app.config['USAGE_RATE_WEEKS'] = int(os.environ.get('USAGE_RATE_WEEKS', 8))
+    app.config['USAGE_RATE_DECAY'] = float(os.environ.get('USAGE_RATE_DECAY', 0.7))
+    
+    # إعادة بناء ملخص آخر صيانة لكل جهاز وفئة دورياً لالتقاط الصيانات المسجلة من خارج التطبيق (0 لتعطيلها)
+    app.config['MAINTENANCE_SUMMARY_REBUILD_INTERVAL_HOURS'] = int(os.environ.get('MAINTENANCE_SUMMARY_REBUILD_INTERVAL_HOURS', 6))
+    
+    # حساب الحالة الموحدة دورياً للأجهزة المضافة أو المعدلة من خارج التطبيق (0 لتعطيلها)
+    app.config['DEVICE_STATUS_SYNC_INTERVAL_HOURS'] = int(os.environ.get('DEVICE_STATUS_SYNC_INTERVAL_HOURS', 6))
+    
+    # حساب تقارير الصيانة والاستبدال مسبقاً بالدقائق (0 لتعطيله وحساب كل طلب من جديد)
+    app.config['REPORT_SNAPSHOT_INTERVAL_MINUTES'] = int(os.environ.get('REPORT_SNAPSHOT_INTERVAL_MINUTES', 15))
+    # إعادة حساب صفوف الأجهزة وقطع الغيار المتغيرة فقط ودمجها في التقارير بالثواني (0 لتعطيله)
+    app.config['REPORT_SNAPSHOT_SPLICE_SECONDS'] = int(os.environ.get('REPORT_SNAPSHOT_SPLICE_SECONDS', 30))
+    # مدة الاحتفاظ بتقرير قطع الغيار مجمعاً في الذاكرة لخدمة التصفية حسب الأولوية والسبب والمعمل بالثواني
+    app.config['FUTURE_NEEDS_CACHE_SECONDS'] = int(os.environ.get('FUTURE_NEEDS_CACHE_SECONDS', 60))
+    # نصف عمر وزن حركات الاستهلاك في معدل استهلاك قطع الغيار بالأيام
+    app.config['SPARE_PART_RATE_HALF_LIFE_DAYS'] = float(os.environ.get('SPARE_PART_RATE_HALF_LIFE_DAYS', 30))
+    
+    # حساب تنبيهات المعايرة وساعات التشغيل بالدقائق (0 لتعطيله)، ومدة صلاحية التنبيه قبل تكراره،
+    # ومدة الاحتفاظ بالتنبيهات المنتهية، وأنواع المستخدمين الذين يستلمون كل التنبيهات مع مشرفي المعامل
+    app.config['ALERT_SCAN_INTERVAL_MINUTES'] = int(os.environ.get('ALERT_SCAN_INTERVAL_MINUTES', 60))
+    app.config['ALERT_EXPIRY_HOURS'] = int(os.environ.get('ALERT_EXPIRY_HOURS', 24))
+    app.config['ALERT_RETENTION_DAYS'] = int(os.environ.get('ALERT_RETENTION_DAYS', 30))
+    app.config['ALERT_RECIPIENT_USER_TYPES'] = [
+        user_type.strip() for user_type in os.environ.get('ALERT_RECIPIENT_USER_TYPES', 'فني').split(',') if user_type.strip()
+    ]
+    
     # إعداد APScheduler - تعطيل API لتجنب التعارض
     app.config['SCHEDULER_API_ENABLED'] = False
     app.config['SCHEDULER_TIMEZONE'] = 'UTC'
     app.config['SCHEDULER_DAEMON'] = False  
        
     db.init_app(app)
+    
+    # إنشاء الجداول غير الموجودة بعد في قاعدة البيانات (مثل سجل محاولات الحجز)
+    with app.app_context():
+        try:
+            db.create_all()
+        except Exception as e:
+            logger.error(f"تعذر إنشاء الجداول الجديدة: {str(e)}")
+        
+        # تطبيق تعديلات المخطط على الجداول الموجودة (مثل الفهارس الجديدة)
+        try:
+            run_migrations()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"تعذر تطبيق تعديلات المخطط: {str(e)}")
     socketio.init_app(app, 
                      cors_allowed_origins="*",
                      async_mode='threading',  
                      daemon=False)  
     scheduler.init_app(app)
+    register_jobs(app)
     
     api = Api(app)
     # Reservation List Resource
     api.add_resource(ReservationListResource, '/reservations')
     api.add_resource(ReservationResource, '/reservations/<int:reservation_id>')
+    api.add_resource(ReservationBulkResource, '/reservations/bulk')
+    api.add_resource(ReservationRecurringResource, '/reservations/recurring')
+    api.add_resource(ReservationAttemptsResource, '/reservations/attempts')
+
+    # تنبيهات الصيانة المحسوبة من المهمة المجدولة
+    api.add_resource(AlertsResource, '/alerts')
+
+    # الفترات الحرة للمعامل والأجهزة
+    api.add_resource(LabFreeSlotsResource, '/labs/<int:lab_id>/free-slots')
+    api.add_resource(DeviceFreeSlotsResource, '/devices/<int:device_id>/free-slots')
 
     # Maintenance Needed Resource
     api.add_resource(MaintenanceNeededResource, '/devices/maintenance-needed')
@@ -87,6 +159,9 @@ def create_app(config_name='default'):
     # الاحتياجات المستقبلية من قطع الغيار
     api.add_resource(FutureNeedsResource, '/future-spare-parts-needs')
     
+    # سجل حركات مخزون قطع الغيار
+    api.add_resource(SparePartMovementsResource, '/spare-parts/<int:part_id>/movements')
+    
     logger.info("تم إنشاء التطبيق بنجاح")
     return app  # Return the app instance
 
@@ -113,7 +188,8 @@ signal.signal(signal.SIGTERM, signal_handler)
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 5000))
     logger.info(f"بدء تشغيل التطبيق على المنفذ {port}")
-    scheduler.start()
+    if not scheduler.running:
+        scheduler.start()
     try:
         socketio.run(app, debug=False, use_reloader=False, host="0.0.0.0", port=port)
     except KeyboardInterrupt:
@@ -0,0 +1,101 @@
+"""
+قياس الحجز المتزامن: عدة عملاء يرسلون طلبات حجز في نفس اللحظة
+
+السيناريو الأول: كل العملاء يطلبون نفس الجهاز في نفس الموعد، والمتوقع حجز واحد مقبول فقط.
+السيناريو الثاني: كل عميل يحجز مواعيد مختلفة، والمتوقع قبول الكل مع زيادة الإنتاجية بزيادة العملاء.
+في النهاية يتحقق من أن عدادات الساعات تطابق الحجوزات (reconcile_hours) رغم أن مدة كل الحجوزات ساعة ونصف،
+بعد حفظ خطوط الأساس للعدادات المبدئية قبل السيناريوهات.
+
+الاستخدام:
+    BENCH_DATABASE_URL=postgresql://... python benchmarks/bench_concurrent_booking.py --clients 16
+
+ملاحظة: SQLite لا يدعم أقفال الصفوف (يتجاهل FOR UPDATE)، لذلك نتيجة السيناريو الأول
+معتبرة فقط على PostgreSQL أو SQL Server.
+"""
+import argparse
+import threading
+import time
+
+from common import create_bench_app, future_date, seed_lab
+
+
+def run_clients(app, client_count, bookings_for_client):
+    """تشغيل العملاء في نفس اللحظة وإرجاع (حالات الاستجابة، الزمن بالثواني)"""
+    barrier = threading.Barrier(client_count)
+    statuses = []
+    statuses_lock = threading.Lock()
+
+    def worker(client_number):
+        client = app.test_client()
+        bookings = bookings_for_client(client_number)
+        barrier.wait()
+        for booking in bookings:
+            response = client.post('/reservations', json=booking)
+            with statuses_lock:
+                statuses.append(response.status_code)
+
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(client_count)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return statuses, time.perf_counter() - started
+
+
+def count_allowed(app, day):
+    from model import Reservations
+    with app.app_context():
+        return Reservations.query.filter_by(Date=day, IsAllowed=True).count()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--bookings', type=int, default=10, help="عدد الحجوزات لكل عميل في السيناريو الثاني")
+    args = parser.parse_args()
+
+    from services import ReservationService
+    app = create_bench_app('concurrent_booking')
+    with app.app_context():
+        device_ids, user_ids = seed_lab(device_count=4, user_count=args.clients)
+        ReservationService.reconcile_hours(apply=True)
+
+    # السيناريو الأول: نفس الجهاز ونفس الموعد
+    same_day = future_date(1)
+    statuses, elapsed = run_clients(app, args.clients, lambda number: [dict(
+        user_id=user_ids[number], lab_id=1, experiment_id=1, device_ids=[device_ids[0]],
+        date=same_day, start_time="10:00", end_time="11:30", purpose="bench"
+    )])
+    from datetime import datetime
+    allowed = count_allowed(app, datetime.strptime(same_day, "%Y-%m-%d").date())
+    print(f"same slot: clients={args.clients} accepted={statuses.count(201)} "
+          f"rejected={statuses.count(400)} allowed_rows={allowed} time={elapsed * 1000:.0f}ms "
+          f"{'OK' if allowed == 1 else 'DOUBLE BOOKED'}")
+
+    # السيناريو الثاني: مواعيد مختلفة، مقارنة عميل واحد بعدة عملاء لنفس عدد الطلبات
+    total = args.clients * args.bookings
+    for client_count in (1, args.clients):
+        per_client = total // client_count
+        offset = 2 if client_count == 1 else 2 + total
+
+        def bookings_for_client(number, per_client=per_client, offset=offset):
+            return [dict(
+                user_id=user_ids[number % len(user_ids)], lab_id=1, experiment_id=1,
+                device_ids=[device_ids[(number * per_client + k) % len(device_ids)]],
+                date=future_date(offset + number * per_client + k),
+                start_time="08:00", end_time="09:30", purpose="bench"
+            ) for k in range(per_client)]
+
+        statuses, elapsed = run_clients(app, client_count, bookings_for_client)
+        print(f"distinct slots: clients={client_count} requests={len(statuses)} "
+              f"accepted={statuses.count(201)} time={elapsed:.2f}s throughput={len(statuses) / elapsed:.1f} req/s")
+
+    with app.app_context():
+        drift = ReservationService.reconcile_hours()
+    drifted = len(drift["labs"]) + len(drift["experiments"]) + len(drift["devices"])
+    print(f"counters: drifted={drifted} {'OK' if drifted == 0 else drift}")
+
+
+if __name__ == '__main__':
+    main()
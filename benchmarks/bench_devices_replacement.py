@@ -0,0 +1,120 @@
+"""
+قياس تقييم الأجهزة التي تحتاج استبدال (/devices-replacement) لآلاف الأجهزة
+
+يقارن الطريقة السابقة (أربعة استعلامات لكل جهاز: صيانات الإصلاح والدورية وإجمالي التكاليف
+وقطع الغيار) بالاستعلام المجمع الواحد الحالي، ويتحقق من تطابق المخرجات. الطريقتان تستخدمان نفس
+حساب التقييم، فالفرق في تحميل الإحصائيات فقط.
+
+الاستخدام:
+    python benchmarks/bench_devices_replacement.py --devices 5000
+"""
+import argparse
+import json
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, insert
+
+from common import count_queries, create_bench_app, seed_lab, timed
+
+
+def legacy_stats(device):
+    """نسخة من استعلامات الإحصائيات السابقة لكل جهاز للمقارنة"""
+    from extensions import db
+    from model import Maintenances, SpareParts
+    from services import _ReplacementStats
+
+    six_months_ago = datetime.now() - timedelta(days=180)
+    one_year_ago = datetime.now() - timedelta(days=365)
+    repair_maintenances = Maintenances.query.filter(
+        Maintenances.DeviceId == device.Id,
+        Maintenances.SchedulingAt > six_months_ago,
+        Maintenances.Type == "إصلاح"
+    ).all()
+    periodic_maintenances = Maintenances.query.filter(
+        Maintenances.DeviceId == device.Id,
+        Maintenances.SchedulingAt > one_year_ago,
+        Maintenances.Type == "دورية"
+    ).all()
+    maintenance_costs = db.session.query(func.sum(Maintenances.Cost)).filter(
+        Maintenances.DeviceId == device.Id
+    ).scalar() or 0
+    spare_parts = SpareParts.query.filter_by(DeviceId=device.Id).all()
+    return _ReplacementStats(
+        len(repair_maintenances), len(periodic_maintenances), float(maintenance_costs),
+        len(spare_parts), sum(float(part.Cost) * part.Quantity for part in spare_parts)
+    )
+
+
+def legacy_replacement():
+    from model import Devices
+    from services import DevicesReplacementService
+
+    results = []
+    for device in Devices.query.order_by(Devices.Id).all():
+        evaluation = DevicesReplacementService.evaluate_device_replacement(device, legacy_stats(device))
+        if evaluation["should_retire"]:
+            results.append(evaluation)
+    results.sort(key=DevicesReplacementService.report_sort_key)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=5000)
+    parser.add_argument('--maintenances', type=int, default=4, help='متوسط عدد الصيانات لكل جهاز')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    app = create_bench_app('devices_replacement')
+
+    from extensions import db
+    from model import Devices, Maintenances, SpareParts
+    from services import DevicesReplacementService
+
+    with app.app_context():
+        device_ids, user_ids = seed_lab(device_count=args.devices, user_count=1)
+
+        generator = random.Random(25)
+        now = datetime.now()
+        for device in Devices.query.all():
+            device.PurchaseDate = now - timedelta(days=generator.randrange(100, 5000))
+            device.PurchaseCost = generator.randrange(500, 20000)
+            device.TotalOperatingHours = generator.randrange(0, 5000)
+        maintenances = []
+        parts = []
+        for device_id in device_ids:
+            for _ in range(generator.randrange(0, args.maintenances * 2 + 1)):
+                scheduled_at = now - timedelta(days=generator.randrange(1, 700))
+                maintenances.append(dict(
+                    Priority="-", Status="مكتملة", Type=generator.choice(("إصلاح", "دورية", "معايرة")),
+                    SchedulingAt=scheduled_at, StartAt=scheduled_at, EndAt=scheduled_at,
+                    Cost=generator.randrange(10, 3000), DeviceId=device_id, Reason="bench", UserId=user_ids[0]
+                ))
+            for _ in range(generator.randrange(0, 3)):
+                parts.append(dict(
+                    PartName=f"قطعة {len(parts) + 1}", Type="-", Quantity=generator.randrange(0, 30),
+                    MinimumQuantity=1, Unit="-", Cost=generator.randrange(5, 200), DeviceId=device_id, LaboratoryId=1
+                ))
+        db.session.execute(insert(Maintenances), maintenances)
+        db.session.execute(insert(SpareParts), parts)
+        db.session.commit()
+
+        results = {}
+        for name, check in (("legacy", legacy_replacement), ("current", DevicesReplacementService.get_devices_for_replacement)):
+            def run():
+                db.session.remove()
+                return check()
+
+            with count_queries(db.engine) as queries:
+                results[name] = run()
+            best, mean = timed(run, 1 if name == "legacy" else args.repeat)
+            print(f"{name:8} devices={args.devices} retire={len(results[name])} "
+                  f"queries={queries['count']} best={best:.1f}ms mean={mean:.1f}ms")
+
+        identical = json.dumps(results['legacy'], ensure_ascii=False) == json.dumps(results['current'], ensure_ascii=False)
+        print(f"identical_output={identical}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+"""
+قياس احتياجات قطع الغيار المستقبلية (/future-spare-parts-needs) مع عشرات الآلاف من القطع
+
+يقارن الطريقة السابقة (أربعة استعلامات على القطع، واستعلام لقطع كل صيانة قادمة ولاسم جهاز كل
+قطعة، ومنع التكرار بالبحث في القوائم) بالاستعلام الواحد الحالي، ويتحقق من تطابق المخرجات.
+الطريقة السابقة تربيعية في عدد القطع (نحو 20 ثانية عند 50 ألف قطعة)، لذلك تقاس فقط حتى
+--legacy-limit قطعة.
+
+الاستخدام:
+    python benchmarks/bench_future_needs.py --parts 50000
+"""
+import argparse
+import json
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+
+from common import count_queries, create_bench_app, seed_lab, timed
+
+
+def legacy_device_name(device_id):
+    from model import Devices
+
+    device = Devices.query.filter_by(Id=device_id).first()
+    return device.Name if device else "غير معروف"
+
+
+def legacy_part_info(part, **details):
+    info = {
+        "id": part.PartId,
+        "name": part.PartName,
+        "current_quantity": part.Quantity,
+        "minimum_quantity": part.MinimumQuantity,
+        "device_id": part.DeviceId,
+        "device_name": legacy_device_name(part.DeviceId),
+        "lab_id": part.LaboratoryId,
+        "unit": part.Unit,
+        "cost": round(float(part.Cost), 2),
+        "expiry_date": part.ExpiryDate.strftime('%Y-%m-%d') if part.ExpiryDate else None
+    }
+    info.update(details)
+    return info
+
+
+def legacy_needs():
+    """نسخة من حساب الاحتياجات السابق للمقارنة"""
+    from model import Maintenances, SpareParts
+
+    today = datetime.now()
+    two_months = today + timedelta(days=60)
+
+    low_stock_parts = SpareParts.query.filter(SpareParts.Quantity <= (SpareParts.MinimumQuantity * 1.2)).all()
+    expiring_parts = SpareParts.query.filter(
+        SpareParts.ExpiryDate.isnot(None),
+        SpareParts.ExpiryDate <= two_months,
+        SpareParts.Quantity > 0
+    ).all()
+
+    high_consumption_parts = []
+    for part in SpareParts.query.filter(SpareParts.LastRestockDate.isnot(None), SpareParts.Quantity > 0).all():
+        days_since_restock = (today - part.LastRestockDate).days
+        if days_since_restock > 0:
+            consumed_quantity = part.Quantity * 1.5 - part.Quantity
+            daily_consumption_rate = consumed_quantity / days_since_restock
+            days_until_empty = part.Quantity / daily_consumption_rate if daily_consumption_rate > 0 else 999
+            if days_until_empty <= 45:
+                part.estimated_days = round(days_until_empty, 2)
+                part.consumption_rate = round(daily_consumption_rate, 2)
+                high_consumption_parts.append(part)
+
+    upcoming_maintenances = Maintenances.query.filter(
+        Maintenances.Status.in_(["مجدولة", "قيد التنفيذ", "تم الجدولة"]),
+        Maintenances.SchedulingAt > today,
+        Maintenances.SchedulingAt <= two_months
+    ).all()
+    maintenance_related_parts = []
+    for maintenance in upcoming_maintenances:
+        if maintenance.DeviceId:
+            for part in SpareParts.query.filter_by(DeviceId=maintenance.DeviceId).all():
+                if part not in maintenance_related_parts:
+                    maintenance_related_parts.append(part)
+
+    all_parts_list = []
+    for part in low_stock_parts:
+        stock_percentage = (part.Quantity / part.MinimumQuantity * 100) if part.MinimumQuantity > 0 else 0
+        if part.Quantity <= part.MinimumQuantity:
+            priority, days_to_action = "عالية", 0
+        else:
+            priority, days_to_action = "متوسطة", round((part.Quantity - part.MinimumQuantity) * 2, 2)
+        suggested_quantity = max(part.MinimumQuantity * 2 - part.Quantity, 5)
+        all_parts_list.append(legacy_part_info(
+            part, priority=priority, reason="منخفض المخزون", stock_percentage=round(stock_percentage, 2),
+            days_to_action=days_to_action, suggested_quantity=suggested_quantity,
+            total_cost_estimation=round(float(part.Cost) * suggested_quantity, 2)
+        ))
+
+    for part in expiring_parts:
+        if part.PartId not in [p["id"] for p in all_parts_list]:
+            days_to_expiry = (part.ExpiryDate - today).days
+            priority = "عالية" if days_to_expiry <= 15 else "متوسطة" if days_to_expiry <= 30 else "منخفضة"
+            suggested_quantity = max(part.Quantity, part.MinimumQuantity)
+            all_parts_list.append(legacy_part_info(
+                part, priority=priority, reason="قرب انتهاء الصلاحية", days_to_action=days_to_expiry,
+                suggested_quantity=suggested_quantity,
+                total_cost_estimation=round(float(part.Cost) * suggested_quantity, 2)
+            ))
+
+    for part in high_consumption_parts:
+        if part.PartId not in [p["id"] for p in all_parts_list]:
+            days_to_empty = part.estimated_days
+            priority = "عالية" if days_to_empty <= 15 else "متوسطة" if days_to_empty <= 30 else "منخفضة"
+            suggested_quantity = max(round(part.consumption_rate * 60), part.MinimumQuantity)
+            all_parts_list.append(legacy_part_info(
+                part, priority=priority, reason="معدل استهلاك عالي", days_to_action=days_to_empty,
+                consumption_rate=part.consumption_rate, suggested_quantity=suggested_quantity,
+                total_cost_estimation=round(float(part.Cost) * suggested_quantity, 2)
+            ))
+
+    for part in maintenance_related_parts:
+        if part.PartId not in [p["id"] for p in all_parts_list]:
+            if part.Quantity < part.MinimumQuantity:
+                priority, days_to_action = "عالية", 0
+            elif part.Quantity < part.MinimumQuantity * 1.5:
+                priority, days_to_action = "متوسطة", 15
+            else:
+                priority, days_to_action = "منخفضة", 30
+            suggested_quantity = max(part.MinimumQuantity - part.Quantity + 3, 3)
+            all_parts_list.append(legacy_part_info(
+                part, priority=priority, reason="مطلوبة للصيانة القادمة", days_to_action=days_to_action,
+                suggested_quantity=suggested_quantity,
+                total_cost_estimation=round(float(part.Cost) * suggested_quantity, 2)
+            ))
+
+    priority_order = {"عالية": 0, "متوسطة": 1, "منخفضة": 2}
+    final_sorted_list = sorted(all_parts_list, key=lambda x: (priority_order.get(x["priority"], 3), x["days_to_action"]))
+    return {
+        "summary": {
+            "total_parts_needed": len(final_sorted_list),
+            "high_priority_count": sum(1 for item in final_sorted_list if item["priority"] == "عالية"),
+            "total_estimated_cost": round(sum(item["total_cost_estimation"] for item in final_sorted_list), 2),
+            "date_generated": today.strftime('%Y-%m-%d')
+        },
+        "parts_to_purchase": final_sorted_list
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--parts', type=int, default=50000)
+    parser.add_argument('--devices', type=int, default=2000)
+    parser.add_argument('--legacy-limit', type=int, default=50000, help='أكبر عدد قطع تقاس عنده الطريقة السابقة')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    app = create_bench_app('future_needs')
+
+    from extensions import db
+    from model import Maintenances, SpareParts
+    from services import FutureNeedsService
+
+    with app.app_context():
+        device_ids, user_ids = seed_lab(device_count=args.devices, user_count=1)
+
+        generator = random.Random(21)
+        now = datetime.now()
+        parts = []
+        for index in range(args.parts):
+            minimum = generator.randrange(1, 10)
+            parts.append(dict(
+                PartName=f"قطعة {index + 1}", Type="-", Quantity=generator.randrange(0, 60), MinimumQuantity=minimum,
+                Unit="-", Cost=generator.randrange(5, 200),
+                LastRestockDate=generator.choice((None, now - timedelta(days=generator.randrange(1, 200)))),
+                ExpiryDate=generator.choice((None, now + timedelta(days=generator.randrange(1, 400)))),
+                DeviceId=generator.choice(device_ids), LaboratoryId=1
+            ))
+        db.session.execute(insert(SpareParts), parts)
+        # صيانات قادمة لعشر الأجهزة، بترتيب الأجهزة حتى يطابق ترتيب الطريقة السابقة عند تساوي الأولوية
+        db.session.execute(insert(Maintenances), [
+            dict(
+                Priority="-", Status="مجدولة", Type="دورية", SchedulingAt=now + timedelta(days=generator.randrange(1, 60)),
+                Cost=100, DeviceId=device_id, Reason="bench", UserId=user_ids[0]
+            )
+            for device_id in sorted(generator.sample(device_ids, len(device_ids) // 10))
+        ])
+        db.session.commit()
+
+        results = {}
+        checks = [("current", FutureNeedsService.get_future_spare_parts_needs)]
+        if args.parts <= args.legacy_limit:
+            checks.insert(0, ("legacy", legacy_needs))
+        for name, check in checks:
+            def run():
+                db.session.remove()
+                return check()
+
+            with count_queries(db.engine) as queries:
+                results[name] = run()
+            best, mean = timed(run, 1 if name == "legacy" else args.repeat)
+            print(f"{name:8} parts={args.parts} needed={results[name]['summary']['total_parts_needed']} "
+                  f"queries={queries['count']} best={best:.1f}ms mean={mean:.1f}ms")
+
+        if "legacy" in results:
+            identical = json.dumps(results['legacy'], ensure_ascii=False) == json.dumps(results['current'], ensure_ascii=False)
+            print(f"identical_output={identical}")
+        else:
+            print(f"legacy skipped (parts > --legacy-limit {args.legacy_limit})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+قياس التحقق من توفر المعمل مع آلاف الحجوزات في نفس اليوم
+
+يقارن الطريقة السابقة (تحميل كل الحجوزات المتداخلة ثم قراءة نوع المستخدم من العلاقة)
+بالاستعلام الحالي الذي يحمل المستخدم والمعمل والتجربة وأعلام EXISTS في رحلة واحدة.
+
+الاستخدام:
+    python benchmarks/bench_lab_availability.py --reservations 5000
+"""
+import argparse
+import random
+from datetime import datetime, time
+
+from sqlalchemy import and_, insert, or_
+
+from common import count_queries, create_bench_app, future_date, seed_lab, seed_users, timed
+
+
+def current_lab_check(user_id, lab_id, experiment_id, reservation_date, start_time, end_time):
+    """مسار التحقق الحالي: تحميل المستخدم والمعمل والتجربة مع أعلام التداخل ثم التحقق من المعمل"""
+    from services import BookingRequest, ReservationService
+
+    ok, booking = BookingRequest.parse(user_id, lab_id, experiment_id, [], reservation_date, start_time, end_time)
+    user, lab, _, conflict_flags = ReservationService.load_booking_entities(booking, include_lab_conflicts=True)
+    return ReservationService.validate_lab_availability(booking, lab, user.UserType, conflict_flags=conflict_flags)[1]
+
+
+def legacy_lab_check(lab_id, user_type, reservation_date, start_time, end_time):
+    """نسخة من الاستعلام السابق للمقارنة"""
+    from extensions import db
+    from model import Laboratories, Reservations, Users
+    from services import ReservationService
+
+    lab = Laboratories.query.get(lab_id)
+    overlapping_reservations = db.session.query(Reservations).filter(
+        Reservations.LabId == lab_id,
+        Reservations.Date == reservation_date,
+        Reservations.IsAllowed == True,
+        or_(
+            and_(Reservations.StartTime <= start_time, Reservations.EndTime > start_time),
+            and_(Reservations.StartTime < end_time, Reservations.EndTime >= end_time),
+            and_(Reservations.StartTime >= start_time, Reservations.EndTime <= end_time)
+        )
+    )
+    overlapping_user_types = [
+        reservation.user.UserType for reservation in overlapping_reservations.join(Users).all()
+    ]
+    return ReservationService.lab_conflict_message(lab.LabName, user_type, overlapping_user_types)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--reservations', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    app = create_bench_app('lab_availability')
+    app.config['RESERVATION_INDEX_ENABLED'] = False
+
+    from extensions import db
+    from model import Reservations
+
+    day_str = future_date(1)
+    day = datetime.strptime(day_str, "%Y-%m-%d").date()
+    with app.app_context():
+        device_ids, doctor_ids = seed_lab(device_count=20, user_count=100)
+        researcher_ids = seed_users(1000, 100, "باحث")
+        db.session.commit()
+
+        generator = random.Random(7)
+        rows = []
+        for _ in range(args.reservations):
+            start_minute = generator.randrange(8 * 60, 18 * 60, 5)
+            length = generator.choice((30, 60, 90, 120))
+            end_minute = min(start_minute + length, 23 * 60 + 55)
+            rows.append(dict(
+                Date=day,
+                StartTime=time(start_minute // 60, start_minute % 60),
+                EndTime=time(end_minute // 60, end_minute % 60),
+                Purpose="bench",
+                DeviceId=generator.choice(device_ids),
+                UserId=generator.choice(researcher_ids if generator.random() < 0.7 else doctor_ids),
+                ExperimentId=1,
+                IsAllowed=True,
+                LabId=1
+            ))
+        db.session.execute(insert(Reservations), rows)
+        db.session.commit()
+
+        start_time, end_time = time(10, 0), time(11, 0)
+        checks = [
+            ("legacy", lambda: legacy_lab_check(1, "دكتور", day, start_time, end_time)),
+            ("current", lambda: current_lab_check(doctor_ids[0], 1, 1, day_str, "10:00", "11:00")),
+        ]
+        for name, check in checks:
+            def run():
+                # جلسة جديدة في كل مرة حتى لا تخفي ذاكرة الجلسة الاستعلامات الكسولة
+                db.session.remove()
+                return check()
+
+            with count_queries(db.engine) as queries:
+                message = run()
+            best, mean = timed(run, args.repeat)
+            print(f"{name:8} reservations={args.reservations} queries={queries['count']} "
+                  f"best={best:.2f}ms mean={mean:.2f}ms message={message}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""
+قياس توقعات الصيانة (/api/devices-maintenance-prediction) مع آلاف الأجهزة
+
+يقارن الطريقة السابقة (استعلام لآخر معايرة وحتى أربعة استعلامات للتكلفة لكل جهاز)
+بمحرك الدفعة الحالي، ويتحقق من تطابق المخرجات.
+
+الاستخدام:
+    python benchmarks/bench_maintenance_prediction.py --devices 10000
+"""
+import argparse
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, insert, not_
+
+from common import count_queries, create_bench_app, seed_lab, timed
+
+
+def legacy_expected_cost(device, maintenance_type):
+    """نسخة من حساب التكلفة السابق للمقارنة"""
+    from extensions import db
+    from model import Devices, Maintenances
+
+    previous_maintenance = Maintenances.query.filter(
+        Maintenances.DeviceId == device.Id,
+        Maintenances.Type == maintenance_type
+    ).order_by(Maintenances.EndAt.desc()).first()
+    if previous_maintenance:
+        return float(previous_maintenance.Cost)
+
+    similar_device_ids = [d.Id for d in Devices.query.filter(
+        Devices.CategoryName == device.CategoryName,
+        Devices.Id != device.Id
+    ).all()]
+    if similar_device_ids:
+        similar_maintenance = Maintenances.query.filter(
+            Maintenances.DeviceId.in_(similar_device_ids),
+            Maintenances.Type == maintenance_type
+        ).order_by(Maintenances.EndAt.desc()).first()
+        if similar_maintenance:
+            return float(similar_maintenance.Cost)
+
+    avg_cost = db.session.query(func.avg(Maintenances.Cost)).filter(
+        Maintenances.Type == maintenance_type
+    ).scalar()
+    if avg_cost:
+        return float(avg_cost)
+    return 500.0
+
+
+def legacy_predictions():
+    """نسخة من حلقة التوقعات السابقة للمقارنة"""
+    from model import Devices, Maintenances
+
+    available_devices = Devices.query.filter(
+        not_(Devices.Status.in_(["قيد الصيانة", "في الصيانة", "غير متاح"]))
+    ).all()
+    predictions = []
+    current_date = datetime.now()
+    for device in available_devices:
+        prediction = {"Id": device.Id, "Name": device.Name, "CurrentHour": device.CurrentHour, "MaximumHour": device.MaximumHour}
+        if device.CurrentHour >= device.MaximumHour * 0.9:
+            prediction["MaintenanceType"] = "صيانة دورية"
+            remaining_hours = device.MaximumHour - device.CurrentHour
+            prediction["ExpectedDate"] = (current_date + timedelta(days=remaining_hours / 8)).strftime('%Y-%m-%d')
+            prediction["ExpectedCost"] = legacy_expected_cost(device, "صيانة دورية")
+        if device.CalibrationInterval is not None and device.LastMaintenanceDate is not None:
+            last_calibration = Maintenances.query.filter(
+                Maintenances.DeviceId == device.Id,
+                Maintenances.Type == "معايرة"
+            ).order_by(Maintenances.EndAt.desc()).first()
+            if last_calibration:
+                next_calibration_date = last_calibration.EndAt + timedelta(days=device.CalibrationInterval * 30)
+                days_left = (next_calibration_date - current_date).days
+                if 0 < days_left <= 30:
+                    if "MaintenanceType" not in prediction or (
+                        datetime.strptime(prediction["ExpectedDate"], '%Y-%m-%d') > next_calibration_date
+                    ):
+                        prediction["MaintenanceType"] = "معايرة"
+                        prediction["ExpectedDate"] = next_calibration_date.strftime('%Y-%m-%d')
+                        prediction["ExpectedCost"] = legacy_expected_cost(device, "معايرة")
+                elif days_left <= 0:
+                    prediction["MaintenanceType"] = "معايرة متأخرة"
+                    prediction["ExpectedDate"] = next_calibration_date.strftime('%Y-%m-%d')
+                    prediction["ExpectedCost"] = legacy_expected_cost(device, "معايرة")
+        if "MaintenanceType" in prediction:
+            predictions.append(prediction)
+    return predictions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=10000)
+    parser.add_argument('--maintenances', type=int, default=2, help='عدد الصيانات لكل جهاز في المتوسط')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    app = create_bench_app('maintenance_prediction')
+
+    from extensions import db
+    from model import Devices, Maintenances
+    from services import MaintenancePredictionService, MaintenanceSummaryService
+
+    with app.app_context():
+        device_ids, user_ids = seed_lab(device_count=args.devices, user_count=1)
+
+        generator = random.Random(12)
+        now = datetime.now()
+        for device in Devices.query.all():
+            device.CategoryName = f"فئة {generator.randrange(50)}"
+            device.CurrentHour = generator.randrange(0, 11000)
+            device.CalibrationInterval = generator.choice((None, 1, 3, 6, 12))
+            device.Status = generator.choice(("متاح", "متاح", "متاح", "في الصيانة", "غير متاح"))
+        rows = []
+        for _ in range(args.devices * args.maintenances):
+            end_at = now - timedelta(days=generator.randrange(1, 400), minutes=generator.randrange(1440))
+            rows.append(dict(
+                Priority="-", Status="مكتملة", Type=generator.choice(("معايرة", "صيانة دورية", "إصلاح")),
+                SchedulingAt=end_at, StartAt=end_at, EndAt=end_at, Cost=generator.randrange(50, 900),
+                DeviceId=generator.choice(device_ids), Reason="bench", UserId=user_ids[0]
+            ))
+        db.session.execute(insert(Maintenances), rows)
+        db.session.commit()
+        # الإدخال المجمع لا يمر بأحداث الجلسة، فيبنى الملخص مرة واحدة كما تفعل المهمة المجدولة
+        MaintenanceSummaryService.rebuild()
+
+        results = {}
+        checks = [
+            ("legacy", legacy_predictions),
+            ("current", MaintenancePredictionService.predict_device_maintenance),
+        ]
+        for name, check in checks:
+            def run():
+                db.session.remove()
+                return check()
+
+            with count_queries(db.engine) as queries:
+                results[name] = run()
+            best, mean = timed(run, args.repeat)
+            print(f"{name:8} devices={args.devices} predictions={len(results[name])} queries={queries['count']} "
+                  f"best={best:.1f}ms mean={mean:.1f}ms")
+
+        print(f"identical_output={results['legacy'] == results['current']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+قياس تقرير الأجهزة التي تحتاج صيانة (/devices/maintenance-needed) مع آلاف الأجهزة
+
+يقارن الطريقة السابقة (استعلامان لآخر معايرة لكل جهاز) بالاستعلام الحالي
+الذي يجمع MAX(EndAt) لكل جهاز مع أعمدة الأجهزة في رحلة واحدة.
+
+الاستخدام:
+    python benchmarks/bench_maintenance_report.py --devices 2000
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, insert, select
+
+from common import count_queries, create_bench_app, seed_lab, timed
+
+
+def legacy_report():
+    """نسخة من التقرير السابق للمقارنة (مع تصحيح فلتر الحالة فقط)"""
+    from extensions import db
+    from model import Devices, Maintenances
+    from services import MaintenanceService
+
+    def last_calibration(device_id):
+        stmt = select(Maintenances.EndAt).where(
+            and_(Maintenances.DeviceId == device_id, Maintenances.Type == "معايرة")
+        ).order_by(Maintenances.EndAt.desc())
+        result = db.session.execute(stmt).first()
+        return result[0] if result else None
+
+    priority_order = {"طارئة": 4, "عالية": 3, "متوسطة": 2, "ضعيفة": 1, "غير محدد": 0}
+    devices_data = []
+    for device in Devices.query.filter(Devices.Status.notin_(["في الصيانة", "غير متاح"])).all():
+        periodic = MaintenanceService.calculate_periodic_maintenance_priority(device.CurrentHour, device.MaximumHour)
+        calibration = MaintenanceService.calculate_calibration_priority(
+            last_calibration(device.Id) if device.CalibrationInterval else None, device.CalibrationInterval
+        )
+        last_date = last_calibration(device.Id)
+        devices_data.append((device.Id, max(periodic, calibration, key=priority_order.get), last_date))
+    return devices_data
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=2000)
+    parser.add_argument('--calibrations', type=int, default=3, help='عدد المعايرات لكل جهاز')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = create_bench_app('maintenance_report')
+
+    from extensions import db
+    from model import Devices, Maintenances
+    from services import MaintenanceService, MaintenanceSummaryService
+
+    with app.app_context():
+        device_ids, user_ids = seed_lab(device_count=args.devices, user_count=1)
+
+        generator = random.Random(11)
+        now = datetime.now()
+        for device in Devices.query.all():
+            device.CurrentHour = generator.randrange(0, 11000)
+            device.CalibrationInterval = generator.choice((None, 3, 6, 12))
+            device.Status = generator.choice(("متاح", "متاح", "متاح", "في الصيانة", "غير متاح"))
+        rows = []
+        for device_id in device_ids:
+            for _ in range(args.calibrations):
+                end_at = now - timedelta(days=generator.randrange(1, 900))
+                rows.append(dict(
+                    Priority="-", Status="مكتملة", Type=generator.choice(("معايرة", "معايرة", "دورية")),
+                    SchedulingAt=end_at, StartAt=end_at, EndAt=end_at, Cost=100,
+                    DeviceId=device_id, Reason="bench", UserId=user_ids[0]
+                ))
+        db.session.execute(insert(Maintenances), rows)
+        db.session.commit()
+        # الإدخال المجمع لا يمر بأحداث الجلسة، فيبنى الملخص مرة واحدة كما تفعل المهمة المجدولة
+        MaintenanceSummaryService.rebuild()
+
+        checks = [
+            ("legacy", legacy_report),
+            ("current", lambda: MaintenanceService.get_devices_needing_maintenance()[1]),
+        ]
+        for name, check in checks:
+            def run():
+                db.session.remove()
+                return check()
+
+            with count_queries(db.engine) as queries:
+                devices = run()
+            started = time.process_time()
+            best, mean = timed(run, args.repeat)
+            cpu = (time.process_time() - started) / args.repeat * 1000
+            print(f"{name:8} devices={args.devices} reported={len(devices)} queries={queries['count']} "
+                  f"best={best:.1f}ms mean={mean:.1f}ms cpu={cpu:.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
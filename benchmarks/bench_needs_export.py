@@ -0,0 +1,82 @@
+"""
+قياس ذاكرة تصدير احتياجات قطع الغيار (/future-spare-parts-needs?format=csv|ndjson)
+
+يقيس أعلى استهلاك للذاكرة (tracemalloc) أثناء إرسال الرد بالكامل لكل صيغة بعد تحميل التقرير المجمع
+في الذاكرة، فالزيادة تخص الرد وحده. رد JSON يبنى كاملاً قبل إرساله فيكبر مع عدد القطع، والصيغ
+المتدفقة تكتب جزءاً بعد جزء فتبقى ثابتة تقريباً.
+
+الاستخدام:
+    python benchmarks/bench_needs_export.py --parts 50000
+"""
+import argparse
+import csv
+import io
+import json
+import random
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+
+from common import create_bench_app, seed_lab
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--parts', type=int, default=50000)
+    parser.add_argument('--devices', type=int, default=2000)
+    args = parser.parse_args()
+
+    app = create_bench_app('needs_export')
+
+    from extensions import db
+    from model import SpareParts
+    from services import future_needs_index
+
+    with app.app_context():
+        device_ids, _ = seed_lab(device_count=args.devices, user_count=1)
+
+        generator = random.Random(24)
+        now = datetime.now()
+        db.session.execute(insert(SpareParts), [
+            dict(
+                PartName=f"قطعة {index + 1}", Type="-", Quantity=generator.randrange(0, 60),
+                MinimumQuantity=generator.randrange(1, 10), Unit="-", Cost=generator.randrange(5, 200),
+                LastRestockDate=generator.choice((None, now - timedelta(days=generator.randrange(1, 200)))),
+                ExpiryDate=generator.choice((None, now + timedelta(days=generator.randrange(1, 400)))),
+                DeviceId=generator.choice(device_ids), LaboratoryId=1
+            )
+            for index in range(args.parts)
+        ])
+        db.session.commit()
+        needed = future_needs_index.filter()["summary"]["total_parts_needed"]
+
+    client = app.test_client()
+    bodies = {}
+    for output_format in ('json', 'csv', 'ndjson'):
+        tracemalloc.start()
+        started = time.perf_counter()
+        response = client.get(f'/future-spare-parts-needs?format={output_format}&lab_id=1', buffered=False)
+        size = 0
+        for chunk in response.response:
+            size += len(chunk)
+        elapsed = (time.perf_counter() - started) * 1000
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        response.close()
+        bodies[output_format] = client.get(f'/future-spare-parts-needs?format={output_format}&lab_id=1').get_data(as_text=True)
+        print(f"{output_format:7} parts={args.parts} needed={needed} size={size / 1024:.0f}KB "
+              f"peak={peak / 1024:.0f}KB time={elapsed:.1f}ms")
+
+    # نفس القطع بنفس الترتيب في الصيغ الثلاث
+    ids = {
+        'json': [part["id"] for part in json.loads(bodies['json'])["parts_to_purchase"]],
+        'csv': [int(row["id"]) for row in csv.DictReader(io.StringIO(bodies['csv'].lstrip("\ufeff")))],
+        'ndjson': [json.loads(line)["id"] for line in bodies['ndjson'].splitlines()[1:]]
+    }
+    print(f"identical_output={ids['json'] == ids['csv'] == ids['ndjson'] and len(ids['json']) == needed}")
+
+
+if __name__ == '__main__':
+    main()
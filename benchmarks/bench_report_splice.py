@@ -0,0 +1,102 @@
+"""
+قياس دمج التغييرات في التقارير المحسوبة مسبقاً مقارنة بإعادة حسابها بالكامل
+
+يحسب التقارير الأربعة، ثم في كل جولة يضيف حجوزات لعدد قليل من الأجهزة (كما يحدث باستمرار أثناء
+العمل) ويقيس دمج صفوفها فقط مقابل الحساب الكامل، ويتحقق في النهاية من تطابق النسخة المدمجة
+مع حساب كامل جديد.
+
+الاستخدام:
+    python benchmarks/bench_report_splice.py --devices 5000 --changes 20
+"""
+import argparse
+import json
+import random
+import time
+from datetime import date, datetime, time as clock, timedelta
+
+from sqlalchemy import insert
+
+from common import count_queries, create_bench_app, seed_lab, timed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=5000)
+    parser.add_argument('--changes', type=int, default=20, help='عدد الحجوزات الجديدة في كل جولة')
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    app = create_bench_app('report_splice')
+
+    from extensions import db
+    from model import Devices, Maintenances, SpareParts, Reservations, ReportSnapshots
+    from services import MaintenanceSummaryService, ReportSnapshotService
+
+    with app.app_context():
+        device_ids, user_ids = seed_lab(device_count=args.devices, user_count=1)
+
+        generator = random.Random(18)
+        now = datetime.now()
+        for device in Devices.query.all():
+            device.CategoryName = f"فئة {generator.randrange(50)}"
+            device.CurrentHour = generator.randrange(0, 11000)
+            device.CalibrationInterval = generator.choice((None, 1, 3, 6, 12))
+            device.PurchaseDate = now - timedelta(days=generator.randrange(100, 5000))
+        maintenances = []
+        parts = []
+        for device_id in device_ids:
+            for _ in range(2):
+                end_at = now - timedelta(days=generator.randrange(1, 400))
+                maintenances.append(dict(
+                    Priority="-", Status="مكتملة", Type=generator.choice(("معايرة", "صيانة دورية", "إصلاح", "دورية")),
+                    SchedulingAt=end_at, StartAt=end_at, EndAt=end_at, Cost=generator.randrange(50, 900),
+                    DeviceId=device_id, Reason="bench", UserId=user_ids[0]
+                ))
+                parts.append(dict(
+                    PartName=f"قطعة {len(parts) + 1}", Type="-", Quantity=generator.randrange(0, 30),
+                    MinimumQuantity=generator.randrange(1, 10), Unit="-", Cost=generator.randrange(5, 200),
+                    LastRestockDate=now - timedelta(days=generator.randrange(1, 90)),
+                    ExpiryDate=now + timedelta(days=generator.randrange(1, 400)), DeviceId=device_id, LaboratoryId=1
+                ))
+        db.session.execute(insert(Maintenances), maintenances)
+        db.session.execute(insert(SpareParts), parts)
+        db.session.commit()
+        MaintenanceSummaryService.rebuild()
+
+        names = list(ReportSnapshotService.builders())
+        for name in names:
+            ReportSnapshotService.refresh(name)
+
+        def full_build():
+            for name in names:
+                ReportSnapshotService.build(name)
+
+        best, mean = timed(full_build, 1)
+        print(f"full     devices={args.devices} reports={len(names)} best={best:.1f}ms")
+
+        day = date.today() + timedelta(days=1)
+        for round_number in range(args.rounds):
+            for index in range(args.changes):
+                start = clock(8 + (round_number * args.changes + index) % 12, 0)
+                db.session.add(Reservations(
+                    Date=day, StartTime=start, EndTime=clock(start.hour + 1, 0), Purpose="bench",
+                    DeviceId=generator.choice(device_ids), UserId=user_ids[0], ExperimentId=1, IsAllowed=True, LabId=1
+                ))
+            db.session.commit()
+
+            with count_queries(db.engine) as queries:
+                started = time.perf_counter()
+                ReportSnapshotService.splice_all()
+                elapsed = (time.perf_counter() - started) * 1000
+            print(f"splice   round={round_number + 1} changes={args.changes} queries={queries['count']} time={elapsed:.1f}ms")
+
+        identical = all(
+            json.loads(db.session.query(ReportSnapshots.Payload).filter(ReportSnapshots.Name == name).scalar())
+            == json.loads(ReportSnapshotService.build(name)[0])
+            for name in names
+        )
+        print(f"identical_output={identical}")
+
+
+if __name__ == '__main__':
+    main()
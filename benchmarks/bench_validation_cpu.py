@@ -0,0 +1,57 @@
+"""
+قياس زمن المعالج لكل طلب في محرك التحقق من الحجز (التحويل + التحقق بدون الحفظ)
+
+الاستخدام:
+    python benchmarks/bench_validation_cpu.py --requests 2000
+"""
+import argparse
+import time
+
+from common import count_queries, create_bench_app, future_date, seed_lab
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    app = create_bench_app('validation_cpu')
+
+    from extensions import db
+    from services import BookingRequest, ReservationService
+
+    with app.app_context():
+        device_ids, user_ids = seed_lab(device_count=6, user_count=4)
+        day = future_date(3)
+
+        def validate_once():
+            parsed, booking = BookingRequest.parse(
+                user_ids[0], 1, 1, device_ids[:3], day, "10:00", "12:00", "bench"
+            )
+            valid, result = ReservationService.validate_booking(booking)
+            assert valid, result
+            return booking.hours
+
+        for index_enabled in (True, False):
+            app.config['RESERVATION_INDEX_ENABLED'] = index_enabled
+            for _ in range(50):
+                validate_once()
+
+            with count_queries(db.engine) as queries:
+                validate_once()
+
+            started = time.process_time()
+            for _ in range(args.requests):
+                validate_once()
+            cpu_per_request = (time.process_time() - started) / args.requests * 1e6
+            print(f"index={'on ' if index_enabled else 'off'} queries={queries['count']} "
+                  f"cpu_per_request={cpu_per_request:.0f}us")
+
+        started = time.process_time()
+        for _ in range(args.requests * 10):
+            BookingRequest.parse(user_ids[0], 1, 1, device_ids[:3], day, "10:00", "12:00", "bench")
+        print(f"parse_only cpu_per_request={(time.process_time() - started) / (args.requests * 10) * 1e6:.1f}us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+أدوات مشتركة لسكربتات قياس الأداء
+
+تعمل السكربتات على قاعدة بيانات منفصلة يحددها BENCH_DATABASE_URL (مثلاً PostgreSQL أو SQL Server
+تجريبي)، وإن لم يحدد تستخدم ملف SQLite مؤقت. لا تستخدم DATABASE_URL عمداً لأن السكربتات
+تحذف الجداول وتعيد إنشاءها.
+"""
+import os
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def create_bench_app(name):
+    """إنشاء التطبيق على قاعدة بيانات القياس بجداول فارغة"""
+    bench_url = os.environ.get('BENCH_DATABASE_URL')
+    if not bench_url:
+        path = os.path.join(tempfile.gettempdir(), f'physics_lab_bench_{name}.db')
+        if os.path.exists(path):
+            os.remove(path)
+        bench_url = f'sqlite:///{path}'
+    os.environ['DATABASE_URL'] = bench_url
+
+    from app import app
+    from extensions import db
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    return app
+
+
+def seed_lab(lab_id=1, experiment_id=1, device_count=10, user_count=10, user_type="دكتور"):
+    """إضافة معمل أكاديمي وتجربة وأجهزة مرتبطة بهما ومستخدمين"""
+    from extensions import db
+    from model import Users, Laboratories, Experiments, Devices, ExperimentDevices, DeviceLabs
+
+    now = datetime.now()
+    db.session.add(Laboratories(
+        LabId=lab_id, LabName=f"معمل {lab_id}", Type="أكاديمي", Location="-", Status="متاح",
+        TotalOperatingHours=0, OperatingCost=0, UsageHours=0
+    ))
+    db.session.add(Experiments(
+        ExperimentId=experiment_id, ExperimentName=f"تجربة {experiment_id}", Description="-",
+        LabId=lab_id, CompletedCount=0, Type="أكاديمية"
+    ))
+    first_device = (lab_id - 1) * device_count + 1
+    device_ids = list(range(first_device, first_device + device_count))
+    for device_id in device_ids:
+        db.session.add(Devices(
+            Id=device_id, SerialNumber=f"SN-{device_id}", Name=f"جهاز {device_id}", CategoryName="عام",
+            Status="متاح", PurchaseDate=now - timedelta(days=365), Lifespan=10, CurrentHour=0,
+            MaximumHour=10000, LastMaintenanceDate=now - timedelta(days=30), TotalOperatingHours=0,
+            PurchaseCost=1000, UseRecommendations="-", SafetyRecommendations="-", JobDescription="-"
+        ))
+    db.session.flush()
+    for device_id in device_ids:
+        db.session.add(ExperimentDevices(ExperimentId=experiment_id, DeviceId=device_id))
+        db.session.add(DeviceLabs(DeviceId=device_id, LabId=lab_id))
+
+    user_ids = seed_users((lab_id - 1) * user_count + 1, user_count, user_type)
+    db.session.commit()
+    return device_ids, user_ids
+
+
+def seed_users(first_id, count, user_type="دكتور"):
+    """إضافة مستخدمين بأرقام متتالية (بدون حفظ)"""
+    from extensions import db
+    from model import Users
+
+    now = datetime.now()
+    user_ids = list(range(first_id, first_id + count))
+    for user_id in user_ids:
+        db.session.add(Users(
+            Id=user_id, UserType=user_type, NationalId=str(user_id), FullName=f"مستخدم {user_id}",
+            PhoneNumber="-", CreatedAt=now, Email=f"user{user_id}@example.com", ApplicationUserId=str(user_id)
+        ))
+    return user_ids
+
+
+def future_date(days=1):
+    return (date.today() + timedelta(days=days)).strftime("%Y-%m-%d")
+
+
+@contextmanager
+def count_queries(engine):
+    """عد جمل SQL المنفذة داخل الكتلة"""
+    from sqlalchemy import event
+
+    counter = {"count": 0}
+
+    def before_cursor_execute(*args):
+        counter["count"] += 1
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def timed(func, repeat=5):
+    """تنفيذ الدالة عدة مرات وإرجاع (أفضل زمن، متوسط الزمن) بالمللي ثانية"""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    return min(samples), sum(samples) / len(samples)
@@ -0,0 +1,132 @@
+"""
+المهام المجدولة للتطبيق (APScheduler)
+"""
+from extensions import scheduler
+from services import ReservationService, ReservationAttemptService, MaintenanceSummaryService, DeviceStatusService
+from services import ReportSnapshotService, AlertService
+from datetime import datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _in_app_context(app, name, func):
+    """تشغيل المهمة داخل سياق التطبيق حتى تعمل جلسة قاعدة البيانات"""
+    def job():
+        with app.app_context():
+            try:
+                func()
+            except Exception as e:
+                logger.error(f"فشل تنفيذ المهمة المجدولة {name}: {str(e)}")
+    return job
+
+
+def reconcile_hours():
+    ReservationService.reconcile_hours(apply=True)
+
+
+def compact_reservation_attempts():
+    ReservationAttemptService.compact()
+
+
+def rebuild_maintenance_summaries():
+    MaintenanceSummaryService.rebuild()
+
+
+def sync_device_statuses():
+    DeviceStatusService.sync_all()
+
+
+def refresh_report_snapshots():
+    ReportSnapshotService.refresh_all()
+
+
+def splice_report_changes():
+    ReportSnapshotService.splice_all()
+
+
+def generate_alerts():
+    AlertService.generate()
+
+
+def register_jobs(app):
+    """تسجيل المهام المجدولة حسب إعدادات التطبيق"""
+    reconciliation_interval = app.config.get('HOURS_RECONCILIATION_INTERVAL_HOURS')
+    if reconciliation_interval:
+        scheduler.add_job(
+            id='reconcile_hours',
+            func=_in_app_context(app, 'reconcile_hours', reconcile_hours),
+            trigger='interval',
+            hours=reconciliation_interval,
+            replace_existing=True
+        )
+        logger.info(f"تم جدولة تصحيح عدادات الساعات كل {reconciliation_interval} ساعة")
+
+    compaction_interval = app.config.get('RESERVATION_ATTEMPTS_COMPACTION_INTERVAL_HOURS')
+    if compaction_interval:
+        scheduler.add_job(
+            id='compact_reservation_attempts',
+            func=_in_app_context(app, 'compact_reservation_attempts', compact_reservation_attempts),
+            trigger='interval',
+            hours=compaction_interval,
+            replace_existing=True
+        )
+        logger.info(f"تم جدولة ضغط محاولات الحجز المرفوضة كل {compaction_interval} ساعة")
+
+    summary_interval = app.config.get('MAINTENANCE_SUMMARY_REBUILD_INTERVAL_HOURS')
+    if summary_interval:
+        scheduler.add_job(
+            id='rebuild_maintenance_summaries',
+            func=_in_app_context(app, 'rebuild_maintenance_summaries', rebuild_maintenance_summaries),
+            trigger='interval',
+            hours=summary_interval,
+            replace_existing=True
+        )
+        logger.info(f"تم جدولة إعادة بناء ملخص الصيانات كل {summary_interval} ساعة")
+
+    status_sync_interval = app.config.get('DEVICE_STATUS_SYNC_INTERVAL_HOURS')
+    if status_sync_interval:
+        scheduler.add_job(
+            id='sync_device_statuses',
+            func=_in_app_context(app, 'sync_device_statuses', sync_device_statuses),
+            trigger='interval',
+            hours=status_sync_interval,
+            replace_existing=True
+        )
+        logger.info(f"تم جدولة توحيد حالات الأجهزة كل {status_sync_interval} ساعة")
+
+    snapshot_interval = app.config.get('REPORT_SNAPSHOT_INTERVAL_MINUTES')
+    if snapshot_interval:
+        scheduler.add_job(
+            id='refresh_report_snapshots',
+            func=_in_app_context(app, 'refresh_report_snapshots', refresh_report_snapshots),
+            trigger='interval',
+            minutes=snapshot_interval,
+            # الحساب الأول عند بدء التشغيل حتى لا تنتظر الواجهات فترة كاملة
+            next_run_time=datetime.now(),
+            replace_existing=True
+        )
+        logger.info(f"تم جدولة حساب التقارير مسبقاً كل {snapshot_interval} دقيقة")
+
+        splice_interval = app.config.get('REPORT_SNAPSHOT_SPLICE_SECONDS')
+        if splice_interval:
+            scheduler.add_job(
+                id='splice_report_changes',
+                func=_in_app_context(app, 'splice_report_changes', splice_report_changes),
+                trigger='interval',
+                seconds=splice_interval,
+                replace_existing=True
+            )
+            logger.info(f"تم جدولة دمج تغييرات التقارير كل {splice_interval} ثانية")
+
+    alert_interval = app.config.get('ALERT_SCAN_INTERVAL_MINUTES')
+    if alert_interval:
+        scheduler.add_job(
+            id='generate_alerts',
+            func=_in_app_context(app, 'generate_alerts', generate_alerts),
+            trigger='interval',
+            minutes=alert_interval,
+            next_run_time=datetime.now(),
+            replace_existing=True
+        )
+        logger.info(f"تم جدولة حساب تنبيهات الصيانة كل {alert_interval} دقيقة")
@@ -0,0 +1,112 @@
+"""
+تعديلات مخطط قاعدة البيانات ذات الإصدارات
+
+db.create_all() ينشئ الجداول غير الموجودة فقط ولا يضيف أعمدة أو فهارس إلى الجداول الموجودة،
+لذلك تسجل هنا تعديلات المخطط بالترتيب، ويطبق عند بدء التطبيق ما لم يطبق منها بعد ويحفظ
+رقم كل إصدار مطبق في جدول SchemaMigrations.
+"""
+from sqlalchemy import inspect, text
+from extensions import db
+from model import Devices, Reservations, Maintenances, SpareParts, ExperimentDevices, SchemaMigrations, ReportSnapshots, Alerts
+from services import DeviceStatusService
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def model_index(model, name):
+    """الفهرس المعرف في النموذج بهذا الاسم"""
+    return next(index for index in model.__table__.indexes if index.name == name)
+
+
+# الفهارس المركبة لأعمدة التصفية في الاستعلامات الأكثر استخداماً (انظر benchmarks/index_advisor.py)
+HOT_FILTER_INDEXES = [
+    (Reservations, 'IX_Reservations_Lab_Date'),
+    (Reservations, 'IX_Reservations_Device_Date'),
+    (Maintenances, 'IX_Maintenances_Device_Type_EndAt'),
+    (ExperimentDevices, 'IX_ExperimentDevices_Experiment_Device'),
+    (SpareParts, 'IX_SpareParts_DeviceId'),
+    (Devices, 'IX_Devices_CategoryName'),
+]
+
+
+def create_indexes(engine, indexes):
+    """إنشاء الفهارس غير الموجودة، كل فهرس في معاملة مستقلة حتى لا يوقف فشل أحدها الباقي"""
+    existing = {}
+    for model, name in indexes:
+        table_name = model.__tablename__
+        if table_name not in existing:
+            existing[table_name] = {index['name'] for index in inspect(engine).get_indexes(table_name)}
+        if name in existing[table_name]:
+            continue
+        try:
+            with engine.begin() as connection:
+                model_index(model, name).create(connection)
+            logger.info(f"تم إنشاء الفهرس {name}")
+        except Exception as e:
+            # مثلاً أعمدة نصية بدون طول محدد في جداول SQL Server الموجودة لا يمكن فهرستها
+            logger.warning(f"تعذر إنشاء الفهرس {name}: {str(e)}")
+
+
+def drop_indexes(engine, indexes):
+    """حذف الفهارس الموجودة (لمقارنة خطط الاستعلامات قبل الفهارس وبعدها)"""
+    for model, name in indexes:
+        existing = {index['name'] for index in inspect(engine).get_indexes(model.__tablename__)}
+        if name in existing:
+            with engine.begin() as connection:
+                model_index(model, name).drop(connection)
+
+
+def add_column(engine, model, name):
+    """إضافة عمود النموذج إلى الجدول الموجود إذا لم يكن موجوداً (يجب أن يقبل NULL)"""
+    table_name = model.__tablename__
+    if name in {column['name'] for column in inspect(engine).get_columns(table_name)}:
+        return
+    column = model.__table__.c[name]
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.begin() as connection:
+        connection.execute(text(
+            f"ALTER TABLE {quote(table_name)} ADD {quote(name)} {column.type.compile(dialect=engine.dialect)} NULL"
+        ))
+    logger.info(f"تم إضافة العمود {table_name}.{name}")
+
+
+def add_hot_filter_indexes(engine):
+    create_indexes(engine, HOT_FILTER_INDEXES)
+
+
+def add_normalized_device_status(engine):
+    add_column(engine, Devices, 'NormalizedStatus')
+    with engine.begin() as connection:
+        updated = DeviceStatusService.sync(connection)
+    logger.info(f"تم حساب الحالة الموحدة لـ {updated} جهاز")
+    create_indexes(engine, [(Devices, 'IX_Devices_NormalizedStatus')])
+
+
+def add_report_snapshot_updated_at(engine):
+    add_column(engine, ReportSnapshots, 'UpdatedAt')
+
+
+def add_alert_expiry_index(engine):
+    create_indexes(engine, [(Alerts, 'IX_Alerts_ExpiresAt_Device')])
+
+
+# (الإصدار، الوصف، دالة التطبيق) بالترتيب، ولا يعدل إصدار بعد نشره بل يضاف إصدار جديد
+MIGRATIONS = [
+    (1, "فهارس مركبة لأعمدة التصفية الأكثر استخداماً", add_hot_filter_indexes),
+    (2, "عمود الحالة الموحدة للأجهزة مع فهرسه", add_normalized_device_status),
+    (3, "وقت آخر دمج للتغييرات في نسخ التقارير", add_report_snapshot_updated_at),
+    (4, "فهرس صلاحية التنبيهات لمنع تكرارها", add_alert_expiry_index),
+]
+
+
+def run_migrations():
+    """تطبيق تعديلات المخطط غير المطبقة بالترتيب"""
+    applied = {version for (version,) in db.session.query(SchemaMigrations.Version).all()}
+    for version, description, apply in MIGRATIONS:
+        if version in applied:
+            continue
+        apply(db.engine)
+        db.session.add(SchemaMigrations(Version=version, Description=description))
+        db.session.commit()
+        logger.info(f"تم تطبيق تعديل المخطط {version}: {description}")
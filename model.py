@@ -26,12 +26,18 @@ class Users(db.Model):
 
 class Devices(db.Model):
     __tablename__ = 'Devices'
+    __table_args__ = (
+        db.Index('IX_Devices_CategoryName', 'CategoryName'),
+        db.Index('IX_Devices_NormalizedStatus', 'NormalizedStatus'),
+    )
     
     Id = db.Column(db.Integer, primary_key=True)
     SerialNumber = db.Column(db.String, nullable=False)
     Name = db.Column(db.String, nullable=False)
     CategoryName = db.Column(db.String, nullable=False)
     Status = db.Column(db.String, nullable=False)
+    # الحالة بصيغتها الموحدة (بدون مسافات زائدة وبتهجئة واحدة) تحسب عند الحفظ للتصفية بالمساواة
+    NormalizedStatus = db.Column(db.Unicode(50), nullable=True)
     PurchaseDate = db.Column(db.DateTime, nullable=False)
     Lifespan = db.Column(db.Integer, nullable=False)
     Notes = db.Column(db.String, nullable=True)
@@ -102,6 +108,10 @@ class Experiments(db.Model):
 
 class Reservations(db.Model):
     __tablename__ = 'Reservations'
+    __table_args__ = (
+        db.Index('IX_Reservations_Lab_Date', 'LabId', 'Date', 'IsAllowed', 'StartTime'),
+        db.Index('IX_Reservations_Device_Date', 'DeviceId', 'Date'),
+    )
     
     Id = db.Column(db.Integer, primary_key=True)
     Date = db.Column(db.Date, nullable=False)
@@ -120,6 +130,9 @@ class Reservations(db.Model):
 
 class Maintenances(db.Model):
     __tablename__ = 'Maintenances'
+    __table_args__ = (
+        db.Index('IX_Maintenances_Device_Type_EndAt', 'DeviceId', 'Type', 'EndAt'),
+    )
     
     Id = db.Column(db.Integer, primary_key=True)
     Priority = db.Column(db.String, nullable=True)
@@ -141,6 +154,9 @@ class Maintenances(db.Model):
 
 class Alerts(db.Model):
     __tablename__ = 'Alerts'
+    __table_args__ = (
+        db.Index('IX_Alerts_ExpiresAt_Device', 'ExpiresAt', 'DeviceId'),
+    )
     
     Id = db.Column(db.Integer, primary_key=True)
     Type = db.Column(db.String, nullable=False)
@@ -171,6 +187,9 @@ class AlertRecipients(db.Model):
 
 class SpareParts(db.Model):
     __tablename__ = 'SpareParts'
+    __table_args__ = (
+        db.Index('IX_SpareParts_DeviceId', 'DeviceId'),
+    )
     
     PartId = db.Column(db.Integer, primary_key=True)
     PartName = db.Column(db.String(100), nullable=False)
@@ -189,6 +208,195 @@ class SpareParts(db.Model):
         return f'<SparePart {self.PartName}>'
 
 
+class SparePartMovements(db.Model):
+    """سجل حركات مخزون قطع الغيار (توريد، استهلاك، تعديل جرد) للإضافة فقط، والكمية موجبة للزيادة"""
+    __tablename__ = 'SparePartMovements'
+    __table_args__ = (
+        db.Index('IX_SparePartMovements_Part_CreatedAt', 'PartId', 'CreatedAt'),
+    )
+    
+    Id = db.Column(db.Integer, primary_key=True)
+    PartId = db.Column(db.Integer, db.ForeignKey('SpareParts.PartId'), nullable=False)
+    Kind = db.Column(db.Unicode(20), nullable=False)
+    Quantity = db.Column(db.Integer, nullable=False)
+    BalanceAfter = db.Column(db.Integer, nullable=False)
+    UserId = db.Column(db.Integer, db.ForeignKey('Users.Id'), nullable=True)
+    Notes = db.Column(db.Unicode, nullable=True)
+    CreatedAt = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    
+    def __repr__(self):
+        return f'<SparePartMovement {self.Kind} Part {self.PartId}>'
+
+
+class SparePartConsumptionStats(db.Model):
+    """
+    معدل استهلاك كل قطعة غيار من سجل الحركات، يحدث مع كل حركة استهلاك
+    
+    DecayedConsumed مجموع الكميات المستهلكة موزونة بتضاؤل أسي حسب قدمها حتى RateAt،
+    ومنه ومن FirstMovementAt يحسب المعدل اليومي عند القراءة.
+    """
+    __tablename__ = 'SparePartConsumptionStats'
+    
+    PartId = db.Column(db.Integer, db.ForeignKey('SpareParts.PartId'), primary_key=True)
+    DecayedConsumed = db.Column(db.Float, nullable=False, default=0.0)
+    RateAt = db.Column(db.DateTime, nullable=False)
+    FirstMovementAt = db.Column(db.DateTime, nullable=False)
+    TotalConsumed = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<SparePartConsumptionStats Part {self.PartId}>'
+
+
+class ReservationAttempts(db.Model):
+    """سجل محاولات الحجز المرفوضة (إضافة فقط)، منفصل عن جدول الحجوزات"""
+    __tablename__ = 'ReservationAttempts'
+    
+    Id = db.Column(db.Integer, primary_key=True)
+    UserId = db.Column(db.Integer, db.ForeignKey('Users.Id'), nullable=False)
+    LabId = db.Column(db.Integer, db.ForeignKey('Laboratories.LabId'), nullable=True)
+    ExperimentId = db.Column(db.Integer, db.ForeignKey('Experiments.ExperimentId'), nullable=True)
+    DeviceIds = db.Column(db.String(200), nullable=True)
+    Date = db.Column(db.Date, nullable=False)
+    StartTime = db.Column(db.Time, nullable=False)
+    EndTime = db.Column(db.Time, nullable=False)
+    Purpose = db.Column(db.Unicode, nullable=True)
+    Reason = db.Column(db.Unicode, nullable=True)
+    CreatedAt = db.Column(db.DateTime, nullable=False, default=datetime.now, index=True)
+    
+    def __repr__(self):
+        return f'<ReservationAttempt {self.Id}>'
+
+
+class ReservationAttemptDailyStats(db.Model):
+    """عدد المحاولات المرفوضة لكل (مستخدم، معمل، يوم) بعد ضغط السجل القديم"""
+    __tablename__ = 'ReservationAttemptDailyStats'
+    __table_args__ = (
+        db.UniqueConstraint('UserId', 'LabId', 'Date', name='UQ_ReservationAttemptDailyStats_User_Lab_Date'),
+    )
+    
+    Id = db.Column(db.Integer, primary_key=True)
+    UserId = db.Column(db.Integer, db.ForeignKey('Users.Id'), nullable=False)
+    LabId = db.Column(db.Integer, db.ForeignKey('Laboratories.LabId'), nullable=True)
+    Date = db.Column(db.Date, nullable=False)
+    AttemptCount = db.Column(db.Integer, nullable=False, default=0)
+    LastAttemptAt = db.Column(db.DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f'<ReservationAttemptDailyStats User {self.UserId} Lab {self.LabId} {self.Date}>'
+
+
+class MaintenanceSummaries(db.Model):
+    """آخر صيانة (تاريخ الانتهاء والتكلفة) وعدد الصيانات لكل (جهاز، نوع صيانة)، يحدث مع جدول الصيانات"""
+    __tablename__ = 'MaintenanceSummaries'
+    __table_args__ = (
+        db.UniqueConstraint('DeviceId', 'Type', name='UQ_MaintenanceSummaries_Device_Type'),
+    )
+    
+    Id = db.Column(db.Integer, primary_key=True)
+    DeviceId = db.Column(db.Integer, db.ForeignKey('Devices.Id'), nullable=False)
+    Type = db.Column(db.Unicode(100), nullable=False)
+    LastEndAt = db.Column(db.DateTime, nullable=True)
+    LastCost = db.Column(db.Numeric(10, 2), nullable=True)
+    MaintenanceCount = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<MaintenanceSummary Device {self.DeviceId} {self.Type}>'
+
+
+class CategoryMaintenanceSummaries(db.Model):
+    """آخر صيانة وعدد الصيانات لكل (فئة أجهزة، نوع صيانة)"""
+    __tablename__ = 'CategoryMaintenanceSummaries'
+    __table_args__ = (
+        db.UniqueConstraint('CategoryName', 'Type', name='UQ_CategoryMaintenanceSummaries_Category_Type'),
+    )
+    
+    Id = db.Column(db.Integer, primary_key=True)
+    CategoryName = db.Column(db.Unicode(200), nullable=False)
+    Type = db.Column(db.Unicode(100), nullable=False)
+    LastEndAt = db.Column(db.DateTime, nullable=True)
+    LastCost = db.Column(db.Numeric(10, 2), nullable=True)
+    MaintenanceCount = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<CategoryMaintenanceSummary {self.CategoryName} {self.Type}>'
+
+
+class SchemaMigrations(db.Model):
+    """إصدارات تعديلات المخطط المطبقة على قاعدة البيانات (انظر migrations.py)"""
+    __tablename__ = 'SchemaMigrations'
+    
+    Version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    Description = db.Column(db.Unicode(200), nullable=False)
+    AppliedAt = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    
+    def __repr__(self):
+        return f'<SchemaMigration {self.Version}>'
+
+
+class ReportSnapshots(db.Model):
+    """
+    آخر نسخة محسوبة مسبقاً من كل تقرير (JSON جاهز للإرسال) مع وقت حسابها
+    
+    LockedBy وLockedUntil حجز مؤقت يضمن أن عملية واحدة فقط من عمليات gunicorn تعيد حساب التقرير
+    (وصف alerts_generation بدون نسخة يستخدم نفس الحجز لإضافة تنبيهات الصيانة).
+    GeneratedAt وقت آخر حساب كامل، وUpdatedAt وقت آخر تعديل للنسخة (بعد دمج الصفوف المتغيرة).
+    """
+    __tablename__ = 'ReportSnapshots'
+    
+    Name = db.Column(db.Unicode(100), primary_key=True)
+    Payload = db.Column(db.LargeBinary, nullable=True)
+    StatusCode = db.Column(db.Integer, nullable=True)
+    GeneratedAt = db.Column(db.DateTime, nullable=True)
+    BuildSeconds = db.Column(db.Float, nullable=True)
+    UpdatedAt = db.Column(db.DateTime, nullable=True)
+    LockedBy = db.Column(db.Unicode(100), nullable=True)
+    LockedUntil = db.Column(db.DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f'<ReportSnapshot {self.Name} {self.GeneratedAt}>'
+
+
+class ReportChanges(db.Model):
+    """
+    الأجهزة وقطع الغيار التي تغيرت منذ آخر تحديث لكل تقرير محسوب مسبقاً
+    
+    تكتب في نفس معاملة التغيير، وتحذف بعد إعادة حساب صفوفها ودمجها في نسخة التقرير.
+    """
+    __tablename__ = 'ReportChanges'
+    __table_args__ = (
+        db.Index('IX_ReportChanges_Report_Id', 'Report', 'Id'),
+    )
+    
+    Id = db.Column(db.Integer, primary_key=True)
+    Report = db.Column(db.Unicode(100), nullable=False)
+    Kind = db.Column(db.Unicode(20), nullable=False)
+    EntityId = db.Column(db.Integer, nullable=False)
+    CreatedAt = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    
+    def __repr__(self):
+        return f'<ReportChange {self.Report} {self.Kind} {self.EntityId}>'
+
+
+class HourCounterBaselines(db.Model):
+    """
+    ساعات كل عداد استخدام غير المسجلة في جدول الحجوزات، تحفظ عند أول مطابقة للعداد
+    
+    reconcile_hours يقارن (العداد - Baseline) بمجموع الحجوزات بدلاً من العداد كاملاً، فلا تمسح
+    الساعات المدخلة يدوياً أو المستوردة أو السابقة للتطبيق. LastMaintenanceDate للأجهزة فقط: إذا
+    تغير تاريخ آخر صيانة بعد الحفظ (تصفير العداد من خارج التطبيق) يعاد حفظ القيمة.
+    """
+    __tablename__ = 'HourCounterBaselines'
+    
+    Kind = db.Column(db.Unicode(20), primary_key=True)
+    EntityId = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    Baseline = db.Column(db.Integer, nullable=False)
+    LastMaintenanceDate = db.Column(db.DateTime, nullable=True)
+    CapturedAt = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    
+    def __repr__(self):
+        return f'<HourCounterBaseline {self.Kind} {self.EntityId}>'
+
+
 # Association Tables
 class DeviceLabs(db.Model):
     __tablename__ = 'DeviceLabs'
@@ -200,6 +408,9 @@ class DeviceLabs(db.Model):
 
 class ExperimentDevices(db.Model):
     __tablename__ = 'ExperimentDevices'
+    __table_args__ = (
+        db.Index('IX_ExperimentDevices_Experiment_Device', 'ExperimentId', 'DeviceId'),
+    )
     
     Id = db.Column(db.Integer, primary_key=True)
     ExperimentId = db.Column(db.Integer, db.ForeignKey('Experiments.ExperimentId', ondelete='CASCADE'), nullable=False)
@@ -1,20 +1,18 @@
 from flask import jsonify
-from flask_restful import Resource
-from services import DevicesReplacementService
-
 from flask_restful import Resource
 from services import DeviceSuggestionService
 
 from flask_restful import Resource, reqparse
 from flask import jsonify, make_response, request
-from services import FutureNeedsService
+from services import FutureNeedsService, SparePartMovementService
+import csv
+import io
+import json
 
-from flask_restful import Resource
-from services import MaintenanceService
-from flask import request, jsonify
+from flask import request, jsonify, Response
 from flask_restful import Resource
 from datetime import datetime
-from services import MaintenancePredictionService
+from services import ReportSnapshotService
 from model import Devices, DeviceLabs, Laboratories
 
 
@@ -26,6 +24,8 @@ from flask_restful import Resource, request
 from services import ReservationService
 from model import Reservations
 
+from services import AvailabilityService, ReservationAttemptService, AlertService
+
 
 class ReservationResource(Resource):
     def put(self, reservation_id):
@@ -94,7 +94,7 @@ class ReservationListResource(Resource):
                     return {"success": False, "message": f"الحقل {field} مطلوب"}, 400
 
             # إنشاء الحجز
-            reservation_id, message = ReservationService.create_reservation(
+            reservation_id, message, attempt_id = ReservationService.create_reservation(
                 data['user_id'],
                 data['lab_id'],
                 data['experiment_id'],
@@ -105,28 +105,26 @@ class ReservationListResource(Resource):
                 data['purpose']
             )
 
-            if not reservation_id:
-                return {"success": False, "message": message}, 400
-
-            # التحقق من حالة الحجز
-            reservation = Reservations.query.get(reservation_id)
-            if reservation.IsAllowed:
+            if reservation_id:
                 return {
                     "success": True,
                     "message": "تم إنشاء الحجز بنجاح",
                     "reservation_id": reservation_id
                 }, 201
-            else:
-                # الحصول على اسم المعمل
-                lab = Laboratories.query.get(data['lab_id'])
-                lab_name = lab.LabName if lab else "غير معروف"
-                
-                return {
-                    "success": False,
-                    "message": f"{lab_name} محجوز بالفعل",
-                    "reservation_id": reservation_id,
-                    "status": "تم تسجيل محاولة الحجز"
-                }, 400
+
+            if not attempt_id:
+                return {"success": False, "message": message}, 400
+
+            # الحجز مرفوض بسبب التعارض وتم تسجيله في سجل المحاولات
+            lab = Laboratories.query.get(data['lab_id'])
+            lab_name = lab.LabName if lab else "غير معروف"
+
+            return {
+                "success": False,
+                "message": f"{lab_name} محجوز بالفعل",
+                "attempt_id": attempt_id,
+                "status": "تم تسجيل محاولة الحجز"
+            }, 400
 
         except Exception as e:
             return {
@@ -135,22 +133,185 @@ class ReservationListResource(Resource):
             }, 500 
 
 
+class ReservationBulkResource(Resource):
+    def post(self):
+        try:
+            data = request.get_json()
+            
+            # يقبل مصفوفة حجوزات مباشرة أو كائن يحتوي على الحقل reservations
+            bookings = data.get('reservations') if isinstance(data, dict) else data
+            if not isinstance(bookings, list) or not bookings:
+                return {"success": False, "message": "يجب إرسال قائمة بالحجوزات"}, 400
+
+            success, results = ReservationService.create_reservations_bulk(bookings)
+            if not success:
+                return {"success": False, "message": results}, 500
+
+            created_count = sum(1 for item in results if item["success"])
+            return {
+                "success": created_count == len(results),
+                "message": f"تم إنشاء {created_count} من أصل {len(results)} حجز",
+                "created_count": created_count,
+                "failed_count": len(results) - created_count,
+                "results": results
+            }, 201 if created_count else 400
+
+        except Exception as e:
+            return {
+                "success": False,
+                "message": f"حدث خطأ أثناء إنشاء الحجوزات: {str(e)}"
+            }, 500 
+
+
+class ReservationRecurringResource(Resource):
+    def post(self):
+        try:
+            data = request.get_json()
+            
+            # التحقق من البيانات المطلوبة
+            required_fields = [
+                'user_id', 'lab_id', 'experiment_id', 'device_ids', 'start_date',
+                'occurrences', 'start_time', 'end_time', 'purpose'
+            ]
+            for field in required_fields:
+                if field not in data:
+                    return {"success": False, "message": f"الحقل {field} مطلوب"}, 400
+
+            # إنشاء سلسلة الحجوزات
+            success, results = ReservationService.create_recurring_reservations(
+                data['user_id'],
+                data['lab_id'],
+                data['experiment_id'],
+                data['device_ids'],
+                data['start_date'],
+                data['occurrences'],
+                data['start_time'],
+                data['end_time'],
+                data['purpose'],
+                weekday=data.get('weekday'),
+                interval_weeks=data.get('interval_weeks', 1)
+            )
+
+            if not success:
+                return {"success": False, "message": results}, 400
+
+            created_count = sum(1 for item in results if item["success"])
+            return {
+                "success": created_count == len(results),
+                "message": f"تم إنشاء {created_count} من أصل {len(results)} حجز في السلسلة",
+                "created_count": created_count,
+                "conflict_count": len(results) - created_count,
+                "occurrences": results
+            }, 201 if created_count else 400
+
+        except Exception as e:
+            return {
+                "success": False,
+                "message": f"حدث خطأ أثناء إنشاء سلسلة الحجوزات: {str(e)}"
+            }, 500 
+
+
+class ReservationAttemptsResource(Resource):
+    def get(self):
+        """
+        عدد محاولات الحجز المرفوضة لكل (مستخدم، معمل، يوم)
+        
+        المعلمات: from، to (YYYY-MM-DD)، lab_id، user_id
+        """
+        success, result = ReservationAttemptService.get_daily_counts(
+            from_str=request.args.get('from'),
+            to_str=request.args.get('to'),
+            lab_id=request.args.get('lab_id', type=int),
+            user_id=request.args.get('user_id', type=int)
+        )
+        if not success:
+            return {"success": False, "message": result}, 400
+
+        return {"success": True, "attempts": result}, 200
+
+
+class LabFreeSlotsResource(Resource):
+    def get(self, lab_id):
+        """
+        الفترات الحرة للمعمل
+        
+        المعلمات: from، to (YYYY-MM-DD)، min_minutes، day_start، day_end (HH:MM)
+        """
+        return free_slots_response("lab", lab_id)
+
+
+class DeviceFreeSlotsResource(Resource):
+    def get(self, device_id):
+        """
+        الفترات الحرة للجهاز
+        
+        المعلمات: from، to (YYYY-MM-DD)، min_minutes، day_start، day_end (HH:MM)
+        """
+        return free_slots_response("device", device_id)
+
+
+def free_slots_response(resource_type, resource_id):
+    success, result = AvailabilityService.get_free_slots(
+        resource_type,
+        resource_id,
+        from_str=request.args.get('from'),
+        to_str=request.args.get('to'),
+        min_minutes=request.args.get('min_minutes', 0),
+        day_start_str=request.args.get('day_start'),
+        day_end_str=request.args.get('day_end')
+    )
+    if not success:
+        return {"success": False, "message": result}, 404 if "غير موجود" in result else 400
+
+    return {"success": True, **result}, 200
+
+
+class AlertsResource(Resource):
+    def get(self):
+        """
+        تنبيهات الصيانة الحالية الأحدث أولاً
+        
+        المعلمات: user_id، device_id، since (YYYY-MM-DD أو YYYY-MM-DDTHH:MM:SS)، include_expired (1 أو true)
+        """
+        success, result = AlertService.get_alerts(
+            user_id=request.args.get('user_id', type=int),
+            device_id=request.args.get('device_id', type=int),
+            since_str=request.args.get('since'),
+            include_expired=request.args.get('include_expired', '').lower() in ('1', 'true')
+        )
+        if not success:
+            return {"success": False, "message": result}, 400
+
+        return {"success": True, "alerts": result}, 200
+
+
+def snapshot_response(name):
+    """
+    رد التقرير من النسخة المحسوبة مسبقاً، و?fresh=1 يتجاوزها ويحسب التقرير الآن
+    """
+    fresh = request.args.get('fresh', '').lower() in ('1', 'true')
+    payload, status_code, generated_at, updated_at = ReportSnapshotService.serve(name, fresh=fresh)
+    return Response(payload, status=status_code, content_type='application/json; charset=utf-8', headers={
+        'X-Report-Generated-At': generated_at.isoformat(timespec='seconds'),
+        'X-Report-Updated-At': updated_at.isoformat(timespec='seconds')
+    })
+
+
 class DeviceMaintenancePredictionResource(Resource):
     def get(self):
         """
         الحصول على قائمة بالأجهزة المتاحة التي تحتاج إلى صيانة متوقعة
         ---
+        parameters:
+          - name: fresh
+            in: query
+            description: 1 لحساب التوقعات الآن بدلاً من النسخة المحسوبة مسبقاً
         responses:
           200:
             description: قائمة بتوقعات الصيانة للأجهزة المتاحة
         """
         try:
-            maintenance_predictions = MaintenancePredictionService.predict_device_maintenance()
-            return jsonify({
-                "status": "success",
-                "data": maintenance_predictions,
-                "message": "تم استرجاع توقعات الصيانة بنجاح"
-            })
+            return snapshot_response(ReportSnapshotService.MAINTENANCE_PREDICTION)
         except Exception as e:
             return jsonify({
                 "status": "error",
@@ -161,19 +322,7 @@ class DeviceMaintenancePredictionResource(Resource):
 class MaintenanceNeededResource(Resource):
     def get(self):
         try:
-            success, result = MaintenanceService.get_devices_needing_maintenance()
-            
-            if not success:
-                return {
-                    "success": False,
-                    "message": result
-                }, 500
-
-            return {
-                "success": True,
-                "message": "تم جلب بيانات الأجهزة وأولويات الصيانة بنجاح",
-                "devices": result
-            }, 200
+            return snapshot_response(ReportSnapshotService.MAINTENANCE_NEEDED)
 
         except Exception as e:
             return {
@@ -182,27 +331,118 @@ class MaintenanceNeededResource(Resource):
             }, 500 
 
 
+def filter_values(name):
+    """قيم معلمة التصفية المفصولة بفواصل (أو الفاصلة العربية)، أو None إذا لم ترسل"""
+    value = request.args.get(name)
+    if not value:
+        return None
+    return [item.strip() for item in value.replace('،', ',').split(',') if item.strip()]
+
+
+# أعمدة ملف CSV لقائمة قطع الغيار بنفس أسماء حقول JSON
+NEEDS_CSV_COLUMNS = [
+    "id", "name", "priority", "reason", "days_to_action", "current_quantity", "minimum_quantity",
+    "suggested_quantity", "unit", "cost", "total_cost_estimation", "consumption_rate", "stock_percentage",
+    "device_id", "device_name", "lab_id", "expiry_date"
+]
+# عدد الصفوف التي تكتب معاً في كل جزء من الرد المتدفق
+STREAM_CHUNK_ROWS = 500
+
+
+def stream_needs_response(output_format, summary, parts):
+    """
+    رد متدفق بقائمة قطع الغيار يكتب أثناء المرور على القطع بدون بناء الملف كاملاً في الذاكرة
+    
+    ndjson: السطر الأول {"summary": ...} ثم قطعة في كل سطر.
+    csv: UTF-8 مع BOM ليفتح في Excel بالعربية، والملخص في ترويسات X-Summary-*.
+    """
+    def ndjson_rows():
+        yield json.dumps({"summary": summary}, ensure_ascii=False) + "\n"
+        chunk = []
+        for part in parts:
+            chunk.append(json.dumps(part, ensure_ascii=False))
+            if len(chunk) == STREAM_CHUNK_ROWS:
+                yield "\n".join(chunk) + "\n"
+                chunk = []
+        if chunk:
+            yield "\n".join(chunk) + "\n"
+
+    def csv_rows():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=NEEDS_CSV_COLUMNS, extrasaction='ignore')
+        buffer.write("\ufeff")
+        writer.writeheader()
+        for count, part in enumerate(parts, 1):
+            writer.writerow(part)
+            if count % STREAM_CHUNK_ROWS == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    if output_format == 'ndjson':
+        return Response(
+            (chunk.encode('utf-8') for chunk in ndjson_rows()),
+            content_type='application/x-ndjson; charset=utf-8'
+        )
+    return Response(
+        (chunk.encode('utf-8') for chunk in csv_rows()),
+        content_type='text/csv; charset=utf-8',
+        headers={
+            'Content-Disposition': 'attachment; filename=future-spare-parts-needs.csv',
+            'X-Summary-Total-Parts-Needed': str(summary["total_parts_needed"]),
+            'X-Summary-High-Priority-Count': str(summary["high_priority_count"]),
+            'X-Summary-Total-Estimated-Cost': str(summary["total_estimated_cost"]),
+            'X-Summary-Date-Generated': summary["date_generated"]
+        }
+    )
+
+
 class FutureNeedsResource(Resource):
     """واجهة API للاحتياجات المستقبلية من قطع الغيار"""
     
+    FORMATS = ('json', 'csv', 'ndjson')
+    
     def get(self):
         """
         الحصول على قائمة قطع الغيار المطلوب شراؤها مستقبلاً
         
-        يمكن تصفية النتائج باستخدام المعلمات التالية:
+        يمكن تصفية النتائج باستخدام المعلمات التالية، وكل معلمة تقبل أكثر من قيمة مفصولة بفواصل:
         - priority: الأولوية (عالية، متوسطة، منخفضة)
         - reason: سبب الاحتياج (منخفض المخزون، قرب انتهاء الصلاحية، معدل استهلاك عالي، مطلوبة للصيانة القادمة)
+        - lab_id: رقم المعمل
+        
+        و format=csv أو format=ndjson لتنزيل القائمة كرد متدفق (انظر stream_needs_response)
         """
         # استخدام args بدلاً من RequestParser
-        priority = request.args.get('priority')
-        reason = request.args.get('reason')
+        priorities = filter_values('priority')
+        reasons = filter_values('reason')
+        lab_ids = filter_values('lab_id')
+        output_format = request.args.get('format', 'json').lower()
         
-        # إذا تم تحديد معلمة الأولوية
-        if priority:
-            if priority not in ["عالية", "متوسطة", "منخفضة"]:
-                return {'status': 'error', 'message': "الأولوية غير صالحة"}, 400
-            
-            result = FutureNeedsService.get_parts_by_priority(priority)
+        if output_format not in self.FORMATS:
+            return {'status': 'error', 'message': f"صيغة غير مدعومة، الصيغ المتاحة: {', '.join(self.FORMATS)}"}, 400
+        if lab_ids is not None:
+            try:
+                lab_ids = [int(lab_id) for lab_id in lab_ids]
+            except ValueError:
+                return {'status': 'error', 'message': "رقم المعمل غير صالح"}, 400
+        
+        if output_format != 'json':
+            try:
+                summary, parts = FutureNeedsService.stream_filtered_needs(priorities, reasons, lab_ids)
+            except Exception as e:
+                return {'status': 'error', 'message': f"حدث خطأ أثناء استرجاع احتياجات قطع الغيار: {str(e)}"}, 500
+            if parts is None:
+                return {'status': 'error', 'message': summary['error']}, 400
+            return stream_needs_response(output_format, summary, parts)
+        
+        if priorities is not None or reasons is not None or lab_ids is not None:
+            try:
+                # التصفية من التقرير المجمع في الذاكرة بدون إعادة حسابه
+                result = FutureNeedsService.get_filtered_needs(priorities, reasons, lab_ids)
+            except Exception as e:
+                return {'status': 'error', 'message': f"حدث خطأ أثناء استرجاع احتياجات قطع الغيار: {str(e)}"}, 500
             if 'error' in result:
                 return {'status': 'error', 'message': result['error']}, 400
             
@@ -210,25 +450,48 @@ class FutureNeedsResource(Resource):
             response.headers['Content-Type'] = 'application/json; charset=utf-8'
             return response
         
-        # إذا تم تحديد معلمة السبب
-        if reason:
-            valid_reasons = ["منخفض المخزون", "قرب انتهاء الصلاحية", "معدل استهلاك عالي", "مطلوبة للصيانة القادمة"]
-            if reason not in valid_reasons:
-                return {'status': 'error', 'message': "السبب غير صالح"}, 400
+        # بدون تصفية، استرجاع كل الاحتياجات من النسخة المحسوبة مسبقاً
+        return snapshot_response(ReportSnapshotService.FUTURE_NEEDS)
+
+
+class SparePartMovementsResource(Resource):
+    """سجل حركات مخزون قطعة الغيار"""
+    
+    def get(self, part_id):
+        """آخر حركات القطعة (limit، افتراضياً 50) مع معدل استهلاكها الحالي"""
+        limit = request.args.get('limit', 50, type=int)
+        if limit <= 0:
+            return {"success": False, "message": "عدد الحركات يجب أن يكون أكبر من صفر"}, 400
+        
+        success, result = SparePartMovementService.get_movements(part_id, limit)
+        if not success:
+            return {"success": False, "message": result}, 404
+        
+        return {"success": True, **result}, 200
+    
+    def post(self, part_id):
+        """
+        تسجيل حركة مخزون
+        
+        الحقول: kind (restock أو consume أو adjust)، quantity، user_id و notes اختياريان
+        """
+        try:
+            data = request.get_json()
+            for field in ('kind', 'quantity'):
+                if field not in data:
+                    return {"success": False, "message": f"الحقل {field} مطلوب"}, 400
             
-            result = FutureNeedsService.get_parts_by_reason(reason)
-            if 'error' in result:
-                return {'status': 'error', 'message': result['error']}, 400
+            success, result = SparePartMovementService.record_movement(
+                part_id, data['kind'], data['quantity'], data.get('user_id'), data.get('notes')
+            )
+            if not success:
+                return {"success": False, "message": result}, 404 if result == "قطعة الغيار غير موجودة" else 400
             
-            response = make_response(jsonify(result))
-            response.headers['Content-Type'] = 'application/json; charset=utf-8'
-            return response
+            return {"success": True, "message": "تم تسجيل الحركة بنجاح", "movement": result}, 201
         
-        # بدون تصفية، استرجاع كل الاحتياجات
-        result = FutureNeedsService.get_future_spare_parts_needs()
-        response = make_response(jsonify(result))
-        response.headers['Content-Type'] = 'application/json; charset=utf-8'
-        return response
+        except Exception as e:
+            return {"success": False, "message": f"حدث خطأ أثناء تسجيل حركة المخزون: {str(e)}"}, 500
+
 
 class SuggestDeviceResource(Resource):
     def get(self, device_id):
@@ -246,18 +509,16 @@ class DevicesReplacementResource(Resource):
         """
         الحصول على قائمة بالأجهزة التي تحتاج إلى استبدال
         ---
+        parameters:
+          - name: fresh
+            in: query
+            description: 1 لحساب القائمة الآن بدلاً من النسخة المحسوبة مسبقاً
         responses:
           200:
             description: قائمة بالأجهزة التي تحتاج إلى استبدال مع تحليل لكل جهاز
         """
         try:
-            devices_for_replacement = DevicesReplacementService.get_devices_for_replacement()
-            
-            return jsonify({
-                "status": "نجاح",
-                "data": devices_for_replacement,
-                "message": "تم استرجاع قائمة الأجهزة التي تحتاج إلى استبدال بنجاح"
-            })
+            return snapshot_response(ReportSnapshotService.DEVICES_REPLACEMENT)
         except Exception as e:
             return jsonify({
                 "status": "فشل",
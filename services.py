@@ -1,414 +1,507 @@
 from datetime import datetime, timedelta, date
+from collections import namedtuple
 from model import Users, Laboratories, Experiments, Reservations, Devices, ExperimentDevices, Maintenances, SpareParts
-from sqlalchemy import and_, func, not_, or_, select
+from model import Alerts, AlertRecipients, DeviceLabs, SparePartMovements, SparePartConsumptionStats
+from model import ReservationAttempts, ReservationAttemptDailyStats, MaintenanceSummaries, CategoryMaintenanceSummaries, ReportSnapshots, ReportChanges
+from model import HourCounterBaselines
+from sqlalchemy import and_, case, delete, event, func, insert, inspect, not_, or_, select, update
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from flask import current_app, has_app_context
 from extensions import db
+import bisect
 import difflib  
+import heapq
+import json
 import logging
+import math
+import numpy as np
+import os
+import random
+import socket
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
 
-class ReservationService:
+_IndexEntry = namedtuple('_IndexEntry', ['start', 'end', 'reservation_id', 'user_type'])
+
+
+class ReservationIndex:
+    """
+    فهرس زمني في الذاكرة للحجوزات المسموحة، مقسم حسب (المعمل، اليوم) و(الجهاز، اليوم)
+    
+    كل مفتاح يحمل مصفوفة مرتبة حسب وقت البداية، فيتم البحث عن التداخل بالتنصيف
+    بدلاً من استعلام قاعدة البيانات. يتم تحميل الفهرس من جدول Reservations عند أول
+    استخدام (ومن ثم بعد كل إعادة تشغيل) ويتم تحديثه عند الإنشاء والتحديث والرفض.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._warm = False
+        self._since = None
+        self._labs = {}
+        self._devices = {}
+        self._entries = {}
+
     @staticmethod
-    def validate_user_type(user_id):
-        user = Users.query.get(user_id)
-        if not user:
-            return False, "المستخدم غير موجود"
-        
-        if user.UserType not in ["دكتور", "باحث"]:
-            return False, "نوع المستخدم غير مصرح له بالحجز"
-            
-        return True, user
+    def _load_rows(since):
+        return db.session.query(
+            Reservations.Id,
+            Reservations.LabId,
+            Reservations.DeviceId,
+            Reservations.Date,
+            Reservations.StartTime,
+            Reservations.EndTime,
+            Users.UserType
+        ).join(Users, Users.Id == Reservations.UserId).filter(
+            Reservations.IsAllowed == True,
+            Reservations.Date >= since
+        ).all()
 
     @staticmethod
-    def validate_lab_availability(lab_id, user_type, date_str, start_time_str, end_time_str, exclude_reservation_id=None):
-        lab = Laboratories.query.get(lab_id)
-        if not lab:
-            return False, "المعمل غير موجود"
-            
-        if lab.Status != "متاح":
-            return False, "المعمل غير متاح حالياً"
-            
-        # التحقق من نوع المعمل
-        if user_type == "دكتور" and lab.Type != "أكاديمي":
-            return False, "هذا المعمل مخصص للأبحاث فقط"
-        elif user_type == "باحث" and lab.Type != "بحثي":
-            return False, "هذا المعمل مخصص للتدريس فقط"
+    def _insert(buckets, key, entry):
+        if key[0] is None:
+            return
+        bisect.insort(buckets.setdefault(key, []), entry)
 
-        # التحقق من صحة التاريخ والوقت
-        try:
-            reservation_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-            start_time = datetime.strptime(start_time_str, "%H:%M").time()
-            end_time = datetime.strptime(end_time_str, "%H:%M").time()
-            
-            # التحقق من أن التاريخ في المستقبل
-            if reservation_date < date.today():
-                return False, "لا يمكن الحجز في تاريخ سابق"
-                
-            # التحقق من أن وقت البداية قبل وقت النهاية
-            start_datetime = datetime.combine(reservation_date, start_time)
-            end_datetime = datetime.combine(reservation_date, end_time)
-            
-            if start_datetime >= end_datetime:
-                return False, "وقت البداية يجب أن يكون قبل وقت النهاية"
-        except ValueError:
-            return False, "صيغة التاريخ أو الوقت غير صحيحة"
+    @staticmethod
+    def _delete(buckets, key, entry):
+        bucket = buckets.get(key)
+        if not bucket:
+            return
+        position = bisect.bisect_left(bucket, entry)
+        if position < len(bucket) and bucket[position] == entry:
+            del bucket[position]
+        if not bucket:
+            del buckets[key]
 
-        # التحقق من الحجوزات الموجودة
-        existing_reservations = Reservations.query.filter(
-            Reservations.LabId == lab_id,
-            Reservations.Date == reservation_date,
-            Reservations.IsAllowed == True
-        )
-        
-        # استثناء الحجز الحالي عند التحديث
-        if exclude_reservation_id:
-            existing_reservations = existing_reservations.filter(
-                Reservations.Id != exclude_reservation_id
-            )
+    def rebuild(self, since=None):
+        """إعادة بناء الفهرس بالكامل من جدول الحجوزات (الحجوزات من اليوم فصاعداً)"""
+        since = since or date.today()
+        labs, devices, entries = {}, {}, {}
+        for row in self._load_rows(since):
+            entry = _IndexEntry(row.StartTime, row.EndTime, row.Id, row.UserType)
+            entries[row.Id] = (row.LabId, row.DeviceId, row.Date, entry)
+            self._insert(labs, (row.LabId, row.Date), entry)
+            self._insert(devices, (row.DeviceId, row.Date), entry)
 
-        existing_reservations = existing_reservations.join(Users).all()
+        with self._lock:
+            self._labs, self._devices, self._entries = labs, devices, entries
+            self._since = since
+            self._warm = True
+        logger.info(f"تم بناء فهرس الحجوزات: {len(entries)} حجز منذ {since}")
 
-        for reservation in existing_reservations:
-            res_start = datetime.combine(reservation_date, reservation.StartTime)
-            res_end = datetime.combine(reservation_date, reservation.EndTime)
-            
-            # التحقق من التداخل الزمني
-            if (start_datetime < res_end and end_datetime > res_start):
-                # إذا كان هناك دكتور حاجز المعمل
-                if reservation.user.UserType == "دكتور":
-                    return False, "المعمل محجوز من قبل دكتور في هذا الوقت"
-                # إذا كان المستخدم الحالي دكتور وهناك باحث حاجز
-                elif user_type == "دكتور" and reservation.user.UserType == "باحث":
-                    return False, "المعمل محجوز من قبل باحث في هذا الوقت"
+    def ensure_warm(self):
+        with self._lock:
+            if self._warm and self._since == date.today():
+                return
+        # إعادة البناء عند أول استخدام أو عند بداية يوم جديد للتخلص من الأيام المنقضية
+        self.rebuild()
 
-        return True, lab
+    def invalidate(self):
+        with self._lock:
+            self._warm = False
 
-    @staticmethod
-    def validate_experiment(experiment_id, lab_id, user_type):
-        experiment = Experiments.query.get(experiment_id)
-        if not experiment:
-            return False, "التجربة غير موجودة"
-            
-        if experiment.LabId != lab_id:
-            return False, "التجربة غير متوفرة في هذا المعمل"
-            
-        if user_type == "دكتور" and experiment.Type != "أكاديمية":
-            return False, "هذه التجربة مخصصة للأبحاث فقط"
-        elif user_type == "باحث" and experiment.Type != "بحثية":
-            return False, "هذه التجربة مخصصة للتدريس فقط"
-            
-        return True, experiment
+    def remove(self, reservation_id):
+        with self._lock:
+            stored = self._entries.pop(reservation_id, None)
+            if not stored:
+                return
+            lab_id, device_id, reservation_date, entry = stored
+            self._delete(self._labs, (lab_id, reservation_date), entry)
+            self._delete(self._devices, (device_id, reservation_date), entry)
+
+    def sync(self, reservation, user_type):
+        """مزامنة حجز واحد مع الفهرس بعد حفظه: يضاف إذا كان مسموحاً ويحذف إذا رُفض"""
+        with self._lock:
+            if not self._warm:
+                # سيتم تحميله من قاعدة البيانات عند أول استخدام
+                return
+            self.remove(reservation.Id)
+            if not reservation.IsAllowed or reservation.Date < self._since:
+                return
+            entry = _IndexEntry(reservation.StartTime, reservation.EndTime, reservation.Id, user_type)
+            self._entries[reservation.Id] = (reservation.LabId, reservation.DeviceId, reservation.Date, entry)
+            self._insert(self._labs, (reservation.LabId, reservation.Date), entry)
+            self._insert(self._devices, (reservation.DeviceId, reservation.Date), entry)
 
     @staticmethod
-    def validate_devices(device_ids, experiment_id, date_str, start_time_str, end_time_str, exclude_reservation_id=None):
-        try:
-            # التحقق من صحة التاريخ والوقت
-            reservation_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-            start_time = datetime.strptime(start_time_str, "%H:%M").time()
-            end_time = datetime.strptime(end_time_str, "%H:%M").time()
-            
-            # التحقق من أن التاريخ في المستقبل
-            if reservation_date < date.today():
-                return False, "لا يمكن الحجز في تاريخ سابق"
-                
-            # التحقق من أن وقت البداية قبل وقت النهاية
-            start_datetime = datetime.combine(reservation_date, start_time)
-            end_datetime = datetime.combine(reservation_date, end_time)
-            
-            if start_datetime >= end_datetime:
-                return False, "وقت البداية يجب أن يكون قبل وقت النهاية"
-            
-            valid_devices = []
-            for device_id in device_ids:
-                device = Devices.query.get(device_id)
-                if not device:
-                    return False, f"الجهاز رقم {device_id} غير موجود"
-                    
-                # التحقق من أن الجهاز تابع للتجربة من خلال جدول ExperimentDevices
-                experiment_device = ExperimentDevices.query.filter_by(
-                    ExperimentId=experiment_id,
-                    DeviceId=device_id
-                ).first()
-                
-                if not experiment_device:
-                    return False, f"الجهاز رقم {device_id} غير مرتبط بهذه التجربة"
-                    
-                if device.Status != "متاح":
-                    return False, f"الجهاز {device.Name} غير متاح حالياً. الحالة: {device.Status}"
-                
-                # البحث عن الحجوزات المتداخلة بطريقة أكثر شمولية
-                overlapping_reservations = db.session.query(Reservations).filter(
-                    Reservations.DeviceId == device_id,
-                    Reservations.Date == reservation_date,
-                    Reservations.IsAllowed == True,
-                    or_(
-                        and_(
-                            Reservations.StartTime <= start_time,
-                            Reservations.EndTime > start_time
-                        ),
-                        and_(
-                            Reservations.StartTime < end_time,
-                            Reservations.EndTime >= end_time
-                        ),
-                        and_(
-                            Reservations.StartTime >= start_time,
-                            Reservations.EndTime <= end_time
-                        )
-                    )
+    def _overlapping(bucket, start_time, end_time, exclude_reservation_id):
+        # كل الحجوزات التي تبدأ قبل نهاية الفترة المطلوبة، ثم نتحقق من نهايتها
+        limit = bisect.bisect_left(bucket, (end_time,))
+        return [
+            entry for entry in bucket[:limit]
+            if entry.end > start_time and entry.reservation_id != exclude_reservation_id
+        ]
+
+    def find_lab_overlaps(self, lab_id, reservation_date, start_time, end_time, exclude_reservation_id=None):
+        self.ensure_warm()
+        with self._lock:
+            bucket = self._labs.get((lab_id, reservation_date), [])
+            return self._overlapping(bucket, start_time, end_time, exclude_reservation_id)
+
+    def find_reserved_devices(self, device_ids, reservation_date, start_time, end_time, exclude_reservation_id=None):
+        self.ensure_warm()
+        with self._lock:
+            return {
+                device_id for device_id in set(device_ids)
+                if self._overlapping(
+                    self._devices.get((device_id, reservation_date), []),
+                    start_time, end_time, exclude_reservation_id
                 )
-                
-                # استثناء الحجز الحالي في حالة التحديث
-                if exclude_reservation_id:
-                    overlapping_reservations = overlapping_reservations.filter(
-                        Reservations.Id != exclude_reservation_id
-                    )
-                
-                overlapping_count = overlapping_reservations.count()
-                
-                if overlapping_count > 0:
-                    return False, f"الجهاز {device.Name} محجوز بالفعل في هذا الوقت"
-                
-                # التحقق من وجود صيانة متداخلة للجهاز
-                try:
-                    overlapping_maintenance = db.session.query(Maintenances).filter(
-                        Maintenances.DeviceId == device_id,
-                        or_(
-                            and_(
-                                Maintenances.StartAt <= datetime.combine(reservation_date, datetime.min.time()),
-                                Maintenances.EndAt >= datetime.combine(reservation_date, datetime.min.time())
-                            )
-                        ),
-                        Maintenances.Status != "مكتملة"
-                    ).count()
-                    
-                    if overlapping_maintenance > 0:
-                        return False, f"الجهاز {device.Name} في الصيانة في هذا التاريخ"
-                except Exception as e:
-                    logger.warning(f"خطأ أثناء التحقق من جدول الصيانة: {str(e)}")
-                    # استمر في التنفيذ حتى لو لم يتم العثور على جدول الصيانة
-                    pass
-                    
-                valid_devices.append(device)
-                
-            return True, valid_devices
-            
-        except Exception as e:
-            logger.error(f"خطأ أثناء التحقق من توفر الأجهزة: {str(e)}")
-            return False, f"حدث خطأ أثناء التحقق من توفر الأجهزة: {str(e)}"
+            }
 
-    @staticmethod
-    def calculate_hours(start_time_str, end_time_str, date_str):
-        start_time = datetime.strptime(start_time_str, "%H:%M").time()
-        end_time = datetime.strptime(end_time_str, "%H:%M").time()
-        date = datetime.strptime(date_str, "%Y-%m-%d").date()
-        
-        start_datetime = datetime.combine(date, start_time)
-        end_datetime = datetime.combine(date, end_time)
-        return (end_datetime - start_datetime).total_seconds() / 3600
+    def check_consistency(self, repair=False):
+        """مقارنة محتوى الفهرس مع جدول الحجوزات وإعادة البناء عند الطلب إذا وجد اختلاف"""
+        self.ensure_warm()
+        with self._lock:
+            since = self._since
+            actual = dict(self._entries)
 
-    @staticmethod
-    def deduct_reservation_hours(reservation):
-        """تقليل ساعات الحجز القديم"""
-        hours = ReservationService.calculate_hours(
-            reservation.StartTime.strftime("%H:%M"),
-            reservation.EndTime.strftime("%H:%M"),
-            reservation.Date.strftime("%Y-%m-%d")
+        expected = {
+            row.Id: (row.LabId, row.DeviceId, row.Date,
+                     _IndexEntry(row.StartTime, row.EndTime, row.Id, row.UserType))
+            for row in self._load_rows(since)
+        }
+
+        missing = sorted(expected.keys() - actual.keys())
+        stale = sorted(actual.keys() - expected.keys())
+        mismatched = sorted(
+            reservation_id for reservation_id in expected.keys() & actual.keys()
+            if expected[reservation_id] != actual[reservation_id]
         )
-        
-        # تقليل ساعات المعمل
-        lab = Laboratories.query.get(reservation.LabId)
-        lab.UsageHours -= hours
-        lab.TotalOperatingHours -= hours
-        
-        # تقليل ساعات الأجهزة
-        devices = Devices.query.join(Reservations).filter(
-            Reservations.Id == reservation.Id
-        ).all()
-        
-        for device in devices:
-            device.CurrentHour -= hours
-            device.TotalOperatingHours -= hours
-            
-        # تقليل عدد مرات إجراء التجربة
-        experiment = Experiments.query.get(reservation.ExperimentId)
-        experiment.CompletedCount -= 1
-        
-        db.session.commit()
+        consistent = not (missing or stale or mismatched)
+
+        if not consistent:
+            logger.warning(
+                f"فهرس الحجوزات غير متطابق مع الجدول: مفقود {len(missing)}، زائد {len(stale)}، مختلف {len(mismatched)}"
+            )
+            if repair:
+                self.rebuild(since)
+
+        return {
+            "consistent": consistent,
+            "since": since.strftime("%Y-%m-%d"),
+            "indexed_count": len(actual),
+            "table_count": len(expected),
+            "missing": missing,
+            "stale": stale,
+            "mismatched": mismatched
+        }
+
+
+reservation_index = ReservationIndex()
+
+
+class DeviceUsageRates:
+    """
+    معدل الاستخدام اليومي الفعلي لكل جهاز من الحجوزات المسموحة في آخر عدة أسابيع
+    
+    المعدل متوسط موزون أسياً لساعات كل أسبوع (الأسبوع الأحدث وزنه 1 ثم يتناقص بمعامل
+    التضاؤل) مقسوماً على 7. يتم تحميله باستعلام تجميعي واحد عند أول استخدام وعند بداية
+    كل يوم، ويحدث تدريجياً عند إنشاء الحجوزات وتحديثها، فلا تعيد التوقعات قراءة السجل.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._warm = False
+        self._since = None
+        self._today = None
+        self._daily = {}
+        self._rates = {}
 
     @staticmethod
-    def add_reservation_hours(reservation, devices, lab, experiment, hours):
-        """إضافة ساعات الحجز الجديد"""
-        # إضافة ساعات المعمل
-        lab.UsageHours += hours
-        lab.TotalOperatingHours += hours
-        
-        # إضافة ساعات الأجهزة
-        for device in devices:
-            device.CurrentHour += hours
-            device.TotalOperatingHours += hours
-            
-        # زيادة عدد مرات إجراء التجربة
-        experiment.CompletedCount += 1
-        
-        db.session.commit()
+    def _settings():
+        weeks = max(1, current_app.config.get('USAGE_RATE_WEEKS', 8))
+        decay = current_app.config.get('USAGE_RATE_DECAY', 0.7)
+        return weeks, decay
+
+    def _rate(self, daily_hours, weeks, decay):
+        weekly = [0.0] * weeks
+        for reservation_date, hours in daily_hours.items():
+            weekly[(self._today - reservation_date).days // 7] += hours
+        weights = [decay ** week for week in range(weeks)]
+        return sum(w * h for w, h in zip(weights, weekly)) / sum(weights) / 7
+
+    def rebuild(self):
+        """إعادة تحميل ساعات الحجوزات اليومية لكل جهاز في نافذة المعدل وحساب المعدلات"""
+        weeks, decay = self._settings()
+        today = date.today()
+        since = today - timedelta(days=weeks * 7 - 1)
+
+        # التجميع حسب الفترة الزمنية لأن طرح الأوقات يختلف بين قواعد البيانات
+        rows = db.session.query(
+            Reservations.DeviceId,
+            Reservations.Date,
+            Reservations.StartTime,
+            Reservations.EndTime,
+            func.count(Reservations.Id)
+        ).filter(
+            Reservations.IsAllowed == True,
+            Reservations.DeviceId != None,
+            Reservations.Date >= since,
+            Reservations.Date <= today
+        ).group_by(
+            Reservations.DeviceId, Reservations.Date, Reservations.StartTime, Reservations.EndTime
+        ).all()
+
+        daily = {}
+        for device_id, reservation_date, start_time, end_time, count in rows:
+            hours = ReservationService.hours_between(reservation_date, start_time, end_time) * count
+            device_daily = daily.setdefault(device_id, {})
+            device_daily[reservation_date] = device_daily.get(reservation_date, 0) + hours
+
+        with self._lock:
+            self._today, self._since, self._daily = today, since, daily
+            self._rates = {
+                device_id: self._rate(device_daily, weeks, decay)
+                for device_id, device_daily in daily.items()
+            }
+            self._warm = True
+        logger.info(f"تم حساب معدلات استخدام {len(daily)} جهاز منذ {since}")
+
+    def ensure_warm(self):
+        with self._lock:
+            if self._warm and self._today == date.today():
+                return
+        # إعادة الحساب عند أول استخدام أو عند بداية يوم جديد لتحريك نافذة الأسابيع
+        self.rebuild()
+
+    def invalidate(self):
+        with self._lock:
+            self._warm = False
+
+    def record(self, device_id, reservation_date, hours):
+        """إضافة (أو طرح عند القيمة السالبة) ساعات حجز جهاز وإعادة حساب معدله فقط"""
+        with self._lock:
+            if not self._warm or device_id is None or not (self._since <= reservation_date <= self._today):
+                # الأيام المستقبلية تدخل النافذة عند إعادة الحساب في يومها
+                return
+            weeks, decay = self._settings()
+            device_daily = self._daily.setdefault(device_id, {})
+            device_daily[reservation_date] = device_daily.get(reservation_date, 0) + hours
+            self._rates[device_id] = self._rate(device_daily, weeks, decay)
+
+    def rates_for(self, device_ids):
+        """معدل الاستخدام اليومي لكل جهاز، و None للأجهزة التي ليس لها حجوزات في النافذة"""
+        self.ensure_warm()
+        with self._lock:
+            return [self._rates.get(device_id) for device_id in device_ids]
+
+
+device_usage_rates = DeviceUsageRates()
+
+
+class MaintenanceCalendar:
+    """
+    نوافذ الصيانة غير المكتملة في مدى زمني، محملة باستعلام واحد ومفهرسة حسب الجهاز (أو المعمل)
+    
+    تمنع الصيانة الحجز من بدايتها (أو موعد جدولتها إذا لم تبدأ بعد) حتى نهايتها، والصيانة
+    بدون نهاية مفتوحة حتى يتم إكمالها. نوافذ كل مفتاح مرتبة حسب البداية مع أبعد نهاية حتى
+    كل موضع، فيتم فحص تقاطعها مع أي فترة بالتنصيف.
+    """
+
+    OPEN_END = datetime.max
+
+    def __init__(self, rows):
+        grouped = {}
+        for key, start_at, end_at in rows:
+            end_at = end_at or self.OPEN_END
+            if start_at is not None and start_at < end_at:
+                grouped.setdefault(key, []).append((start_at, end_at))
+
+        self._windows = {}
+        for key, windows in grouped.items():
+            windows.sort()
+            starts = []
+            reaches = []
+            reach = datetime.min
+            for start_at, end_at in windows:
+                reach = max(reach, end_at)
+                starts.append(start_at)
+                reaches.append(reach)
+            self._windows[key] = (windows, starts, reaches)
 
     @staticmethod
-    def update_reservation(reservation_id, update_data):
-        try:
-            # الحصول على الحجز الحالي
-            reservation = Reservations.query.get(reservation_id)
-            if not reservation:
-                return False, "الحجز غير موجود"
+    def _load_rows(key_column, condition, range_start, range_end):
+        window_start = func.coalesce(Maintenances.StartAt, Maintenances.SchedulingAt)
+        return db.session.query(key_column, window_start, Maintenances.EndAt).filter(
+            condition,
+            Maintenances.Status != "مكتملة",
+            window_start < range_end,
+            or_(Maintenances.EndAt.is_(None), Maintenances.EndAt > range_start)
+        ).all()
 
-            # التحقق من نوع المستخدم
-            user_valid, user = ReservationService.validate_user_type(reservation.UserId)
-            if not user_valid:
-                return False, user
+    @classmethod
+    def for_devices(cls, device_ids, range_start, range_end):
+        """صيانات الأجهزة التي تتقاطع مع المدى [range_start, range_end)"""
+        device_ids = list(set(device_ids))
+        if not device_ids:
+            return cls([])
+        return cls(cls._load_rows(
+            Maintenances.DeviceId, Maintenances.DeviceId.in_(device_ids), range_start, range_end
+        ))
 
-            # تحديد البيانات المطلوب تحديثها
-            lab_id = update_data.get('lab_id', reservation.LabId)
-            experiment_id = update_data.get('experiment_id', reservation.ExperimentId)
-            device_ids = update_data.get('device_ids', [reservation.DeviceId])
-            date_str = update_data.get('date', reservation.Date.strftime("%Y-%m-%d"))
-            start_time_str = update_data.get('start_time', reservation.StartTime.strftime("%H:%M"))
-            end_time_str = update_data.get('end_time', reservation.EndTime.strftime("%H:%M"))
-            purpose = update_data.get('purpose', reservation.Purpose)
-
-            # التحقق من توفر المعمل
-            lab_valid, lab = ReservationService.validate_lab_availability(
-                lab_id, user.UserType, date_str, start_time_str, end_time_str,
-                exclude_reservation_id=reservation_id
-            )
-            if not lab_valid:
-                return False, lab
+    @classmethod
+    def for_lab(cls, lab_id, range_start, range_end):
+        """صيانات المعمل نفسه (غير المرتبطة بجهاز) التي تتقاطع مع المدى"""
+        return cls(cls._load_rows(
+            Maintenances.LabId,
+            and_(Maintenances.LabId == lab_id, Maintenances.DeviceId.is_(None)),
+            range_start, range_end
+        ))
 
-            # التحقق من التجربة
-            exp_valid, experiment = ReservationService.validate_experiment(
-                experiment_id, lab_id, user.UserType
-            )
-            if not exp_valid:
-                return False, experiment
+    def is_blocked(self, key, start, end):
+        """هل تتقاطع أي صيانة للمفتاح مع الفترة [start, end)"""
+        indexed = self._windows.get(key)
+        if not indexed:
+            return False
+        _, starts, reaches = indexed
+        # النوافذ التي تبدأ قبل نهاية الفترة، وأبعد نهاية بينها تحدد التقاطع
+        position = bisect.bisect_left(starts, end)
+        return position > 0 and reaches[position - 1] > start
 
-            # التحقق من الأجهزة
-            devices_valid, devices = ReservationService.validate_devices(
-                device_ids, experiment_id, date_str, start_time_str, end_time_str,
-                exclude_reservation_id=reservation_id
-            )
-            if not devices_valid:
-                return False, devices
+    def windows(self, key):
+        """نوافذ المفتاح مرتبة حسب البداية، والنهاية المفتوحة OPEN_END"""
+        indexed = self._windows.get(key)
+        return list(indexed[0]) if indexed else []
+
+
+class BookingRequest:
+    """
+    طلب حجز بعد تحويل التاريخ والأوقات مرة واحدة
+    
+    يستخدمه محرك التحقق في الإنشاء والتحديث والحجز المجمع والمتكرر بدلاً من تمرير
+    النصوص وإعادة تحويلها في كل خطوة.
+    """
+
+    __slots__ = (
+        'user_id', 'lab_id', 'experiment_id', 'device_ids',
+        'date', 'start_time', 'end_time', 'purpose', 'exclude_reservation_id'
+    )
 
-            # حساب ساعات الحجز الجديد
-            new_hours = ReservationService.calculate_hours(
-                start_time_str, end_time_str, date_str
+    def __init__(self, user_id, lab_id, experiment_id, device_ids, reservation_date, start_time, end_time,
+                 purpose=None, exclude_reservation_id=None):
+        self.user_id = user_id
+        self.lab_id = lab_id
+        self.experiment_id = experiment_id
+        self.device_ids = device_ids
+        self.date = reservation_date
+        self.start_time = start_time
+        self.end_time = end_time
+        self.purpose = purpose
+        self.exclude_reservation_id = exclude_reservation_id
+
+    @classmethod
+    def parse(cls, user_id, lab_id, experiment_id, device_ids, date_str, start_time_str, end_time_str,
+              purpose=None, exclude_reservation_id=None):
+        """
+        تحويل حقول الطلب
+        
+        :return: (نجاح العملية، الطلب أو رسالة الخطأ)
+        """
+        try:
+            return True, cls(
+                user_id, lab_id, experiment_id, device_ids,
+                datetime.strptime(date_str, "%Y-%m-%d").date(),
+                datetime.strptime(start_time_str, "%H:%M").time(),
+                datetime.strptime(end_time_str, "%H:%M").time(),
+                purpose, exclude_reservation_id
             )
+        except (TypeError, ValueError):
+            return False, "صيغة التاريخ أو الوقت غير صحيحة"
+
+    @property
+    def hours(self):
+        return ReservationService.hours_between(self.date, self.start_time, self.end_time)
+
+    def time_error(self):
+        """التحقق من ترتيب الأوقات وأن التاريخ ليس في الماضي"""
+        if self.start_time >= self.end_time:
+            return "وقت البداية يجب أن يكون قبل وقت النهاية"
+        if self.date < date.today():
+            return "لا يمكن الحجز في تاريخ سابق"
+        return None
 
-            # تقليل ساعات الحجز القديم
-            ReservationService.deduct_reservation_hours(reservation)
-
-            # تحديث بيانات الحجز
-            reservation.LabId = lab_id
-            reservation.ExperimentId = experiment_id
-            reservation.Date = datetime.strptime(date_str, "%Y-%m-%d").date()
-            reservation.StartTime = datetime.strptime(start_time_str, "%H:%M").time()
-            reservation.EndTime = datetime.strptime(end_time_str, "%H:%M").time()
-            reservation.Purpose = purpose
-            reservation.IsAllowed = True
-
-            # إضافة ساعات الحجز الجديد
-            ReservationService.add_reservation_hours(
-                reservation, devices, lab, experiment, new_hours
+    def build_reservations(self, devices):
+        """صفوف الحجز المسموح (صف لكل جهاز) بدون حفظ"""
+        return [
+            Reservations(
+                UserId=self.user_id,
+                DeviceId=device.Id,
+                LabId=self.lab_id,
+                ExperimentId=self.experiment_id,
+                Date=self.date,
+                StartTime=self.start_time,
+                EndTime=self.end_time,
+                Purpose=self.purpose,
+                IsAllowed=True
             )
+            for device in devices
+        ]
 
-            # حفظ التغييرات
-            db.session.commit()
-            return True, "تم تحديث الحجز بنجاح"
 
-        except Exception as e:
-            db.session.rollback()
-            return False, f"حدث خطأ أثناء تحديث الحجز: {str(e)}" 
+# المستخدمون والمعامل والتجارب المحملة دفعة واحدة للحجز المجمع، كل منها {المعرف: الكائن}
+_BookingEntities = namedtuple('_BookingEntities', ['users', 'labs', 'experiments'])
+
 
 class ReservationService:
     @staticmethod
-    def validate_user_type(user_id):
-        user = Users.query.get(user_id)
+    def use_index():
+        """هل يتم التحقق من تداخل الحجوزات من الفهرس الموجود في الذاكرة بدلاً من قاعدة البيانات"""
+        return current_app.config.get('RESERVATION_INDEX_ENABLED', True)
+
+    @staticmethod
+    def user_static_error(user):
+        """التحقق من وجود المستخدم وصلاحية نوعه للحجز"""
         if not user:
-            return False, "المستخدم غير موجود"
+            return "المستخدم غير موجود"
         
         if user.UserType not in ["دكتور", "باحث"]:
-            return False, "نوع المستخدم غير مصرح له بالحجز"
-            
-        return True, user
+            return "نوع المستخدم غير مصرح له بالحجز"
+        return None
 
     @staticmethod
-    def validate_lab_availability(lab_id, user_type, date_str, start_time_str, end_time_str, exclude_reservation_id=None):
+    def validate_lab_availability(booking, lab, user_type, check_availability=True, conflict_flags=None):
+        """
+        التحقق من المعمل المحمل مسبقاً ومن عدم تداخل حجزه مع حجوزات أخرى
+        
+        :param conflict_flags: أعلام التداخل المحملة من قاعدة البيانات، أو None للبحث في الفهرس
+        """
         try:
-            lab = Laboratories.query.get(lab_id)
-            if not lab:
-                return False, "المعمل غير موجود"
-                
-            if lab.Status != "متاح":
-                return False, f"المعمل غير متاح حالياً. الحالة: {lab.Status}"
-                
-            # التحقق من نوع المعمل
-            if user_type == "دكتور" and lab.Type != "أكاديمي":
-                return False, "هذا المعمل مخصص للأبحاث فقط"
-            elif user_type == "باحث" and lab.Type != "بحثي":
-                return False, "هذا المعمل مخصص للتدريس فقط"
-
-            # تحويل التاريخ والوقت إلى الصيغة المناسبة
-            from datetime import date
-            reservation_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-            start_time = datetime.strptime(start_time_str, "%H:%M").time()
-            end_time = datetime.strptime(end_time_str, "%H:%M").time()
-            
-            # التحقق من صحة الوقت
-            if start_time >= end_time:
-                return False, "وقت البداية يجب أن يكون قبل وقت النهاية"
-            
-            # التحقق من التاريخ
-            today = date.today()
-            if reservation_date < today:
-                return False, "لا يمكن الحجز في تاريخ سابق"
+            lab_error = ReservationService.lab_static_error(lab, user_type)
+            if lab_error:
+                return False, lab_error
+
+            # التحقق من صحة الوقت والتاريخ
+            time_error = booking.time_error()
+            if time_error:
+                return False, time_error
+
+            if not check_availability:
+                return True, lab
             
             # البحث عن الحجوزات المتداخلة
-            from sqlalchemy import or_, and_
-            overlapping_reservations = db.session.query(Reservations).filter(
-                Reservations.LabId == lab_id,
-                Reservations.Date == reservation_date,
-                Reservations.IsAllowed == True,
-                or_(
-                    and_(
-                        Reservations.StartTime <= start_time,
-                        Reservations.EndTime > start_time
-                    ),
-                    and_(
-                        Reservations.StartTime < end_time,
-                        Reservations.EndTime >= end_time
-                    ),
-                    and_(
-                        Reservations.StartTime >= start_time,
-                        Reservations.EndTime <= end_time
+            if conflict_flags is None:
+                overlapping_user_types = {
+                    entry.user_type for entry in reservation_index.find_lab_overlaps(
+                        booking.lab_id, booking.date, booking.start_time, booking.end_time,
+                        booking.exclude_reservation_id
                     )
-                )
-            )
-            
-            # استثناء الحجز الحالي في حالة التحديث
-            if exclude_reservation_id:
-                overlapping_reservations = overlapping_reservations.filter(
-                    Reservations.Id != exclude_reservation_id
+                }
+                conflict_flags = (
+                    "دكتور" in overlapping_user_types,
+                    "باحث" in overlapping_user_types,
+                    bool(overlapping_user_types)
                 )
             
             # التحقق من الحجوزات المتداخلة
-            for reservation in overlapping_reservations.join(Users).all():
-                # إذا كان هناك دكتور حاجز المعمل
-                if reservation.user.UserType == "دكتور":
-                    return False, f"المعمل {lab.LabName} محجوز من قبل دكتور في هذا الوقت"
-                # إذا كان المستخدم الحالي دكتور وهناك باحث حاجز
-                elif user_type == "دكتور" and reservation.user.UserType == "باحث":
-                    return False, f"المعمل {lab.LabName} محجوز من قبل باحث في هذا الوقت"
-                else:
-                    return False, f"المعمل {lab.LabName} محجوز بالفعل في هذا الوقت"
+            conflict_message = ReservationService.lab_conflict_from_flags(
+                lab.LabName, user_type, *conflict_flags
+            )
+            if conflict_message:
+                return False, conflict_message
 
             return True, lab
             
@@ -416,108 +509,149 @@ class ReservationService:
             return False, f"حدث خطأ أثناء التحقق من توفر المعمل: {str(e)}"
 
     @staticmethod
-    def validate_experiment(experiment_id, lab_id, user_type):
-        experiment = Experiments.query.get(experiment_id)
+    def overlap_conditions(booking):
+        """شروط الحجوزات المسموحة المتداخلة زمنياً مع الطلب (بدون تحديد المعمل أو الجهاز)"""
+        conditions = [
+            Reservations.Date == booking.date,
+            Reservations.IsAllowed == True,
+            Reservations.StartTime < booking.end_time,
+            Reservations.EndTime > booking.start_time
+        ]
+        if booking.exclude_reservation_id:
+            conditions.append(Reservations.Id != booking.exclude_reservation_id)
+        return conditions
+
+    @staticmethod
+    def lab_conflict_columns(booking):
+        """أعمدة أعلام وجود حجوزات متداخلة على المعمل (دكتور، باحث، أي حجز) لإضافتها إلى استعلام التحميل"""
+        overlap = [Reservations.LabId == booking.lab_id] + ReservationService.overlap_conditions(booking)
+
+        def overlap_exists(user_type=None):
+            query = select(Reservations.Id).where(*overlap)
+            if user_type:
+                query = query.join(Users, Users.Id == Reservations.UserId).where(Users.UserType == user_type)
+            # CASE بدلاً من EXISTS مباشرة لأن SQL Server لا يقبل EXISTS في قائمة الأعمدة
+            return case((query.exists(), 1), else_=0)
+
+        return [overlap_exists("دكتور"), overlap_exists("باحث"), overlap_exists()]
+
+    @staticmethod
+    def load_booking_entities(booking, include_lab_conflicts=False):
+        """
+        تحميل المستخدم والمعمل والتجربة (ومعها أعلام تداخل المعمل عند الطلب) في رحلة واحدة لقاعدة البيانات
+        
+        :return: (المستخدم، المعمل، التجربة، أعلام التداخل أو None)، والقيم غير الموجودة None
+        """
+        columns = [Users, Laboratories, Experiments]
+        if include_lab_conflicts:
+            columns += ReservationService.lab_conflict_columns(booking)
+
+        row = db.session.query(*columns).select_from(Users).outerjoin(
+            Laboratories, Laboratories.LabId == booking.lab_id
+        ).outerjoin(
+            Experiments, Experiments.ExperimentId == booking.experiment_id
+        ).filter(Users.Id == booking.user_id).first()
+        if row is None:
+            return None, None, None, None
+
+        user, lab, experiment = row[:3]
+        conflict_flags = tuple(bool(flag) for flag in row[3:]) if include_lab_conflicts else None
+        return user, lab, experiment, conflict_flags
+
+    @staticmethod
+    def lab_static_error(lab, user_type):
+        """التحقق من وجود المعمل وحالته ونوعه بغض النظر عن وقت الحجز"""
+        if not lab:
+            return "المعمل غير موجود"
+            
+        if lab.Status != "متاح":
+            return f"المعمل غير متاح حالياً. الحالة: {lab.Status}"
+            
+        # التحقق من نوع المعمل
+        if user_type == "دكتور" and lab.Type != "أكاديمي":
+            return "هذا المعمل مخصص للأبحاث فقط"
+        elif user_type == "باحث" and lab.Type != "بحثي":
+            return "هذا المعمل مخصص للتدريس فقط"
+        return None
+
+    @staticmethod
+    def lab_conflict_message(lab_name, user_type, overlapping_user_types):
+        """رسالة رفض حجز المعمل حسب أنواع المستخدمين الحاجزين في نفس الوقت"""
+        overlapping_user_types = set(overlapping_user_types)
+        return ReservationService.lab_conflict_from_flags(
+            lab_name,
+            user_type,
+            "دكتور" in overlapping_user_types,
+            "باحث" in overlapping_user_types,
+            bool(overlapping_user_types)
+        )
+
+    @staticmethod
+    def lab_conflict_from_flags(lab_name, user_type, has_doctor, has_researcher, has_any):
+        """رسالة رفض حجز المعمل، حجز الدكتور له الأولوية ثم حجز الباحث إذا كان المستخدم الحالي دكتور"""
+        # إذا كان هناك دكتور حاجز المعمل
+        if has_doctor:
+            return f"المعمل {lab_name} محجوز من قبل دكتور في هذا الوقت"
+        # إذا كان المستخدم الحالي دكتور وهناك باحث حاجز
+        if user_type == "دكتور" and has_researcher:
+            return f"المعمل {lab_name} محجوز من قبل باحث في هذا الوقت"
+        if has_any:
+            return f"المعمل {lab_name} محجوز بالفعل في هذا الوقت"
+        return None
+
+    @staticmethod
+    def experiment_static_error(experiment, lab_id, user_type):
+        """التحقق من وجود التجربة وارتباطها بالمعمل ومناسبة نوعها لنوع المستخدم"""
         if not experiment:
-            return False, "التجربة غير موجودة"
+            return "التجربة غير موجودة"
             
         if experiment.LabId != lab_id:
-            return False, "التجربة غير متوفرة في هذا المعمل"
+            return "التجربة غير متوفرة في هذا المعمل"
             
         if user_type == "دكتور" and experiment.Type != "أكاديمية":
-            return False, "هذه التجربة مخصصة للأبحاث فقط"
+            return "هذه التجربة مخصصة للأبحاث فقط"
         elif user_type == "باحث" and experiment.Type != "بحثية":
-            return False, "هذه التجربة مخصصة للتدريس فقط"
-            
-        return True, experiment
+            return "هذه التجربة مخصصة للتدريس فقط"
+        return None
 
     @staticmethod
-    def validate_devices(device_ids, experiment_id, date_str, start_time_str, end_time_str, exclude_reservation_id=None):
+    def validate_devices(booking, check_availability=True, calendar=None):
+        """
+        :param calendar: تقويم صيانة محمل مسبقاً يغطي وقت الحجز (في الحجز المجمع)، أو None لتحميله
+        """
         try:
             valid_devices = []
-            from datetime import date
-            from sqlalchemy import or_, and_
-            
-            # تحويل التاريخ والوقت إلى الصيغة المناسبة
-            reservation_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-            start_time = datetime.strptime(start_time_str, "%H:%M").time()
-            end_time = datetime.strptime(end_time_str, "%H:%M").time()
-            
-            # التحقق من صحة الوقت
-            if start_time >= end_time:
-                return False, "وقت البداية يجب أن يكون قبل وقت النهاية"
-            
-            # التحقق من التاريخ
-            today = date.today()
-            if reservation_date < today:
-                return False, "لا يمكن الحجز في تاريخ سابق"
-            
-            for device_id in device_ids:
-                device = Devices.query.get(device_id)
-                if not device:
-                    return False, f"الجهاز رقم {device_id} غير موجود"
-                    
-                # التحقق من أن الجهاز تابع للتجربة من خلال جدول ExperimentDevices
-                experiment_device = ExperimentDevices.query.filter_by(
-                    ExperimentId=experiment_id,
-                    DeviceId=device_id
-                ).first()
-                
-                if not experiment_device:
-                    return False, f"الجهاز رقم {device_id} غير مرتبط بهذه التجربة"
-                    
-                if device.Status != "متاح":
-                    return False, f"الجهاز {device.Name} غير متاح حالياً. الحالة: {device.Status}"
-                    
-                # البحث عن الحجوزات المتداخلة
-                overlapping_reservations = db.session.query(Reservations).filter(
-                    Reservations.DeviceId == device_id,
-                    Reservations.Date == reservation_date,
-                    Reservations.IsAllowed == True,
-                    or_(
-                        and_(
-                            Reservations.StartTime <= start_time,
-                            Reservations.EndTime > start_time
-                        ),
-                        and_(
-                            Reservations.StartTime < end_time,
-                            Reservations.EndTime >= end_time
-                        ),
-                        and_(
-                            Reservations.StartTime >= start_time,
-                            Reservations.EndTime <= end_time
-                        )
-                    )
+            if not booking.device_ids:
+                return True, valid_devices
+
+            # تحميل الأجهزة مع ارتباطها بالتجربة (والحجز عند تعطيل الفهرس) في استعلام واحد
+            use_index = ReservationService.use_index()
+            devices_by_id, linked_device_ids, reserved_device_ids = (
+                ReservationService.load_booking_devices(booking, check_availability and not use_index)
+            )
+            if check_availability and use_index:
+                reserved_device_ids = reservation_index.find_reserved_devices(
+                    booking.device_ids, booking.date, booking.start_time, booking.end_time,
+                    booking.exclude_reservation_id
                 )
+            booking_start = datetime.combine(booking.date, booking.start_time)
+            booking_end = datetime.combine(booking.date, booking.end_time)
+            if check_availability and calendar is None:
+                calendar = MaintenanceCalendar.for_devices(devices_by_id, booking_start, booking_end)
+            
+            # تطبيق نفس ترتيب التحقق لكل جهاز للحفاظ على رسائل الخطأ
+            for device_id in booking.device_ids:
+                device_error = ReservationService.device_static_error(device_id, devices_by_id, linked_device_ids)
+                if device_error:
+                    return False, device_error
+                device = devices_by_id[device_id]
                 
-                # استثناء الحجز الحالي في حالة التحديث
-                if exclude_reservation_id:
-                    overlapping_reservations = overlapping_reservations.filter(
-                        Reservations.Id != exclude_reservation_id
-                    )
-                
-                if overlapping_reservations.count() > 0:
-                    return False, f"الجهاز {device.Name} محجوز في هذا الوقت"
-                
-                # البحث عن الصيانة المتداخلة - إذا كان جدول Maintenances موجود
-                try:
-                    from model import Maintenances
-                    overlapping_maintenance = db.session.query(Maintenances).filter(
-                        Maintenances.DeviceId == device_id,
-                        or_(
-                            and_(
-                                Maintenances.StartAt <= datetime.combine(reservation_date, datetime.min.time()),
-                                Maintenances.EndAt >= datetime.combine(reservation_date, datetime.min.time())
-                            )
-                        ),
-                        Maintenances.Status != "مكتملة"
-                    ).count()
+                if check_availability:
+                    if device_id in reserved_device_ids:
+                        return False, f"الجهاز {device.Name} محجوز في هذا الوقت"
                     
-                    if overlapping_maintenance > 0:
-                        return False, f"الجهاز {device.Name} في الصيانة في هذا التاريخ"
-                except ImportError:
-                    # إذا كان جدول الصيانة غير موجود، تجاهل هذا التحقق
-                    pass
+                    if calendar.is_blocked(device_id, booking_start, booking_end):
+                        return False, f"الجهاز {device.Name} في الصيانة في هذا الوقت"
                     
                 valid_devices.append(device)
                 
@@ -527,362 +661,1724 @@ class ReservationService:
             return False, f"حدث خطأ أثناء التحقق من توفر الأجهزة: {str(e)}"
 
     @staticmethod
-    def calculate_hours(start_time_str, end_time_str, date_str):
-        start_time = datetime.strptime(start_time_str, "%H:%M").time()
-        end_time = datetime.strptime(end_time_str, "%H:%M").time()
-        date = datetime.strptime(date_str, "%Y-%m-%d").date()
+    def load_booking_devices(booking, include_reserved=False):
+        """
+        تحميل أجهزة الطلب مع علم الارتباط بالتجربة، واختيارياً وجود حجز متداخل، في استعلام واحد
         
-        start_datetime = datetime.combine(date, start_time)
-        end_datetime = datetime.combine(date, end_time)
+        :return: (الأجهزة حسب المعرف، المرتبطة بالتجربة، المحجوزة)
+        """
+        columns = [Devices, ExperimentDevices.Id]
+        if include_reserved:
+            reserved = select(Reservations.Id).where(
+                Reservations.DeviceId == Devices.Id,
+                *ReservationService.overlap_conditions(booking)
+            ).exists()
+            columns.append(case((reserved, 1), else_=0))
+
+        device_rows = db.session.query(*columns).outerjoin(
+            ExperimentDevices,
+            and_(
+                ExperimentDevices.DeviceId == Devices.Id,
+                ExperimentDevices.ExperimentId == booking.experiment_id
+            )
+        ).filter(Devices.Id.in_(booking.device_ids)).all()
+
+        devices_by_id = {}
+        linked_device_ids = set()
+        reserved_device_ids = set()
+        for device, experiment_device_id, *reserved_flag in device_rows:
+            devices_by_id[device.Id] = device
+            if experiment_device_id is not None:
+                linked_device_ids.add(device.Id)
+            if reserved_flag and reserved_flag[0]:
+                reserved_device_ids.add(device.Id)
+
+        return devices_by_id, linked_device_ids, reserved_device_ids
+
+    @staticmethod
+    def device_static_error(device_id, devices_by_id, linked_device_ids):
+        """التحقق من وجود الجهاز وارتباطه بالتجربة وحالته بغض النظر عن وقت الحجز"""
+        device = devices_by_id.get(device_id)
+        if not device:
+            return f"الجهاز رقم {device_id} غير موجود"
+            
+        if device_id not in linked_device_ids:
+            return f"الجهاز رقم {device_id} غير مرتبط بهذه التجربة"
+            
+        if not DeviceStatusService.is_available(device.Status):
+            return f"الجهاز {device.Name} غير متاح حالياً. الحالة: {device.Status}"
+        return None
+
+    @staticmethod
+    def hours_between(reservation_date, start_time, end_time):
+        start_datetime = datetime.combine(reservation_date, start_time)
+        end_datetime = datetime.combine(reservation_date, end_time)
         return (end_datetime - start_datetime).total_seconds() / 3600
 
     @staticmethod
-    def deduct_reservation_hours(reservation):
-        """تقليل ساعات الحجز القديم"""
-        hours = ReservationService.calculate_hours(
-            reservation.StartTime.strftime("%H:%M"),
-            reservation.EndTime.strftime("%H:%M"),
-            reservation.Date.strftime("%Y-%m-%d")
-        )
-        
-        # تقليل ساعات المعمل
-        lab = Laboratories.query.get(reservation.LabId)
-        lab.UsageHours -= hours
-        lab.TotalOperatingHours -= hours
+    def counted_hours(hours):
+        """
+        الساعات التي تضاف لعدادات الاستخدام عن صف حجز واحد
         
-        # تقليل ساعات الأجهزة
-        devices = Devices.query.join(Reservations).filter(
-            Reservations.Id == reservation.Id
-        ).all()
+        العدادات أعداد صحيحة (Integer في قاعدة البيانات)، فتقرب مدة الحجز لأقرب ساعة ونصف الساعة
+        يقرب لأعلى (أقل من 30 دقيقة لا تضيف شيئاً، و1:30 تضيف ساعتين). نفس القاعدة تستخدم عند
+        الإضافة والخصم وفي reconcile_hours حتى تتطابق القيم.
+        """
+        return math.floor(hours + 0.5)
+
+    @staticmethod
+    def _group_by_delta(deltas):
+        groups = {}
+        for entity_id, delta in (deltas or {}).items():
+            if entity_id is not None and delta:
+                groups.setdefault(delta, []).append(entity_id)
+        return groups.items()
+
+    @staticmethod
+    def apply_hour_deltas(lab_hours=None, device_hours=None, experiment_counts=None):
+        """
+        تطبيق فروقات الساعات بجمل UPDATE مباشرة (col = col + :h) داخل المعاملة الحالية
         
-        for device in devices:
-            device.CurrentHour -= hours
-            device.TotalOperatingHours -= hours
-            
-        # تقليل عدد مرات إجراء التجربة
-        experiment = Experiments.query.get(reservation.ExperimentId)
-        experiment.CompletedCount -= 1
+        لا يتم قراءة الصفوف أو حفظ المعاملة هنا، فتبقى العدادات صحيحة عند الحجوزات المتزامنة
+        وتحفظ مع صفوف الحجز في نفس عملية الحفظ. المعرفات التي لها نفس الفرق تحدث بجملة واحدة.
         
-        db.session.commit()
+        :param lab_hours: {LabId: عدد الساعات}
+        :param device_hours: {DeviceId: عدد الساعات}
+        :param experiment_counts: {ExperimentId: عدد المرات}
+        """
+        for hours, lab_ids in ReservationService._group_by_delta(lab_hours):
+            db.session.execute(
+                update(Laboratories).where(Laboratories.LabId.in_(lab_ids)).values(
+                    UsageHours=Laboratories.UsageHours + hours,
+                    TotalOperatingHours=Laboratories.TotalOperatingHours + hours
+                ).execution_options(synchronize_session=False)
+            )
+
+        for hours, device_ids in ReservationService._group_by_delta(device_hours):
+            db.session.execute(
+                update(Devices).where(Devices.Id.in_(device_ids)).values(
+                    CurrentHour=Devices.CurrentHour + hours,
+                    TotalOperatingHours=Devices.TotalOperatingHours + hours
+                ).execution_options(synchronize_session=False)
+            )
+
+        for count, experiment_ids in ReservationService._group_by_delta(experiment_counts):
+            db.session.execute(
+                update(Experiments).where(Experiments.ExperimentId.in_(experiment_ids)).values(
+                    CompletedCount=Experiments.CompletedCount + count
+                ).execution_options(synchronize_session=False)
+            )
+
+    @staticmethod
+    def deduct_reservation_hours(reservation):
+        """تقليل ساعات الحجز القديم (بدون حفظ)"""
+        # الحجز المرفوض لم تضف ساعاته أصلاً
+        if not reservation.IsAllowed:
+            return
+
+        hours = ReservationService.counted_hours(ReservationService.hours_between(
+            reservation.Date, reservation.StartTime, reservation.EndTime
+        ))
+        ReservationService.apply_hour_deltas(
+            lab_hours={reservation.LabId: -hours},
+            device_hours={reservation.DeviceId: -hours},
+            experiment_counts={reservation.ExperimentId: -1}
+        )
+
+    @staticmethod
+    def add_reservation_hours(reservation, devices, lab, experiment, hours):
+        """إضافة ساعات الحجز (بدون حفظ)"""
+        hours = ReservationService.counted_hours(hours)
+        ReservationService.apply_hour_deltas(
+            lab_hours={lab.LabId: hours},
+            device_hours={device.Id: hours for device in devices},
+            experiment_counts={experiment.ExperimentId: 1}
+        )
+
+    # أجزاء من رسائل أخطاء قاعدة البيانات التي تعني أن إعادة المعاملة قد تنجح
+    # (PostgreSQL: 40P01/40001، SQL Server: 1205، SQLite: database is locked)
+    RETRYABLE_ERROR_MARKERS = ('deadlock', '40p01', '40001', '1205', 'could not serialize', 'database is locked')
+
+    @staticmethod
+    def is_retryable_error(error):
+        if isinstance(error, DBAPIError) and error.connection_invalidated:
+            return True
+        message = str(getattr(error, 'orig', error)).lower()
+        return any(marker in message for marker in ReservationService.RETRYABLE_ERROR_MARKERS)
+
+    @staticmethod
+    def run_with_retry(operation):
+        """
+        تنفيذ معاملة حجز مع إعادة المحاولة عند تعارض الأقفال أو فشل التسلسل
+        
+        :param operation: دالة تنفذ المعاملة كاملة بما فيها الحفظ
+        :return: نتيجة الدالة
+        """
+        attempts = max(1, current_app.config.get('RESERVATION_LOCK_RETRIES', 3))
+        for attempt in range(1, attempts + 1):
+            try:
+                return operation()
+            except DBAPIError as e:
+                db.session.rollback()
+                if attempt == attempts or not ReservationService.is_retryable_error(e):
+                    raise
+                logger.warning("Retrying reservation transaction (attempt %s/%s): %s", attempt, attempts, e.orig)
+                time.sleep(0.05 * attempt + random.uniform(0, 0.05))
+
+    @staticmethod
+    def lock_booking_resources(lab_ids, device_ids):
+        """
+        قفل صفوف المعامل والأجهزة حتى نهاية المعاملة الحالية
+        
+        يترجم إلى SELECT ... FOR UPDATE في PostgreSQL و WITH (UPDLOCK, ROWLOCK) في SQL Server
+        (لأن SQLAlchemy يتجاهل with_for_update مع SQL Server)،
+        فينتظر أي طلب آخر يحجز نفس المعمل أو الجهاز حتى تنتهي هذه المعاملة. القفل يتم دائماً
+        بنفس الترتيب (المعامل ثم الأجهزة تصاعدياً) لتجنب التعارض الدائري بين الطلبات.
+        """
+        lab_ids = sorted(lab_id for lab_id in lab_ids if lab_id is not None)
+        device_ids = sorted(device_id for device_id in device_ids if device_id is not None)
+
+        if db.session.get_bind().dialect.name == 'sqlite':
+            # SQLite يتجاهل FOR UPDATE، وجملة UPDATE بدون تغيير تأخذ قفل الكتابة على قاعدة البيانات كلها،
+            # فتكفي جملة واحدة على المعامل (أو الأجهزة إذا لم يكن هناك معمل) لقفل الأجهزة أيضاً
+            if lab_ids:
+                db.session.execute(
+                    update(Laboratories)
+                    .where(Laboratories.LabId.in_(lab_ids))
+                    .values(LabId=Laboratories.LabId)
+                    .execution_options(synchronize_session=False)
+                )
+            elif device_ids:
+                db.session.execute(
+                    update(Devices)
+                    .where(Devices.Id.in_(device_ids))
+                    .values(Id=Devices.Id)
+                    .execution_options(synchronize_session=False)
+                )
+            return
+
+        if lab_ids:
+            db.session.execute(
+                select(Laboratories.LabId)
+                .where(Laboratories.LabId.in_(lab_ids))
+                .order_by(Laboratories.LabId)
+                .with_for_update()
+                .with_hint(Laboratories, "WITH (UPDLOCK, ROWLOCK)", 'mssql')
+            ).all()
+        if device_ids:
+            db.session.execute(
+                select(Devices.Id)
+                .where(Devices.Id.in_(device_ids))
+                .order_by(Devices.Id)
+                .with_for_update()
+                .with_hint(Devices, "WITH (UPDLOCK, ROWLOCK)", 'mssql')
+            ).all()
+
+    @staticmethod
+    def find_committed_conflicts(slots, exclude_reservation_ids=()):
+        """
+        التحقق من تداخل مواعيد الحجز مع الحجوزات المحفوظة فعلاً في قاعدة البيانات
+        
+        يستدعى بعد قفل الموارد، ولا يعتمد على الفهرس في الذاكرة لأنه لا يرى ما كتبته العمليات الأخرى.
+        
+        :param slots: قائمة بعناصر (المفتاح، نوع المستخدم، المعمل، الأجهزة، التاريخ، وقت البداية، وقت النهاية)
+        :param exclude_reservation_ids: حجوزات يتم تجاهلها (في حالة التحديث)
+        :return: قاموس {المفتاح: رسالة التعارض}
+        """
+        if not slots:
+            return {}
+
+        lab_ids = {lab.LabId for _, _, lab, *_ in slots}
+        device_ids = {device.Id for _, _, _, devices, *_ in slots for device in devices}
+        dates = {day for *_, day, _, _ in slots}
+        exclude_filter = (
+            [not_(Reservations.Id.in_(list(exclude_reservation_ids)))] if exclude_reservation_ids else []
+        )
+
+        lab_rows = db.session.query(
+            Reservations.LabId, Reservations.Date, Reservations.StartTime, Reservations.EndTime, Users.UserType
+        ).join(Users, Users.Id == Reservations.UserId).filter(
+            Reservations.LabId.in_(lab_ids),
+            Reservations.Date.in_(dates),
+            Reservations.IsAllowed == True,
+            *exclude_filter
+        ).all()
+        device_rows = db.session.query(
+            Reservations.DeviceId, Reservations.Date, Reservations.StartTime, Reservations.EndTime
+        ).filter(
+            Reservations.DeviceId.in_(device_ids),
+            Reservations.Date.in_(dates),
+            Reservations.IsAllowed == True,
+            *exclude_filter
+        ).all() if device_ids else []
+
+        booked_labs = {}
+        for lab_id, day, start, end, user_type in lab_rows:
+            booked_labs.setdefault((lab_id, day), []).append((start, end, user_type))
+        booked_devices = {}
+        for device_id, day, start, end in device_rows:
+            booked_devices.setdefault((device_id, day), []).append((start, end))
+
+        conflicts = {}
+        for key, user_type, lab, devices, day, start_time, end_time in slots:
+            lab_overlaps = ReservationService._overlaps(
+                booked_labs.get((lab.LabId, day), []), start_time, end_time
+            )
+            message = ReservationService.lab_conflict_message(
+                lab.LabName, user_type, [entry[2] for entry in lab_overlaps]
+            )
+            if not message:
+                busy_device = next((
+                    device for device in devices
+                    if ReservationService._overlaps(booked_devices.get((device.Id, day), []), start_time, end_time)
+                ), None)
+                if busy_device:
+                    message = f"الجهاز {busy_device.Name} محجوز في هذا الوقت"
+            if message:
+                conflicts[key] = message
+        return conflicts
+
+    @staticmethod
+    def validate_booking(booking, check_availability=True, calendar=None, entities=None):
+        """
+        محرك التحقق المشترك لمسارات الحجز: المستخدم ثم المعمل ثم التجربة ثم الأجهزة
+        
+        :param booking: طلب الحجز (BookingRequest)
+        :param check_availability: False للتحقق الثابت فقط بدون فحص التداخل والصيانة
+        :param calendar: تقويم صيانة محمل مسبقاً للأجهزة (MaintenanceCalendar) أو None
+        :param entities: المستخدمون والمعامل والتجارب المحملة مسبقاً (_BookingEntities) أو None.
+            تستخدم عند فحص التداخل من الفهرس فقط، لأن أعلام التداخل من قاعدة البيانات تحمل مع
+            الكيانات في نفس الاستعلام
+        :return: (نجاح العملية، (المستخدم، المعمل، التجربة، الأجهزة) أو رسالة الخطأ)
+        """
+        # المستخدم والمعمل والتجربة (وأعلام تداخل المعمل عند عدم استخدام الفهرس) في استعلام واحد
+        include_lab_conflicts = check_availability and not ReservationService.use_index()
+        try:
+            preloaded = None
+            if entities is not None and not include_lab_conflicts:
+                preloaded = (
+                    entities.users.get(booking.user_id),
+                    entities.labs.get(booking.lab_id),
+                    entities.experiments.get(booking.experiment_id)
+                )
+            if preloaded and all(preloaded):
+                user, lab, experiment = preloaded
+                conflict_flags = None
+            else:
+                user, lab, experiment, conflict_flags = ReservationService.load_booking_entities(
+                    booking, include_lab_conflicts
+                )
+        except Exception as e:
+            return False, f"حدث خطأ أثناء التحقق من بيانات الحجز: {str(e)}"
+
+        user_error = ReservationService.user_static_error(user)
+        if user_error:
+            return False, user_error
+
+        lab_valid, lab = ReservationService.validate_lab_availability(
+            booking, lab, user.UserType, check_availability, conflict_flags
+        )
+        if not lab_valid:
+            return False, lab
+
+        experiment_error = ReservationService.experiment_static_error(experiment, booking.lab_id, user.UserType)
+        if experiment_error:
+            return False, experiment_error
+
+        devices_valid, devices = ReservationService.validate_devices(booking, check_availability, calendar)
+        if not devices_valid:
+            return False, devices
+
+        return True, (user, lab, experiment, devices)
+
+    @staticmethod
+    def update_reservation(reservation_id, update_data):
+        try:
+            # الحصول على الحجز الحالي
+            reservation = Reservations.query.get(reservation_id)
+            if not reservation:
+                return False, "الحجز غير موجود"
+
+            # كل صف حجز لجهاز واحد، فالتعديل يمكن أن ينقله لجهاز آخر فقط ولا يضيف أجهزة
+            device_ids = update_data.get('device_ids', [reservation.DeviceId])
+            if not isinstance(device_ids, list) or len(device_ids) != 1:
+                return False, "يمكن تعديل الحجز لجهاز واحد فقط، ولحجز أجهزة أخرى يتم إنشاء حجز جديد"
+
+            # تحديد البيانات المطلوب تحديثها، والحقول غير المرسلة تؤخذ من الحجز الحالي كما هي
+            try:
+                booking = BookingRequest(
+                    reservation.UserId,
+                    update_data.get('lab_id', reservation.LabId),
+                    update_data.get('experiment_id', reservation.ExperimentId),
+                    device_ids,
+                    datetime.strptime(update_data['date'], "%Y-%m-%d").date()
+                    if 'date' in update_data else reservation.Date,
+                    datetime.strptime(update_data['start_time'], "%H:%M").time()
+                    if 'start_time' in update_data else reservation.StartTime,
+                    datetime.strptime(update_data['end_time'], "%H:%M").time()
+                    if 'end_time' in update_data else reservation.EndTime,
+                    update_data.get('purpose', reservation.Purpose),
+                    exclude_reservation_id=reservation.Id
+                )
+            except (TypeError, ValueError):
+                return False, "صيغة التاريخ أو الوقت غير صحيحة"
+
+            # التحقق من المستخدم والمعمل والتجربة والأجهزة
+            booking_valid, result = ReservationService.validate_booking(booking)
+            if not booking_valid:
+                return False, result
+            user, lab, experiment, devices = result
+
+            def apply_update():
+                # قفل الموارد القديمة والجديدة ثم إعادة التحقق مقابل قاعدة البيانات
+                ReservationService.lock_booking_resources(
+                    {reservation.LabId, booking.lab_id},
+                    {reservation.DeviceId} | {device.Id for device in devices}
+                )
+                conflict = ReservationService.find_committed_conflicts(
+                    [(reservation.Id, user.UserType, lab, devices, booking.date, booking.start_time, booking.end_time)],
+                    exclude_reservation_ids=[reservation.Id]
+                ).get(reservation.Id)
+                if conflict:
+                    db.session.rollback()
+                    reservation_index.invalidate()
+                    return False, conflict
+
+                # تقليل ساعات الحجز القديم
+                ReservationService.deduct_reservation_hours(reservation)
+                previous_usage = (
+                    reservation.DeviceId, reservation.Date,
+                    ReservationService.hours_between(reservation.Date, reservation.StartTime, reservation.EndTime)
+                ) if reservation.IsAllowed else None
+
+                # تحديث بيانات الحجز
+                reservation.LabId = booking.lab_id
+                reservation.ExperimentId = booking.experiment_id
+                reservation.DeviceId = devices[0].Id
+                reservation.Date = booking.date
+                reservation.StartTime = booking.start_time
+                reservation.EndTime = booking.end_time
+                reservation.Purpose = booking.purpose
+                reservation.IsAllowed = True
+
+                # إضافة ساعات الحجز الجديد
+                ReservationService.add_reservation_hours(
+                    reservation, devices, lab, experiment, booking.hours
+                )
+
+                # حفظ التغييرات مع تعديل الساعات في معاملة واحدة
+                db.session.commit()
+                reservation_index.sync(reservation, user.UserType)
+                if previous_usage:
+                    device_id, previous_date, previous_hours = previous_usage
+                    device_usage_rates.record(device_id, previous_date, -previous_hours)
+                device_usage_rates.record(reservation.DeviceId, reservation.Date, booking.hours)
+                return True, "تم تحديث الحجز بنجاح"
+
+            return ReservationService.run_with_retry(apply_update)
+
+        except Exception as e:
+            db.session.rollback()
+            return False, f"حدث خطأ أثناء تحديث الحجز: {str(e)}"
+
+    @staticmethod
+    def create_reservation(user_id, lab_id, experiment_id, device_ids, date_str, start_time_str, end_time_str, purpose):
+        """
+        إنشاء حجز جديد
+        
+        :return: (رقم الحجز أو None، الرسالة، رقم محاولة الحجز المرفوضة المسجلة أو None)
+        """
+        try:
+            booking_parsed, booking = BookingRequest.parse(
+                user_id, lab_id, experiment_id, device_ids, date_str, start_time_str, end_time_str, purpose
+            )
+            if not booking_parsed:
+                return None, booking, None
+
+            # التحقق من المستخدم والمعمل والتجربة والأجهزة
+            booking_valid, result = ReservationService.validate_booking(booking)
+            if not booking_valid:
+                # تسجيل محاولة مرفوضة فقط إذا كان المعمل أو الجهاز محجوز في هذا الوقت
+                if "محجوز" in result:
+                    return None, result, ReservationAttemptService.record_attempt(booking, result)
+                return None, result, None
+            user, lab, experiment, devices = result
+
+            # حفظ الحجوزات وإضافة ساعاتها في معاملة واحدة بعد قفل المعمل والأجهزة
+            reservations = booking.build_reservations(devices)
+            conflicts = ReservationService.persist_accepted_bookings(
+                [(0, user, lab, experiment, devices, booking.hours, reservations)]
+            )
+            if conflicts:
+                # سبقه طلب متزامن لنفس الموعد بعد التحقق الأولي
+                return None, conflicts[0], ReservationAttemptService.record_attempt(booking, conflicts[0])
+
+            return reservations[0].Id, "تم إنشاء الحجز بنجاح", None
+
+        except Exception as e:
+            db.session.rollback()
+            return None, f"حدث خطأ أثناء إنشاء الحجز: {str(e)}", None
+
+    BULK_REQUIRED_FIELDS = [
+        'user_id', 'lab_id', 'experiment_id', 'device_ids',
+        'date', 'start_time', 'end_time', 'purpose'
+    ]
+
+    @staticmethod
+    def _preload_bulk_entities(bookings):
+        """
+        تحميل المستخدمين والمعامل والتجارب المطلوبة دفعة واحدة، مع تقويم صيانة الأجهزة لكل
+        أيام الطلب، لتمريرها إلى validate_booking بدلاً من تحميلها لكل حجز
+        
+        :return: (_BookingEntities، تقويم الصيانة MaintenanceCalendar)
+        """
+        def ids(field):
+            return {b.get(field) for b in bookings if isinstance(b, dict) and isinstance(b.get(field), int)}
+
+        entities = _BookingEntities(
+            {user.Id: user for user in Users.query.filter(Users.Id.in_(ids('user_id'))).all()},
+            {lab.LabId: lab for lab in Laboratories.query.filter(Laboratories.LabId.in_(ids('lab_id'))).all()},
+            {
+                experiment.ExperimentId: experiment
+                for experiment in Experiments.query.filter(Experiments.ExperimentId.in_(ids('experiment_id'))).all()
+            }
+        )
+
+        device_ids = set()
+        days = set()
+        for item in bookings:
+            if not isinstance(item, dict) or not isinstance(item.get('device_ids'), list):
+                continue
+            try:
+                days.add(datetime.strptime(item.get('date'), "%Y-%m-%d").date())
+            except (TypeError, ValueError):
+                continue
+            device_ids.update(device_id for device_id in item['device_ids'] if isinstance(device_id, int))
+        if not days:
+            return entities, MaintenanceCalendar([])
+        return entities, MaintenanceCalendar.for_devices(
+            device_ids,
+            datetime.combine(min(days), datetime.min.time()),
+            datetime.combine(max(days) + timedelta(days=1), datetime.min.time())
+        )
+
+    @staticmethod
+    def persist_accepted_bookings(accepted):
+        """
+        حفظ الحجوزات المقبولة وتحديث الساعات بعملية حفظ واحدة
+        
+        يتم قفل صفوف المعامل والأجهزة المعنية وإعادة التحقق من التداخل مقابل قاعدة البيانات
+        داخل نفس المعاملة، فلا يمكن لطلبين متزامنين أن يحجزا نفس الموعد.
+        
+        :param accepted: قائمة بعناصر (المفتاح، المستخدم، المعمل، التجربة، الأجهزة، عدد الساعات، صفوف الحجز)
+        :return: قاموس {المفتاح: رسالة التعارض} للحجوزات التي سبقها حجز متزامن ولم يتم حفظها
+        """
+        if not accepted:
+            return {}
+        return ReservationService.run_with_retry(
+            lambda: ReservationService._persist_locked(accepted)
+        )
+
+    @staticmethod
+    def _persist_locked(accepted):
+        ReservationService.lock_booking_resources(
+            {lab.LabId for _, _, lab, *_ in accepted},
+            {device.Id for _, _, _, _, devices, *_ in accepted for device in devices}
+        )
+        conflicts = ReservationService.find_committed_conflicts([
+            (position, user.UserType, lab, devices,
+             reservations[0].Date, reservations[0].StartTime, reservations[0].EndTime)
+            for position, user, lab, _, devices, _, reservations in accepted
+        ])
+        if conflicts:
+            # حجوزات كتبتها عملية أخرى ولم تصل إلى الفهرس في هذه العملية
+            reservation_index.invalidate()
+            accepted = [item for item in accepted if item[0] not in conflicts]
+            if not accepted:
+                db.session.rollback()
+                return conflicts
+
+        db.session.add_all([
+            reservation for *_, reservations in accepted for reservation in reservations
+        ])
+
+        # تجميع فروقات الساعات لكل معمل وجهاز وتجربة وتطبيقها بجمل UPDATE مجمعة
+        lab_hours, device_hours, experiment_counts = {}, {}, {}
+        for _, _, lab, experiment, devices, hours_count, _ in accepted:
+            counted = ReservationService.counted_hours(hours_count)
+            lab_hours[lab.LabId] = lab_hours.get(lab.LabId, 0) + counted
+            experiment_counts[experiment.ExperimentId] = experiment_counts.get(experiment.ExperimentId, 0) + 1
+            for device in devices:
+                device_hours[device.Id] = device_hours.get(device.Id, 0) + counted
+        ReservationService.apply_hour_deltas(lab_hours, device_hours, experiment_counts)
+        db.session.commit()
+
+        for _, user, _, _, _, hours_count, reservations in accepted:
+            for reservation in reservations:
+                reservation_index.sync(reservation, user.UserType)
+                device_usage_rates.record(reservation.DeviceId, reservation.Date, hours_count)
+        return conflicts
+
+    @staticmethod
+    def _overlaps(entries, start_time, end_time):
+        return [entry for entry in entries if entry[0] < end_time and entry[1] > start_time]
+
+    @staticmethod
+    def create_reservations_bulk(bookings):
+        """
+        إنشاء مجموعة حجوزات في معاملة واحدة
+        
+        يتم التحقق من كل حجز مقابل قاعدة البيانات ومقابل الحجوزات المقبولة قبله في نفس
+        الطلب، ثم تحفظ كل الحجوزات المقبولة وتحدث ساعات الأجهزة والمعامل والتجارب مرة واحدة.
+        
+        :param bookings: قائمة بالحجوزات بنفس حقول إنشاء الحجز الفردي
+        :return: (نجاح العملية، قائمة بنتيجة كل حجز أو رسالة الخطأ)
+        """
+        try:
+            results = [None] * len(bookings)
+            accepted = []
+
+            # الحجوزات المقبولة داخل الطلب نفسه للتحقق من التداخل فيما بينها
+            batch_labs = {}
+            batch_devices = {}
+
+            entities, calendar = ReservationService._preload_bulk_entities(bookings)
+
+            for position, item in enumerate(bookings):
+                if not isinstance(item, dict):
+                    results[position] = {"index": position, "success": False, "message": "صيغة الحجز غير صحيحة"}
+                    continue
+
+                missing_field = next(
+                    (field for field in ReservationService.BULK_REQUIRED_FIELDS if field not in item), None
+                )
+                if missing_field:
+                    results[position] = {"index": position, "success": False, "message": f"الحقل {missing_field} مطلوب"}
+                    continue
+
+                if not isinstance(item['device_ids'], list) or not item['device_ids']:
+                    results[position] = {"index": position, "success": False, "message": "يجب تحديد جهاز واحد على الأقل"}
+                    continue
+
+                booking_parsed, booking = BookingRequest.parse(
+                    item['user_id'], item['lab_id'], item['experiment_id'], item['device_ids'],
+                    item['date'], item['start_time'], item['end_time'], item['purpose']
+                )
+                if not booking_parsed:
+                    results[position] = {"index": position, "success": False, "message": booking}
+                    continue
+
+                # 1-4. التحقق من المستخدم والمعمل والتجربة والأجهزة مقابل قاعدة البيانات
+                booking_valid, result = ReservationService.validate_booking(
+                    booking, calendar=calendar, entities=entities
+                )
+                if not booking_valid:
+                    results[position] = {"index": position, "success": False, "message": result}
+                    continue
+                user, lab, experiment, devices = result
+
+                # 5. التحقق من التداخل مع الحجوزات المقبولة في نفس الطلب
+                day_key = (booking.lab_id, booking.date)
+                lab_overlaps = ReservationService._overlaps(
+                    batch_labs.get(day_key, []), booking.start_time, booking.end_time
+                )
+                conflict_message = ReservationService.lab_conflict_message(
+                    lab.LabName, user.UserType, [entry[2] for entry in lab_overlaps]
+                )
+                if not conflict_message:
+                    busy_device = next((
+                        device for device in devices
+                        if ReservationService._overlaps(
+                            batch_devices.get((device.Id, booking.date), []), booking.start_time, booking.end_time
+                        )
+                    ), None)
+                    if busy_device:
+                        conflict_message = f"الجهاز {busy_device.Name} محجوز في هذا الوقت"
+                if conflict_message:
+                    results[position] = {"index": position, "success": False, "message": conflict_message}
+                    continue
+
+                batch_labs.setdefault(day_key, []).append((booking.start_time, booking.end_time, user.UserType))
+                for device in devices:
+                    batch_devices.setdefault((device.Id, booking.date), []).append((booking.start_time, booking.end_time))
+
+                accepted.append((
+                    position, user, lab, experiment, devices, booking.hours, booking.build_reservations(devices)
+                ))
+
+            # حفظ كل الحجوزات المقبولة وتحديث الساعات في معاملة واحدة
+            conflicts = ReservationService.persist_accepted_bookings(accepted)
+            for position, *_, reservations in accepted:
+                if position in conflicts:
+                    results[position] = {"index": position, "success": False, "message": conflicts[position]}
+                    continue
+                results[position] = {
+                    "index": position,
+                    "success": True,
+                    "message": "تم إنشاء الحجز بنجاح",
+                    "reservation_id": reservations[0].Id
+                }
+
+            return True, results
+
+        except Exception as e:
+            db.session.rollback()
+            return False, f"حدث خطأ أثناء إنشاء الحجوزات: {str(e)}"
+
+    MAX_RECURRING_OCCURRENCES = 104
+
+    @staticmethod
+    def expand_weekly_series(start_date, occurrences, weekday=None, interval_weeks=1):
+        """توليد تواريخ سلسلة أسبوعية تبدأ من أول يوم مطابق لليوم المطلوب (0 = الاثنين)"""
+        if weekday is not None:
+            start_date += timedelta(days=(weekday - start_date.weekday()) % 7)
+        step = timedelta(weeks=interval_weeks)
+        return [start_date + step * occurrence for occurrence in range(occurrences)]
+
+    @staticmethod
+    def find_series_conflicts(lab, user_type, devices, dates, start_time, end_time):
+        """
+        التحقق من تعارض كل تواريخ السلسلة مع الحجوزات والصيانات
+        
+        يتم جلب الحجوزات (عند تعطيل الفهرس) والصيانات لكل مورد باستعلام نطاق واحد
+        يغطي السلسلة كاملة ثم تفحص كل الحالات في الذاكرة.
+        
+        :return: قاموس {التاريخ: رسالة التعارض} للتواريخ المتعارضة فقط
+        """
+        device_ids = [device.Id for device in devices]
+        lab_bookings = {}
+        device_bookings = {}
+
+        if not ReservationService.use_index():
+            lab_rows = db.session.query(
+                Reservations.Date, Reservations.StartTime, Reservations.EndTime, Users.UserType
+            ).join(Users, Users.Id == Reservations.UserId).filter(
+                Reservations.LabId == lab.LabId,
+                Reservations.IsAllowed == True,
+                Reservations.Date.in_(dates)
+            ).all()
+            for row in lab_rows:
+                lab_bookings.setdefault(row.Date, []).append((row.StartTime, row.EndTime, row.UserType))
+
+            device_rows = db.session.query(
+                Reservations.DeviceId, Reservations.Date, Reservations.StartTime, Reservations.EndTime
+            ).filter(
+                Reservations.DeviceId.in_(device_ids),
+                Reservations.IsAllowed == True,
+                Reservations.Date.in_(dates)
+            ).all()
+            for row in device_rows:
+                device_bookings.setdefault((row.DeviceId, row.Date), []).append((row.StartTime, row.EndTime))
+
+        # الصيانات غير المكتملة التي تتقاطع مع نطاق السلسلة
+        calendar = MaintenanceCalendar.for_devices(
+            device_ids,
+            datetime.combine(dates[0], start_time),
+            datetime.combine(dates[-1], end_time)
+        )
+
+        conflicts = {}
+        for reservation_date in dates:
+            if ReservationService.use_index():
+                lab_user_types = [
+                    entry.user_type for entry in reservation_index.find_lab_overlaps(
+                        lab.LabId, reservation_date, start_time, end_time
+                    )
+                ]
+                reserved_device_ids = reservation_index.find_reserved_devices(
+                    device_ids, reservation_date, start_time, end_time
+                )
+            else:
+                lab_user_types = [
+                    entry[2] for entry in ReservationService._overlaps(
+                        lab_bookings.get(reservation_date, []), start_time, end_time
+                    )
+                ]
+                reserved_device_ids = {
+                    device_id for device_id in device_ids
+                    if ReservationService._overlaps(
+                        device_bookings.get((device_id, reservation_date), []), start_time, end_time
+                    )
+                }
+
+            message = ReservationService.lab_conflict_message(lab.LabName, user_type, lab_user_types)
+            booking_start = datetime.combine(reservation_date, start_time)
+            booking_end = datetime.combine(reservation_date, end_time)
+            for device in devices:
+                if message:
+                    break
+                if device.Id in reserved_device_ids:
+                    message = f"الجهاز {device.Name} محجوز في هذا الوقت"
+                elif calendar.is_blocked(device.Id, booking_start, booking_end):
+                    message = f"الجهاز {device.Name} في الصيانة في هذا الوقت"
+
+            if message:
+                conflicts[reservation_date] = message
+
+        return conflicts
+
+    @staticmethod
+    def create_recurring_reservations(user_id, lab_id, experiment_id, device_ids, start_date_str, occurrences,
+                                      start_time_str, end_time_str, purpose, weekday=None, interval_weeks=1):
+        """
+        إنشاء سلسلة حجوزات أسبوعية، مثلاً كل ثلاثاء من 10:00 إلى 12:00 لمدة 14 أسبوع
+        
+        يتم التحقق من المستخدم والمعمل والتجربة والأجهزة مرة واحدة للسلسلة، ثم فحص تعارض
+        كل التواريخ دفعة واحدة، وحفظ التواريخ المقبولة في معاملة واحدة.
+        
+        :return: (نجاح العملية، قائمة بنتيجة كل تاريخ أو رسالة الخطأ)
+        """
+        try:
+            try:
+                start_date = datetime.strptime(start_date_str, "%Y-%m-%d").date()
+                start_time = datetime.strptime(start_time_str, "%H:%M").time()
+                end_time = datetime.strptime(end_time_str, "%H:%M").time()
+                occurrences = int(occurrences)
+                interval_weeks = int(interval_weeks)
+                weekday = int(weekday) if weekday is not None else None
+            except (TypeError, ValueError):
+                return False, "صيغة التاريخ أو الوقت أو التكرار غير صحيحة"
+
+            if start_time >= end_time:
+                return False, "وقت البداية يجب أن يكون قبل وقت النهاية"
+
+            max_occurrences = ReservationService.MAX_RECURRING_OCCURRENCES
+            if not 1 <= occurrences <= max_occurrences:
+                return False, f"عدد مرات التكرار يجب أن يكون بين 1 و {max_occurrences}"
+            if interval_weeks < 1:
+                return False, "الفاصل بين الحجوزات يجب أن يكون أسبوعاً واحداً على الأقل"
+            if weekday is not None and not 0 <= weekday <= 6:
+                return False, "اليوم يجب أن يكون رقماً بين 0 (الاثنين) و 6 (الأحد)"
+            if not isinstance(device_ids, list) or not device_ids:
+                return False, "يجب تحديد جهاز واحد على الأقل"
+
+            dates = ReservationService.expand_weekly_series(start_date, occurrences, weekday, interval_weeks)
+            if dates[0] < date.today():
+                return False, "لا يمكن الحجز في تاريخ سابق"
+
+            # 1-4. التحقق الثابت من المستخدم والمعمل والتجربة والأجهزة مرة واحدة للسلسلة
+            booking_valid, result = ReservationService.validate_booking(
+                BookingRequest(user_id, lab_id, experiment_id, device_ids, dates[0], start_time, end_time, purpose),
+                check_availability=False
+            )
+            if not booking_valid:
+                return False, result
+            user, lab, experiment, devices = result
+
+            # 5. فحص تعارض كل تواريخ السلسلة دفعة واحدة
+            conflicts = ReservationService.find_series_conflicts(
+                lab, user.UserType, devices, dates, start_time, end_time
+            )
+
+            results = []
+            accepted = []
+            for position, reservation_date in enumerate(dates):
+                if reservation_date in conflicts:
+                    results.append({
+                        "date": reservation_date.strftime("%Y-%m-%d"),
+                        "success": False,
+                        "message": conflicts[reservation_date]
+                    })
+                    continue
+
+                booking = BookingRequest(
+                    user.Id, lab_id, experiment_id, device_ids, reservation_date, start_time, end_time, purpose
+                )
+                results.append(None)
+                accepted.append((
+                    position, user, lab, experiment, devices, booking.hours, booking.build_reservations(devices)
+                ))
+
+            # 6. حفظ التواريخ المقبولة في معاملة واحدة
+            conflicts = ReservationService.persist_accepted_bookings(accepted)
+            for position, *_, reservations in accepted:
+                if position in conflicts:
+                    results[position] = {
+                        "date": dates[position].strftime("%Y-%m-%d"),
+                        "success": False,
+                        "message": conflicts[position]
+                    }
+                    continue
+                results[position] = {
+                    "date": dates[position].strftime("%Y-%m-%d"),
+                    "success": True,
+                    "message": "تم إنشاء الحجز بنجاح",
+                    "reservation_id": reservations[0].Id
+                }
+
+            return True, results
+
+        except Exception as e:
+            db.session.rollback()
+            return False, f"حدث خطأ أثناء إنشاء سلسلة الحجوزات: {str(e)}"
+
+    # أنواع العدادات في HourCounterBaselines
+    COUNTER_LAB = 'lab'
+    COUNTER_EXPERIMENT = 'experiment'
+    COUNTER_DEVICE = 'device'
+
+    @staticmethod
+    def reconcile_hours(apply=False):
+        """
+        مطابقة عدادات الاستخدام مع جدول الحجوزات لإصلاح أي انحراف
+        
+        - Laboratories.UsageHours: ساعات الحجوزات المسموحة (الحجز لعدة أجهزة يحسب مرة واحدة)
+        - Experiments.CompletedCount: عدد الحجوزات المسموحة للتجربة
+        - Devices.CurrentHour: ساعات حجوزات الجهاز منذ آخر صيانة له
+        ساعات كل صف تحسب بـ counted_hours كما تضاف عند الحجز.
+        
+        العدادات قد تتضمن ساعات غير مسجلة في الحجوزات (إدخال يدوي أو استيراد أو ما قبل التطبيق)، لذلك
+        القيمة المتوقعة هي خط الأساس المحفوظ في HourCounterBaselines زائد مجموع الحجوزات. العداد بدون
+        خط أساس (أو الجهاز الذي تغير تاريخ آخر صيانة له) لا يقارن، ويحفظ خط أساسه عند apply=True على
+        أنه الفرق الحالي بين العداد والحجوزات.
+        لا يتم تعديل TotalOperatingHours لأنه يتضمن ساعات تشغيل سابقة غير مسجلة في الحجوزات.
+        
+        :param apply: حفظ القيم المصححة وخطوط الأساس الجديدة، وإلا يتم إرجاع الانحراف فقط
+        :return: قاموس بالعناصر المنحرفة لكل نوع عداد، وعدد العدادات بدون خط أساس (new_baselines)
+        """
+        lab_hours, experiment_counts, device_hours = {}, {}, {}
+        seen_bookings = set()
+        last_maintenance = dict(db.session.query(Devices.Id, Devices.LastMaintenanceDate).all())
+
+        rows = db.session.query(
+            Reservations.UserId,
+            Reservations.LabId,
+            Reservations.ExperimentId,
+            Reservations.DeviceId,
+            Reservations.Date,
+            Reservations.StartTime,
+            Reservations.EndTime
+        ).filter(Reservations.IsAllowed == True).yield_per(5000)
+
+        for row in rows:
+            hours = ReservationService.counted_hours(
+                ReservationService.hours_between(row.Date, row.StartTime, row.EndTime)
+            )
+
+            since = last_maintenance.get(row.DeviceId)
+            if since is None or row.Date >= since.date():
+                device_hours[row.DeviceId] = device_hours.get(row.DeviceId, 0) + hours
+
+            # صفوف الحجز الواحد لعدة أجهزة تضيف ساعات المعمل والتجربة مرة واحدة
+            booking = (row.UserId, row.LabId, row.ExperimentId, row.Date, row.StartTime, row.EndTime)
+            if booking not in seen_bookings:
+                seen_bookings.add(booking)
+                lab_hours[row.LabId] = lab_hours.get(row.LabId, 0) + hours
+                experiment_counts[row.ExperimentId] = experiment_counts.get(row.ExperimentId, 0) + 1
+
+        baselines = {(row.Kind, row.EntityId): row for row in HourCounterBaselines.query.all()}
+        new_baselines = []
+        now = datetime.now()
+
+        def drift(kind, current_rows, expected, maintenance_dates=None):
+            items = []
+            for entity_id, current in current_rows:
+                reservation_total = expected.get(entity_id, 0)
+                maintenance_date = (maintenance_dates or {}).get(entity_id)
+                baseline = baselines.get((kind, entity_id))
+                if baseline is None or baseline.LastMaintenanceDate != maintenance_date:
+                    new_baselines.append({
+                        "Kind": kind, "EntityId": entity_id, "Baseline": current - reservation_total,
+                        "LastMaintenanceDate": maintenance_date, "CapturedAt": now,
+                        "exists": baseline is not None
+                    })
+                elif current - baseline.Baseline != reservation_total:
+                    items.append({
+                        "id": entity_id, "current": current, "baseline": baseline.Baseline,
+                        "expected": baseline.Baseline + reservation_total
+                    })
+            return items
+
+        report = {
+            "labs": drift(
+                ReservationService.COUNTER_LAB,
+                db.session.query(Laboratories.LabId, Laboratories.UsageHours).all(),
+                lab_hours
+            ),
+            "experiments": drift(
+                ReservationService.COUNTER_EXPERIMENT,
+                db.session.query(Experiments.ExperimentId, Experiments.CompletedCount).all(),
+                experiment_counts
+            ),
+            "devices": drift(
+                ReservationService.COUNTER_DEVICE,
+                db.session.query(Devices.Id, Devices.CurrentHour).all(),
+                device_hours,
+                last_maintenance
+            ),
+            "new_baselines": len(new_baselines),
+            "applied": False
+        }
+
+        if apply and new_baselines:
+            inserted, updated = [], []
+            for item in new_baselines:
+                (updated if item.pop("exists") else inserted).append(item)
+            if inserted:
+                db.session.execute(insert(HourCounterBaselines), inserted)
+            if updated:
+                db.session.execute(update(HourCounterBaselines), updated)
+
+        if apply and (report["labs"] or report["experiments"] or report["devices"] or new_baselines):
+            if report["labs"]:
+                db.session.execute(update(Laboratories), [
+                    {"LabId": item["id"], "UsageHours": item["expected"]} for item in report["labs"]
+                ])
+            if report["experiments"]:
+                db.session.execute(update(Experiments), [
+                    {"ExperimentId": item["id"], "CompletedCount": item["expected"]} for item in report["experiments"]
+                ])
+            if report["devices"]:
+                db.session.execute(update(Devices), [
+                    {"Id": item["id"], "CurrentHour": item["expected"]} for item in report["devices"]
+                ])
+                ReportSnapshotService.mark_changed(
+                    ReportSnapshotService.CHANGED_DEVICE, [item["id"] for item in report["devices"]]
+                )
+            db.session.commit()
+            report["applied"] = True
+            logger.info(
+                f"تم تصحيح العدادات: {len(report['labs'])} معمل، "
+                f"{len(report['experiments'])} تجربة، {len(report['devices'])} جهاز، "
+                f"وحفظ {len(new_baselines)} خط أساس"
+            )
+
+        return report
+
+
+class ReservationAttemptService:
+    """
+    سجل محاولات الحجز المرفوضة
+    
+    المحاولات المرفوضة لا تحفظ في جدول الحجوزات حتى لا تكبر استعلامات التداخل، بل في سجل
+    منفصل يضغط دورياً إلى عدد المحاولات لكل (مستخدم، معمل، يوم) بعد مدة الاحتفاظ.
+    """
+
+    LEGACY_BATCH_SIZE = 1000
+
+    @staticmethod
+    def record_attempt(booking, reason):
+        """تسجيل محاولة حجز مرفوضة وإرجاع رقمها"""
+        attempt = ReservationAttempts(
+            UserId=booking.user_id,
+            LabId=booking.lab_id,
+            ExperimentId=booking.experiment_id,
+            DeviceIds=",".join(str(device_id) for device_id in booking.device_ids),
+            Date=booking.date,
+            StartTime=booking.start_time,
+            EndTime=booking.end_time,
+            Purpose=booking.purpose,
+            Reason=reason,
+            CreatedAt=datetime.now()
+        )
+        db.session.add(attempt)
+        db.session.commit()
+        return attempt.Id
+
+    @staticmethod
+    def migrate_legacy_rejections():
+        """
+        نقل الحجوزات المرفوضة القديمة (IsAllowed=False) من جدول الحجوزات إلى سجل المحاولات
+        
+        :return: عدد الصفوف المنقولة
+        """
+        moved = 0
+        while True:
+            rows = Reservations.query.filter(
+                Reservations.IsAllowed == False
+            ).order_by(Reservations.Id).limit(ReservationAttemptService.LEGACY_BATCH_SIZE).all()
+            if not rows:
+                return moved
+
+            db.session.add_all([
+                ReservationAttempts(
+                    UserId=row.UserId,
+                    LabId=row.LabId,
+                    ExperimentId=row.ExperimentId,
+                    DeviceIds=str(row.DeviceId),
+                    Date=row.Date,
+                    StartTime=row.StartTime,
+                    EndTime=row.EndTime,
+                    Purpose=row.Purpose,
+                    Reason="حجز مرفوض (منقول من جدول الحجوزات)",
+                    # لا يوجد وقت إنشاء للحجز القديم، فيستخدم موعده
+                    CreatedAt=datetime.combine(row.Date, row.StartTime)
+                )
+                for row in rows
+            ])
+            Reservations.query.filter(
+                Reservations.Id.in_([row.Id for row in rows])
+            ).delete(synchronize_session=False)
+            db.session.commit()
+            moved += len(rows)
+
+    @staticmethod
+    def compact(retention_days=None):
+        """
+        ضغط المحاولات الأقدم من مدة الاحتفاظ إلى عدد يومي ثم حذفها من السجل
+        
+        :param retention_days: مدة الاحتفاظ بالأيام (الافتراضي من الإعدادات)
+        :return: قاموس بعدد الصفوف المنقولة والمضغوطة
+        """
+        if retention_days is None:
+            retention_days = current_app.config.get('RESERVATION_ATTEMPTS_RETENTION_DAYS', 30)
+
+        migrated = ReservationAttemptService.migrate_legacy_rejections()
+
+        cutoff = datetime.now() - timedelta(days=retention_days)
+        max_id = db.session.query(func.max(ReservationAttempts.Id)).filter(
+            ReservationAttempts.CreatedAt < cutoff
+        ).scalar()
+        if max_id is None:
+            return {"migrated": migrated, "compacted": 0, "groups": 0}
+
+        old_attempts = and_(ReservationAttempts.CreatedAt < cutoff, ReservationAttempts.Id <= max_id)
+        groups = db.session.query(
+            ReservationAttempts.UserId,
+            ReservationAttempts.LabId,
+            ReservationAttempts.Date,
+            func.count(ReservationAttempts.Id),
+            func.max(ReservationAttempts.CreatedAt)
+        ).filter(old_attempts).group_by(
+            ReservationAttempts.UserId, ReservationAttempts.LabId, ReservationAttempts.Date
+        ).all()
+
+        existing = {
+            (stats.UserId, stats.LabId, stats.Date): stats
+            for stats in ReservationAttemptDailyStats.query.filter(
+                ReservationAttemptDailyStats.UserId.in_({row[0] for row in groups}),
+                ReservationAttemptDailyStats.Date.in_({row[2] for row in groups})
+            ).all()
+        }
+        for user_id, lab_id, attempt_date, attempt_count, last_attempt_at in groups:
+            stats = existing.get((user_id, lab_id, attempt_date))
+            if stats:
+                stats.AttemptCount += attempt_count
+                if not stats.LastAttemptAt or last_attempt_at > stats.LastAttemptAt:
+                    stats.LastAttemptAt = last_attempt_at
+            else:
+                db.session.add(ReservationAttemptDailyStats(
+                    UserId=user_id,
+                    LabId=lab_id,
+                    Date=attempt_date,
+                    AttemptCount=attempt_count,
+                    LastAttemptAt=last_attempt_at
+                ))
+
+        compacted = ReservationAttempts.query.filter(old_attempts).delete(synchronize_session=False)
+        db.session.commit()
+
+        logger.info(f"تم ضغط {compacted} محاولة حجز مرفوضة في {len(groups)} مجموعة يومية")
+        return {"migrated": migrated, "compacted": compacted, "groups": len(groups)}
+
+    @staticmethod
+    def get_daily_counts(from_str=None, to_str=None, lab_id=None, user_id=None):
+        """
+        عدد المحاولات المرفوضة لكل (مستخدم، معمل، يوم) من السجل والإحصائيات المضغوطة معاً
+        
+        :return: (نجاح العملية، قائمة النتائج أو رسالة الخطأ)
+        """
+        try:
+            first_day = datetime.strptime(from_str, "%Y-%m-%d").date() if from_str else None
+            last_day = datetime.strptime(to_str, "%Y-%m-%d").date() if to_str else None
+        except ValueError:
+            return False, "صيغة التاريخ غير صحيحة، استخدم YYYY-MM-DD"
+
+        try:
+            def filtered(query, model):
+                if first_day:
+                    query = query.filter(model.Date >= first_day)
+                if last_day:
+                    query = query.filter(model.Date <= last_day)
+                if lab_id:
+                    query = query.filter(model.LabId == lab_id)
+                if user_id:
+                    query = query.filter(model.UserId == user_id)
+                return query
+
+            counts = {}
+            live_rows = filtered(db.session.query(
+                ReservationAttempts.UserId,
+                ReservationAttempts.LabId,
+                ReservationAttempts.Date,
+                func.count(ReservationAttempts.Id),
+                func.max(ReservationAttempts.CreatedAt)
+            ), ReservationAttempts).group_by(
+                ReservationAttempts.UserId, ReservationAttempts.LabId, ReservationAttempts.Date
+            ).all()
+            compacted_rows = filtered(db.session.query(
+                ReservationAttemptDailyStats.UserId,
+                ReservationAttemptDailyStats.LabId,
+                ReservationAttemptDailyStats.Date,
+                ReservationAttemptDailyStats.AttemptCount,
+                ReservationAttemptDailyStats.LastAttemptAt
+            ), ReservationAttemptDailyStats).all()
+
+            for key_user, key_lab, attempt_date, attempt_count, last_attempt_at in list(live_rows) + list(compacted_rows):
+                key = (key_user, key_lab, attempt_date)
+                count, last = counts.get(key, (0, None))
+                counts[key] = (
+                    count + attempt_count,
+                    max(filter(None, (last, last_attempt_at)), default=None)
+                )
+
+            return True, [
+                {
+                    "user_id": key_user,
+                    "lab_id": key_lab,
+                    "date": attempt_date.strftime("%Y-%m-%d"),
+                    "attempt_count": count,
+                    "last_attempt_at": last.strftime("%Y-%m-%d %H:%M:%S") if last else None
+                }
+                for (key_user, key_lab, attempt_date), (count, last) in sorted(
+                    counts.items(), key=lambda item: (item[0][2], item[0][1] or 0, item[0][0])
+                )
+            ]
+
+        except Exception as e:
+            return False, f"حدث خطأ أثناء جلب إحصائيات محاولات الحجز: {str(e)}"
+
+
+class AvailabilityService:
+    """البحث عن الفترات الحرة للمعامل والأجهزة بدلاً من تجربة الحجز حتى ينجح"""
+
+    MAX_RANGE_DAYS = 31
+
+    @staticmethod
+    def parse_range(from_str, to_str, day_start_str, day_end_str, min_minutes):
+        """التحقق من معاملات البحث وتحويلها"""
+        try:
+            first_day = datetime.strptime(from_str, "%Y-%m-%d").date() if from_str else date.today()
+            last_day = datetime.strptime(to_str, "%Y-%m-%d").date() if to_str else first_day
+        except ValueError:
+            return False, "صيغة التاريخ غير صحيحة، استخدم YYYY-MM-DD"
+        try:
+            day_start = datetime.strptime(day_start_str, "%H:%M").time()
+            day_end = datetime.strptime(day_end_str, "%H:%M").time()
+        except ValueError:
+            return False, "صيغة الوقت غير صحيحة، استخدم HH:MM"
+        try:
+            min_minutes = int(min_minutes or 0)
+        except (TypeError, ValueError):
+            return False, "المدة الدنيا يجب أن تكون عدداً صحيحاً بالدقائق"
+
+        if first_day < date.today():
+            return False, "لا يمكن البحث في تاريخ سابق"
+        if last_day < first_day:
+            return False, "تاريخ النهاية يجب أن يكون بعد تاريخ البداية"
+        if (last_day - first_day).days + 1 > AvailabilityService.MAX_RANGE_DAYS:
+            return False, f"أقصى مدة للبحث {AvailabilityService.MAX_RANGE_DAYS} يوم"
+        if day_start >= day_end:
+            return False, "بداية اليوم يجب أن تكون قبل نهايته"
+        if min_minutes < 0:
+            return False, "المدة الدنيا يجب أن تكون عدداً موجباً"
+
+        return True, (first_day, last_day, day_start, day_end, min_minutes)
+
+    @staticmethod
+    def merge_busy(busy):
+        """دمج الفترات المشغولة المرتبة في فترات متتالية غير متداخلة"""
+        merged = []
+        for busy_start, busy_end in busy:
+            if merged and busy_start <= merged[-1][1]:
+                if busy_end > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], busy_end)
+            else:
+                merged.append((busy_start, busy_end))
+        return merged
+
+    @staticmethod
+    def sweep_free_slots(merged, merged_ends, window_start, window_end, min_minutes):
+        """حساب الفجوات بين الفترات المشغولة المدمجة داخل نافذة اليوم"""
+        slots = []
+        cursor = window_start
+        # أول فترة تنتهي بعد بداية النافذة (نهايات الفترات المدمجة مرتبة)
+        for busy_start, busy_end in merged[bisect.bisect_right(merged_ends, window_start):]:
+            if busy_start >= window_end:
+                break
+            if busy_start > cursor:
+                slots.append((cursor, busy_start))
+            cursor = max(cursor, busy_end)
+        if cursor < window_end:
+            slots.append((cursor, window_end))
+
+        minimum = timedelta(minutes=min_minutes)
+        return [(start, end) for start, end in slots if end - start >= minimum]
+
+    @staticmethod
+    def get_free_slots(resource_type, resource_id, from_str=None, to_str=None, min_minutes=0,
+                       day_start_str=None, day_end_str=None):
+        """
+        الفترات الحرة لمعمل أو جهاز في مدى من الأيام
+        
+        :param resource_type: "lab" أو "device"
+        :param resource_id: رقم المعمل أو الجهاز
+        :param min_minutes: أقل مدة للفترة الحرة بالدقائق
+        :return: (نجاح العملية، النتيجة أو رسالة الخطأ)
+        """
+        try:
+            valid, parsed = AvailabilityService.parse_range(
+                from_str, to_str,
+                day_start_str or current_app.config.get('FREE_SLOTS_DAY_START', "08:00"),
+                day_end_str or current_app.config.get('FREE_SLOTS_DAY_END', "22:00"),
+                min_minutes
+            )
+            if not valid:
+                return False, parsed
+            first_day, last_day, day_start, day_end, min_minutes = parsed
+            range_start = datetime.combine(first_day, datetime.min.time())
+            range_end = datetime.combine(last_day + timedelta(days=1), datetime.min.time())
+
+            if resource_type == "lab":
+                lab = Laboratories.query.get(resource_id)
+                if not lab:
+                    return False, "المعمل غير موجود"
+                if lab.Status != "متاح":
+                    return False, f"المعمل غير متاح حالياً. الحالة: {lab.Status}"
+                reservation_filter = Reservations.LabId == resource_id
+                calendar = MaintenanceCalendar.for_lab(resource_id, range_start, range_end)
+            else:
+                device = Devices.query.get(resource_id)
+                if not device:
+                    return False, f"الجهاز رقم {resource_id} غير موجود"
+                if not DeviceStatusService.is_available(device.Status):
+                    return False, f"الجهاز {device.Name} غير متاح حالياً. الحالة: {device.Status}"
+                reservation_filter = Reservations.DeviceId == resource_id
+                calendar = MaintenanceCalendar.for_devices([resource_id], range_start, range_end)
+
+            # الحجوزات المسموحة في المدى مرتبة حسب البداية
+            busy = [
+                (datetime.combine(row.Date, row.StartTime), datetime.combine(row.Date, row.EndTime))
+                for row in db.session.query(
+                    Reservations.Date, Reservations.StartTime, Reservations.EndTime
+                ).filter(
+                    reservation_filter,
+                    Reservations.IsAllowed == True,
+                    Reservations.Date >= first_day,
+                    Reservations.Date <= last_day
+                ).order_by(Reservations.Date, Reservations.StartTime).all()
+            ]
+
+            # فترات الصيانة غير المكتملة التي تتقاطع مع المدى
+            busy.extend(calendar.windows(resource_id))
+            merged = AvailabilityService.merge_busy(sorted(busy))
+            merged_ends = [busy_end for _, busy_end in merged]
+
+            days = []
+            current_day = first_day
+            while current_day <= last_day:
+                window_start = datetime.combine(current_day, day_start)
+                window_end = datetime.combine(current_day, day_end)
+                slots = AvailabilityService.sweep_free_slots(
+                    merged, merged_ends, window_start, window_end, min_minutes
+                )
+                days.append({
+                    "date": current_day.strftime("%Y-%m-%d"),
+                    "free_slots": [
+                        {
+                            "start_time": start.strftime("%H:%M"),
+                            "end_time": end.strftime("%H:%M"),
+                            "minutes": int((end - start).total_seconds() // 60)
+                        }
+                        for start, end in slots
+                    ]
+                })
+                current_day += timedelta(days=1)
+
+            return True, {
+                f"{resource_type}_id": resource_id,
+                "from": first_day.strftime("%Y-%m-%d"),
+                "to": last_day.strftime("%Y-%m-%d"),
+                "min_minutes": min_minutes,
+                "days": days
+            }
+
+        except Exception as e:
+            return False, f"حدث خطأ أثناء البحث عن الفترات الحرة: {str(e)}"
+
+
+class DeviceStatusService:
+    """
+    توحيد حالات الأجهزة
+    
+    تكتب الحالة يدوياً فتصل بمسافات زائدة وبتهجئات مختلفة ("فى الصيانة"، "قيد الصيانة")، لذلك تحفظ
+    صيغتها الموحدة في العمود NormalizedStatus عند كل حفظ وتتم التصفية عليه بالمساواة أو IN.
+    """
+
+    AVAILABLE = "متاح"
+    IN_MAINTENANCE = "في الصيانة"
+    UNAVAILABLE = "غير متاح"
+
+    # التهجئات الأخرى لنفس الحالة (بعد إزالة المسافات الزائدة)
+    ALIASES = {
+        "فى الصيانة": IN_MAINTENANCE,
+        "قيد الصيانة": IN_MAINTENANCE,
+    }
+
+    # الحالات التي تستبعد من تقرير الصيانة والتوقعات واقتراح البدائل
+    OUT_OF_SERVICE = (IN_MAINTENANCE, UNAVAILABLE)
+
+    MAX_LENGTH = 50
+
+    @staticmethod
+    def normalize(status):
+        """الصيغة الموحدة للحالة، والحالات غير المعروفة تحفظ كما هي بعد إزالة المسافات الزائدة"""
+        if status is None:
+            return None
+        collapsed = " ".join(status.split())
+        return DeviceStatusService.ALIASES.get(collapsed, collapsed)[:DeviceStatusService.MAX_LENGTH]
+
+    @staticmethod
+    def is_available(status):
+        return DeviceStatusService.normalize(status) == DeviceStatusService.AVAILABLE
+
+    @staticmethod
+    def excluding(statuses):
+        """
+        شرط استبعاد حالات موحدة، والأجهزة المضافة من خارج التطبيق ولم تحسب حالتها الموحدة بعد
+        لا تستبعد حتى تحسبها المزامنة الدورية
+        """
+        return or_(Devices.NormalizedStatus.is_(None), Devices.NormalizedStatus.notin_(statuses))
+
+    @staticmethod
+    def sync(connection):
+        """
+        حساب الحالة الموحدة للأجهزة التي تختلف حالتها المحفوظة عن المتوقعة
+        
+        الحالات المختلفة قليلة، فيكفي تحديث واحد لكل حالة نصية بدلاً من المرور على الأجهزة.
+        :return: عدد الأجهزة المحدثة
+        """
+        updated = 0
+        pairs = connection.execute(select(Devices.Status, Devices.NormalizedStatus).distinct()).all()
+        for status, normalized in pairs:
+            expected = DeviceStatusService.normalize(status)
+            if normalized == expected:
+                continue
+            result = connection.execute(
+                update(Devices)
+                .where(
+                    Devices.Status == status,
+                    or_(Devices.NormalizedStatus.is_(None), Devices.NormalizedStatus != expected)
+                )
+                .values(NormalizedStatus=expected)
+            )
+            updated += max(result.rowcount, 0)
+        return updated
+
+    @staticmethod
+    def sync_all():
+        """مزامنة الحالات الموحدة من مهمة مجدولة لالتقاط الأجهزة التي تكتبها أنظمة أخرى مباشرة"""
+        updated = DeviceStatusService.sync(db.session.connection())
+        db.session.commit()
+        if updated:
+            logger.info(f"تم توحيد حالة {updated} جهاز")
+        return updated
+
+
+@event.listens_for(Devices, 'before_insert')
+@event.listens_for(Devices, 'before_update')
+def _normalize_device_status(mapper, connection, target):
+    target.NormalizedStatus = DeviceStatusService.normalize(target.Status)
+
+
+class MaintenanceSummaryService:
+    """
+    صيانة جدولي الملخص MaintenanceSummaries وCategoryMaintenanceSummaries
+    
+    يحدثان لكل جهاز أو فئة تتغير صياناتها عند كل flush لجلسة قاعدة البيانات، ويعاد بناؤهما
+    بالكامل من مهمة مجدولة لالتقاط الصيانات التي تكتبها أنظمة أخرى مباشرة في الجدول.
+    """
+
+    _lock = threading.Lock()
+    _checked = False
+
+    @staticmethod
+    def ranked_maintenances(partition_column, condition=None):
+        """
+        آخر صيانة لكل (مفتاح، نوع) مع عدد الصيانات: الأحدث حسب EndAt، والصيانات بدون تاريخ انتهاء
+        تأتي بعدها بنفس الترتيب في كل قواعد البيانات
+        """
+        ranked = select(
+            partition_column.label("key"),
+            Maintenances.Type,
+            Maintenances.EndAt,
+            Maintenances.Cost,
+            func.row_number().over(
+                partition_by=(partition_column, Maintenances.Type),
+                order_by=(case((Maintenances.EndAt.is_(None), 1), else_=0), Maintenances.EndAt.desc(), Maintenances.Id.desc())
+            ).label("rank"),
+            func.count(Maintenances.Id).over(
+                partition_by=(partition_column, Maintenances.Type)
+            ).label("maintenance_count")
+        ).select_from(Maintenances).join(Devices, Devices.Id == Maintenances.DeviceId)
+        if condition is not None:
+            ranked = ranked.where(condition)
+        ranked = ranked.subquery()
+        return select(
+            ranked.c.key, ranked.c.Type, ranked.c.EndAt, ranked.c.Cost, ranked.c.maintenance_count
+        ).where(ranked.c.rank == 1)
 
     @staticmethod
-    def add_reservation_hours(reservation, devices, lab, experiment, hours):
-        """إضافة ساعات الحجز"""
-        # إضافة ساعات المعمل
-        lab.UsageHours += hours
-        lab.TotalOperatingHours += hours
-        
-        # إضافة ساعات الأجهزة
-        for device in devices:
-            device.CurrentHour += hours
-            device.TotalOperatingHours += hours
-            
-        # زيادة عدد مرات إجراء التجربة
-        experiment.CompletedCount += 1
+    def refresh(connection, device_ids=None, categories=None):
+        """
+        إعادة حساب صفوف الملخص للأجهزة والفئات المحددة (أو كل الصفوف عند عدم التحديد)
         
-        db.session.commit()
+        :param connection: اتصال المعاملة الحالية حتى يحفظ الملخص مع تعديل الصيانات
+        """
+        targets = (
+            (MaintenanceSummaries, MaintenanceSummaries.DeviceId, Devices.Id, device_ids),
+            (CategoryMaintenanceSummaries, CategoryMaintenanceSummaries.CategoryName, Devices.CategoryName, categories)
+        )
+        for summary, key_column, partition_column, keys in targets:
+            if keys is not None and not keys:
+                continue
+            remove = delete(summary)
+            condition = None
+            if keys is not None:
+                remove = remove.where(key_column.in_(keys))
+                condition = partition_column.in_(keys)
+            connection.execute(remove)
+            connection.execute(insert(summary).from_select(
+                [key_column.key, 'Type', 'LastEndAt', 'LastCost', 'MaintenanceCount'],
+                MaintenanceSummaryService.ranked_maintenances(partition_column, condition)
+            ))
 
     @staticmethod
-    def update_reservation(reservation_id, update_data):
-        try:
-            # الحصول على الحجز الحالي
-            reservation = Reservations.query.get(reservation_id)
-            if not reservation:
-                return False, "الحجز غير موجود"
-
-            # التحقق من نوع المستخدم
-            user_valid, user = ReservationService.validate_user_type(reservation.UserId)
-            if not user_valid:
-                return False, user
-
-            # تحديد البيانات المطلوب تحديثها
-            lab_id = update_data.get('lab_id', reservation.LabId)
-            experiment_id = update_data.get('experiment_id', reservation.ExperimentId)
-            device_ids = update_data.get('device_ids', [reservation.DeviceId])
-            date_str = update_data.get('date', reservation.Date.strftime("%Y-%m-%d"))
-            start_time_str = update_data.get('start_time', reservation.StartTime.strftime("%H:%M"))
-            end_time_str = update_data.get('end_time', reservation.EndTime.strftime("%H:%M"))
-            purpose = update_data.get('purpose', reservation.Purpose)
-
-            # التحقق من توفر المعمل
-            lab_valid, lab = ReservationService.validate_lab_availability(
-                lab_id, user.UserType, date_str, start_time_str, end_time_str, reservation.Id
-            )
-            if not lab_valid:
-                return False, lab
+    def rebuild():
+        """إعادة بناء جدولي الملخص بالكامل من جدول الصيانات"""
+        MaintenanceSummaryService.refresh(db.session.connection())
+        db.session.commit()
+        MaintenanceSummaryService._checked = True
+        logger.info("تم إعادة بناء ملخص الصيانات")
 
-            # التحقق من التجربة
-            exp_valid, experiment = ReservationService.validate_experiment(
-                experiment_id, lab_id, user.UserType
-            )
-            if not exp_valid:
-                return False, experiment
+    @staticmethod
+    def ensure_built():
+        """بناء الملخص عند أول استخدام إذا كان فارغاً والجدول يحتوي على صيانات (مثلاً بعد إنشائه)"""
+        if MaintenanceSummaryService._checked:
+            return
+        with MaintenanceSummaryService._lock:
+            if MaintenanceSummaryService._checked:
+                return
+            summary_empty = db.session.query(MaintenanceSummaries.Id).first() is None
+            if summary_empty and db.session.query(Maintenances.Id).filter(Maintenances.DeviceId != None).first():
+                MaintenanceSummaryService.rebuild()
+            MaintenanceSummaryService._checked = True
 
-            # التحقق من الأجهزة
-            devices_valid, devices = ReservationService.validate_devices(
-                device_ids, experiment_id, date_str, start_time_str, end_time_str, reservation.Id
-            )
-            if not devices_valid:
-                return False, devices
+    @staticmethod
+    def changed_keys(session):
+        """الأجهزة والفئات التي تغيرت صياناتها (أو فئتها) في هذا الـ flush"""
+        device_ids, categories = set(), set()
+        summary_fields = ('DeviceId', 'Type', 'EndAt', 'Cost')
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            state = inspect(obj)
+            if isinstance(obj, Maintenances):
+                if obj in session.dirty and not any(state.attrs[field].history.has_changes() for field in summary_fields):
+                    continue
+                history = state.attrs.DeviceId.history
+                device_ids.update(
+                    device_id for device_id in list(history.added) + list(history.deleted) + list(history.unchanged)
+                    if device_id is not None
+                )
+            elif isinstance(obj, Devices) and obj in session.dirty:
+                history = state.attrs.CategoryName.history
+                if history.has_changes():
+                    categories.update(category for category in list(history.added) + list(history.deleted) if category)
+        return device_ids, categories
 
-            # حساب ساعات الحجز الجديد
-            new_hours = ReservationService.calculate_hours(
-                start_time_str, end_time_str, date_str
-            )
 
-            # تقليل ساعات الحجز القديم
-            ReservationService.deduct_reservation_hours(reservation)
-
-            # تحديث بيانات الحجز
-            reservation.LabId = lab_id
-            reservation.ExperimentId = experiment_id
-            reservation.Date = datetime.strptime(date_str, "%Y-%m-%d").date()
-            reservation.StartTime = datetime.strptime(start_time_str, "%H:%M").time()
-            reservation.EndTime = datetime.strptime(end_time_str, "%H:%M").time()
-            reservation.Purpose = purpose
-            reservation.IsAllowed = True
-
-            # إضافة ساعات الحجز الجديد
-            ReservationService.add_reservation_hours(
-                reservation, devices, lab, experiment, new_hours
+@event.listens_for(db.session, 'after_flush')
+def _refresh_maintenance_summaries(session, flush_context):
+    # مسجل على جلسة التطبيق فقط، ولا يعمل إلا إذا تغيرت صيانات أو أجهزة
+    if not any(
+        isinstance(obj, (Maintenances, Devices))
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted)
+    ):
+        return
+    device_ids, categories = MaintenanceSummaryService.changed_keys(session)
+    if not (device_ids or categories):
+        return
+    connection = session.connection()
+    if device_ids:
+        categories.update(
+            category for (category,) in connection.execute(
+                select(Devices.CategoryName).where(Devices.Id.in_(device_ids))
             )
+        )
+    MaintenanceSummaryService.refresh(connection, device_ids, categories)
 
-            # حفظ التغييرات
-            db.session.commit()
-            return True, "تم تحديث الحجز بنجاح"
 
-        except Exception as e:
-            db.session.rollback()
-            return False, f"حدث خطأ أثناء تحديث الحجز: {str(e)}"
+class MaintenancePredictionService:
+    # أنواع الصيانة التي تحسب لها التكلفة المتوقعة
+    PERIODIC = "صيانة دورية"
+    CALIBRATION = "معايرة"
+    # قيمة افتراضية معقولة للصيانة عند عدم وجود أي صيانة سابقة من نفس النوع
+    DEFAULT_COST = 500.0
+    # ساعات الاستخدام اليومية المفترضة للأجهزة التي ليس لها حجوزات في نافذة معدل الاستخدام
+    DEFAULT_DAILY_HOURS = 8
+    # حدود التاريخ المتوقع للأجهزة شبه المتوقفة (حتى لا يتجاوز نطاق التواريخ)
+    MIN_DAILY_HOURS = 0.01
+    MAX_FORECAST_DAYS = 3650
 
     @staticmethod
-    def create_reservation(user_id, lab_id, experiment_id, device_ids, date_str, start_time_str, end_time_str, purpose):
-        try:
-            # 1. التحقق من نوع المستخدم
-            user_valid, user_result = ReservationService.validate_user_type(user_id)
-            if not user_valid:
-                return None, user_result
-            user = user_result
-
-            # 2. التحقق من المعمل
-            lab_valid, lab_result = ReservationService.validate_lab_availability(
-                lab_id, user.UserType, date_str, start_time_str, end_time_str
-            )
-            if not lab_valid:
-                # إنشاء حجز مرفوض فقط إذا كان المعمل محجوز في هذا الوقت
-                if "محجوز" in lab_result:
-                    reservation_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-                    start_time = datetime.strptime(start_time_str, "%H:%M").time()
-                    end_time = datetime.strptime(end_time_str, "%H:%M").time()
-                    
-                    reservation = Reservations(
-                        UserId=user_id,
-                        DeviceId=device_ids[0],
-                        LabId=lab_id,
-                        ExperimentId=experiment_id,
-                        Date=reservation_date,
-                        StartTime=start_time,
-                        EndTime=end_time,
-                        Purpose=purpose,
-                        IsAllowed=False
-                    )
-                    db.session.add(reservation)
-                    db.session.commit()
-                    return reservation.Id, lab_result
-                return None, lab_result
-            lab = lab_result
-
-            # 3. التحقق من التجربة
-            exp_valid, exp_result = ReservationService.validate_experiment(
-                experiment_id, lab_id, user.UserType
-            )
-            if not exp_valid:
-                return None, exp_result
-            experiment = exp_result
+    def predict_device_maintenance(device_ids=None):
+        """
+        توقع الصيانة القادمة لكل الأجهزة المتاحة دفعة واحدة
+        
+        تحمل البيانات في استعلامات مجمعة قليلة ثم تحسب التواريخ والتكاليف كأعمدة NumPy
+        :param device_ids: حساب هذه الأجهزة فقط (لدمجها في نسخة التقرير المحسوبة مسبقاً)
+        """
+        # الحصول على الأجهزة المتاحة (جميع الأجهزة باستثناء: في الصيانة بتهجئاتها، غير متاح)
+        devices = db.session.query(
+            Devices.Id,
+            Devices.Name,
+            Devices.CurrentHour,
+            Devices.MaximumHour,
+            Devices.CalibrationInterval,
+            Devices.LastMaintenanceDate,
+            Devices.CategoryName
+        ).filter(DeviceStatusService.excluding(DeviceStatusService.OUT_OF_SERVICE))
+        if device_ids is not None:
+            devices = devices.filter(Devices.Id.in_(device_ids))
+        devices = devices.order_by(Devices.Id).all()
+        if not devices:
+            return []
 
-            # 4. التحقق من الأجهزة
-            devices_valid, devices_result = ReservationService.validate_devices(
-                device_ids, experiment_id, date_str, start_time_str, end_time_str
-            )
-            if not devices_valid:
-                # إنشاء حجز مرفوض فقط إذا كان الجهاز محجوز في هذا الوقت
-                if "محجوز" in devices_result:
-                    reservation_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-                    start_time = datetime.strptime(start_time_str, "%H:%M").time()
-                    end_time = datetime.strptime(end_time_str, "%H:%M").time()
-                    
-                    reservation = Reservations(
-                        UserId=user_id,
-                        DeviceId=device_ids[0],
-                        LabId=lab_id,
-                        ExperimentId=experiment_id,
-                        Date=reservation_date,
-                        StartTime=start_time,
-                        EndTime=end_time,
-                        Purpose=purpose,
-                        IsAllowed=False
-                    )
-                    db.session.add(reservation)
-                    db.session.commit()
-                    return reservation.Id, devices_result
-                return None, devices_result
-            devices = devices_result
-
-            # حساب عدد ساعات الحجز
-            hours_count = ReservationService.calculate_hours(
-                start_time_str, end_time_str, date_str
+        periodic_type = MaintenancePredictionService.PERIODIC
+        calibration_type = MaintenancePredictionService.CALIBRATION
+        if device_ids is not None:
+            latest_by_device, latest_by_category, average_by_type = MaintenancePredictionService.load_cost_history(
+                device_ids, {device.CategoryName for device in devices}
             )
+        else:
+            latest_by_device, latest_by_category, average_by_type = MaintenancePredictionService.load_cost_history()
 
-            # إنشاء الحجوزات وتحديث الإحصائيات
-            reservation_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-            start_time = datetime.strptime(start_time_str, "%H:%M").time()
-            end_time = datetime.strptime(end_time_str, "%H:%M").time()
-
-            reservations = []
-            for device in devices:
-                reservation = Reservations(
-                    UserId=user_id,
-                    DeviceId=device.Id,
-                    LabId=lab_id,
-                    ExperimentId=experiment_id,
-                    Date=reservation_date,
-                    StartTime=start_time,
-                    EndTime=end_time,
-                    Purpose=purpose,
-                    IsAllowed=True
-                )
-                reservations.append(reservation)
+        ids, names, current_hours, maximum_hours, intervals, last_maintenance_dates, categories = zip(*devices)
+        current_hours = np.array(current_hours, dtype=float)
+        maximum_hours = np.array(maximum_hours, dtype=float)
+        # آخر معايرة لكل جهاز، ولا تحسب المعايرة للأجهزة بدون فترة معايرة أو تاريخ آخر صيانة
+        last_calibrations = np.array([
+            latest_by_device.get((device_id, calibration_type), (None, None))[0]
+            if interval is not None and last_maintenance is not None else None
+            for device_id, interval, last_maintenance in zip(ids, intervals, last_maintenance_dates)
+        ], dtype='datetime64[us]')
+        intervals = np.array([interval if interval is not None else 0 for interval in intervals], dtype='timedelta64[D]')
 
-            # حفظ الحجوزات
-            db.session.add_all(reservations)
-            db.session.commit()
+        current_date = np.datetime64(datetime.now(), 'us')
+        day = np.timedelta64(1, 'D')
 
-            # إضافة ساعات الحجز
-            ReservationService.add_reservation_hours(
-                reservations[0], devices, lab, experiment, hours_count
-            )
+        # الصيانة الدورية: إذا وصل الجهاز إلى 90% من الحد الأقصى، والتاريخ المتوقع حسب معدل الاستخدام الفعلي
+        # للجهاز (وتقدير افتراضي للأجهزة بدون حجوزات حديثة)
+        periodic = current_hours >= maximum_hours * 0.9
+        default_rate = MaintenancePredictionService.DEFAULT_DAILY_HOURS
+        daily_rates = np.array([
+            rate if rate is not None else default_rate
+            for rate in device_usage_rates.rates_for(ids)
+        ], dtype=float)
+        remaining_days = np.minimum(
+            (maximum_hours - current_hours) / np.maximum(daily_rates, MaintenancePredictionService.MIN_DAILY_HOURS),
+            MaintenancePredictionService.MAX_FORECAST_DAYS
+        )
+        remaining_microseconds = np.rint(remaining_days * 86400e6).astype('int64')
+        periodic_dates = (current_date + remaining_microseconds.astype('timedelta64[us]')).astype('datetime64[D]')
 
-            return reservations[0].Id, "تم إنشاء الحجز بنجاح"
+        # المعايرة: التاريخ التالي بعد آخر معايرة (تحويل الشهور إلى أيام)
+        has_calibration = ~np.isnat(last_calibrations)
+        next_calibrations = last_calibrations + intervals * 30
+        days_left = (np.where(has_calibration, next_calibrations, current_date) - current_date) // day
+        # معايرة قريبة (خلال 30 يوم) تحل محل الصيانة الدورية إذا لم توجد أو كانت المعايرة قبلها
+        upcoming = has_calibration & (days_left > 0) & (days_left <= 30) & (
+            ~periodic | (periodic_dates > next_calibrations)
+        )
+        overdue = has_calibration & (days_left <= 0)
+        calibration = upcoming | overdue
 
-        except Exception as e:
-            db.session.rollback()
-            return None, f"حدث خطأ أثناء إنشاء الحجز: {str(e)}" 
+        expected_dates = np.where(
+            calibration,
+            np.datetime_as_string(next_calibrations, unit='D'),
+            np.datetime_as_string(periodic_dates, unit='D')
+        )
 
-class MaintenancePredictionService:
-    @staticmethod
-    def predict_device_maintenance():
-        # الحصول على الأجهزة المتاحة (جميع الأجهزة باستثناء: قيد الصيانة، في الصيانة، غير متاح)
-        unavailable_statuses = ["قيد الصيانة", "في الصيانة", "غير متاح"]
-        available_devices = Devices.query.filter(not_(Devices.Status.in_(unavailable_statuses))).all()
-        
         maintenance_predictions = []
-        
-        current_date = datetime.now()
-        
-        for device in available_devices:
-            prediction = {
-                "Id": device.Id,
-                "Name": device.Name,
-                "CurrentHour": device.CurrentHour,
-                "MaximumHour": device.MaximumHour
-            }
-            
-            # التحقق من ساعات التشغيل للصيانة الدورية
-            if device.CurrentHour >= device.MaximumHour * 0.9:  # إذا وصل إلى 90% من الحد الأقصى
-                prediction["MaintenanceType"] = "صيانة دورية"
-                # حساب التاريخ المتوقع بناءً على معدل استخدام الجهاز
-                remaining_hours = device.MaximumHour - device.CurrentHour
-                prediction["ExpectedDate"] = (current_date + timedelta(days=remaining_hours/8)).strftime('%Y-%m-%d')  # تقدير 8 ساعات في اليوم
-                
-                # حساب التكلفة المتوقعة للصيانة
-                prediction["ExpectedCost"] = MaintenancePredictionService.get_expected_maintenance_cost(device, "صيانة دورية")
-            
-            # التحقق من تاريخ المعايرة
-            if device.CalibrationInterval is not None and device.LastMaintenanceDate is not None:
-                last_calibration = Maintenances.query.filter(
-                    Maintenances.DeviceId == device.Id,
-                    Maintenances.Type == "معايرة"
-                ).order_by(Maintenances.EndAt.desc()).first()
-                
-                if last_calibration:
-                    # حساب تاريخ المعايرة التالية المتوقعة
-                    next_calibration_date = last_calibration.EndAt + timedelta(days=device.CalibrationInterval * 30)  # تحويل الشهور إلى أيام
-                    
-                    # إذا كان موعد المعايرة التالية قريبًا (خلال 30 يوم)
-                    if (next_calibration_date - current_date).days <= 30 and (next_calibration_date - current_date).days > 0:
-                        # إضافة معايرة متوقعة فقط إذا لم تكن هناك صيانة دورية متوقعة بالفعل أو إذا كانت المعايرة قبل الصيانة الدورية
-                        if "MaintenanceType" not in prediction or (
-                            datetime.strptime(prediction["ExpectedDate"], '%Y-%m-%d') > next_calibration_date
-                        ):
-                            prediction["MaintenanceType"] = "معايرة"
-                            prediction["ExpectedDate"] = next_calibration_date.strftime('%Y-%m-%d')
-                            
-                            # حساب التكلفة المتوقعة للمعايرة
-                            prediction["ExpectedCost"] = MaintenancePredictionService.get_expected_maintenance_cost(device, "معايرة")
-                            
-                    # إذا تجاوز موعد المعايرة التالية التاريخ الحالي
-                    elif (next_calibration_date - current_date).days <= 0:
-                        prediction["MaintenanceType"] = "معايرة متأخرة"
-                        prediction["ExpectedDate"] = next_calibration_date.strftime('%Y-%m-%d')
-                        
-                        # حساب التكلفة المتوقعة للمعايرة
-                        prediction["ExpectedCost"] = MaintenancePredictionService.get_expected_maintenance_cost(device, "معايرة")
-            
-            # إضافة التوقع فقط إذا تم تحديد نوع الصيانة
-            if "MaintenanceType" in prediction:
-                maintenance_predictions.append(prediction)
+        for index in np.flatnonzero(periodic | calibration):
+            device_id = ids[index]
+            if calibration[index]:
+                maintenance_type = "معايرة متأخرة" if overdue[index] else "معايرة"
+                cost_type = calibration_type
+            else:
+                maintenance_type = cost_type = periodic_type
+
+            maintenance_predictions.append({
+                "Id": device_id,
+                "Name": names[index],
+                "CurrentHour": int(current_hours[index]),
+                "MaximumHour": int(maximum_hours[index]),
+                "MaintenanceType": maintenance_type,
+                "ExpectedDate": str(expected_dates[index]),
+                "ExpectedCost": MaintenancePredictionService.expected_cost(
+                    device_id, categories[index], cost_type,
+                    latest_by_device, latest_by_category, average_by_type
+                )
+            })
         
         return maintenance_predictions
-        
+
     @staticmethod
-    def get_expected_maintenance_cost(device, maintenance_type):
+    def load_cost_history(device_ids=None, categories=None):
         """
-        حساب التكلفة المتوقعة للصيانة بناءً على صيانات سابقة للجهاز نفسه أو أجهزة من نفس الفئة
+        تحميل سجل تكاليف الصيانة اللازم للتوقعات من جداول الملخص ومتوسط التكلفة لكل نوع
         
-        :param device: الجهاز المراد حساب تكلفة صيانته
-        :param maintenance_type: نوع الصيانة (صيانة دورية أو معايرة)
-        :return: التكلفة المتوقعة للصيانة
+        :param device_ids: تحميل ملخص هذه الأجهزة فقط
+        :param categories: تحميل ملخص هذه الفئات فقط
+        :return: (أحدث صيانة لكل (جهاز، نوع) كـ (EndAt، Cost)، أحدث صيانة لكل (فئة، نوع)، متوسط التكلفة لكل نوع)
         """
-        # 1. البحث عن صيانات سابقة لنفس الجهاز ومن نفس النوع
-        previous_maintenance = Maintenances.query.filter(
-            Maintenances.DeviceId == device.Id,
-            Maintenances.Type == maintenance_type
-        ).order_by(Maintenances.EndAt.desc()).first()
-        
-        if previous_maintenance:
-            return float(previous_maintenance.Cost)
-        
-        # 2. إذا لم يتم العثور على صيانات سابقة للجهاز، ابحث عن صيانات لأجهزة من نفس الفئة
-        similar_devices = Devices.query.filter(
-            Devices.CategoryName == device.CategoryName,
-            Devices.Id != device.Id
-        ).all()
-        
-        similar_device_ids = [d.Id for d in similar_devices]
-        
-        if similar_device_ids:
-            # البحث عن أحدث صيانة للأجهزة من نفس الفئة
-            similar_maintenance = Maintenances.query.filter(
-                Maintenances.DeviceId.in_(similar_device_ids),
-                Maintenances.Type == maintenance_type
-            ).order_by(Maintenances.EndAt.desc()).first()
-            
-            if similar_maintenance:
-                return float(similar_maintenance.Cost)
-        
-        # 3. إذا لم يتم العثور على أي صيانات، استخدم متوسط تكلفة جميع الصيانات من نفس النوع
-        avg_cost = db.session.query(func.avg(Maintenances.Cost)).filter(
-            Maintenances.Type == maintenance_type
-        ).scalar()
-        
-        if avg_cost:
-            return float(avg_cost)
-        
-        # 4. إذا لم يتم العثور على أي شيء، عد بقيمة افتراضية
-        return 500.0  # قيمة افتراضية معقولة للصيانة
+        maintenance_types = [MaintenancePredictionService.PERIODIC, MaintenancePredictionService.CALIBRATION]
+        MaintenanceSummaryService.ensure_built()
+
+        def latest(summary, key_column, keys):
+            rows = db.session.query(
+                key_column, summary.Type, summary.LastEndAt, summary.LastCost
+            ).filter(summary.Type.in_(maintenance_types))
+            if keys is not None:
+                rows = rows.filter(key_column.in_(keys))
+            rows = rows.all()
+            return {(key, maintenance_type): (end_at, cost) for key, maintenance_type, end_at, cost in rows}
+
+        average_by_type = dict(db.session.query(
+            Maintenances.Type, func.avg(Maintenances.Cost)
+        ).filter(Maintenances.Type.in_(maintenance_types)).group_by(Maintenances.Type).all())
+
+        return (
+            latest(MaintenanceSummaries, MaintenanceSummaries.DeviceId, device_ids),
+            latest(CategoryMaintenanceSummaries, CategoryMaintenanceSummaries.CategoryName, categories),
+            average_by_type
+        )
+
+    @staticmethod
+    def expected_cost(device_id, category_name, maintenance_type, latest_by_device, latest_by_category, average_by_type):
+        """
+        التكلفة المتوقعة للصيانة: آخر صيانة للجهاز نفسه، ثم آخر صيانة لجهاز من نفس الفئة،
+        ثم متوسط تكلفة كل الصيانات من نفس النوع، ثم القيمة الافتراضية
+        """
+        latest = latest_by_device.get((device_id, maintenance_type)) or latest_by_category.get((category_name, maintenance_type))
+        if latest:
+            return float(latest[1])
+
+        average_cost = average_by_type.get(maintenance_type)
+        if average_cost:
+            return float(average_cost)
+
+        return MaintenancePredictionService.DEFAULT_COST
    
 
 class MaintenanceService:
+    # ترتيب الأولويات (نأخذ الأعلى أولوية)
+    PRIORITY_ORDER = {"طارئة": 4, "عالية": 3, "متوسطة": 2, "ضعيفة": 1, "غير محدد": 0}
+
+    @staticmethod
+    def report_sort_key(device):
+        """ترتيب تقرير الصيانة المطلوبة: الأعلى أولوية أولاً ثم حسب رقم الجهاز"""
+        return -MaintenanceService.PRIORITY_ORDER[device["priority"]], device["device_id"]
+
     @staticmethod
     def calculate_periodic_maintenance_priority(current_hours, max_hours):
         percentage = (current_hours / max_hours) * 100
@@ -904,27 +2400,17 @@ class MaintenanceService:
         return months
 
     @staticmethod
-    def calculate_calibration_priority(device_id, calibration_interval):
+    def calculate_calibration_priority(last_calibration_date, calibration_interval, now=None):
         if not calibration_interval:
             return "غير محدد"
 
-        # استخدام select لتحديد الأعمدة المطلوبة فقط
-        stmt = select(Maintenances.EndAt).where(
-            and_(
-                Maintenances.DeviceId == device_id,
-                Maintenances.Type == "معايرة"
-            )
-        ).order_by(Maintenances.EndAt.desc())
-        
-        last_calibration = db.session.execute(stmt).first()
-
-        if not last_calibration or not last_calibration[0]:
+        if not last_calibration_date:
             return "غير محدد"
 
         # حساب عدد الشهور منذ آخر معايرة
         months_since_calibration = MaintenanceService.calculate_months_between_dates(
-            last_calibration[0],
-            datetime.now()
+            last_calibration_date,
+            now or datetime.now()
         )
         
         # حساب النسبة المئوية من فترة المعايرة التي مرت
@@ -940,166 +2426,384 @@ class MaintenanceService:
             return "ضعيفة"
 
     @staticmethod
-    def get_last_calibration_date(device_id):
-        # استخدام select لتحديد الأعمدة المطلوبة فقط
-        stmt = select(Maintenances.EndAt).where(
-            and_(
-                Maintenances.DeviceId == device_id,
-                Maintenances.Type == "معايرة"
-            )
-        ).order_by(Maintenances.EndAt.desc())
-        
-        result = db.session.execute(stmt).first()
-        return result[0] if result else None
-
-    @staticmethod
-    def get_devices_needing_maintenance():
+    def get_devices_needing_maintenance(device_ids=None):
+        """
+        :param device_ids: حساب هذه الأجهزة فقط (لدمجها في نسخة التقرير المحسوبة مسبقاً)
+        """
         try:
-            # نجلب كل الأجهزة أولاً للتحقق
-            all_devices = Devices.query.all()
-            print(f"Total devices found: {len(all_devices)}")
-            
-            # نطبع حالة كل جهاز للتحقق
-            for device in all_devices:
-                print(f"Device ID: {device.Id}, Name: {device.Name}, Status: {device.Status}")
-
-            # نجلب الأجهزة المتاحة فقط
-            devices = Devices.query.filter(
-                Devices.Status != ["في الصيانة", "غير متاح"]
-            ).all()
-            print(f"Available devices: {len(devices)}")
+            # الأجهزة المتاحة مع تاريخ آخر معايرة لكل منها من ملخص الصيانات في استعلام واحد
+            MaintenanceSummaryService.ensure_built()
+            rows = db.session.query(
+                Devices.Id,
+                Devices.Name,
+                Devices.LastMaintenanceDate,
+                Devices.CurrentHour,
+                Devices.MaximumHour,
+                Devices.CalibrationInterval,
+                MaintenanceSummaries.LastEndAt
+            ).outerjoin(
+                MaintenanceSummaries,
+                and_(MaintenanceSummaries.DeviceId == Devices.Id, MaintenanceSummaries.Type == "معايرة")
+            ).filter(
+                DeviceStatusService.excluding(DeviceStatusService.OUT_OF_SERVICE)
+            )
+            if device_ids is not None:
+                rows = rows.filter(Devices.Id.in_(device_ids))
+            rows = rows.all()
+            logger.debug(f"Available devices: {len(rows)}")
 
+            # تحديد الأولوية النهائية (نأخذ الأعلى أولوية)
+            priority_order = MaintenanceService.PRIORITY_ORDER
+            now = datetime.now()
             devices_data = []
-            for device in devices:
+            for device_id, name, last_maintenance_date, current_hours, maximum_hours, calibration_interval, last_calibration_date in rows:
                 # حساب أولوية الصيانة الدورية
                 periodic_priority = MaintenanceService.calculate_periodic_maintenance_priority(
-                    device.CurrentHour,
-                    device.MaximumHour
+                    current_hours,
+                    maximum_hours
                 )
 
                 # حساب أولوية صيانة المعايرة
                 calibration_priority = MaintenanceService.calculate_calibration_priority(
-                    device.Id,
-                    device.CalibrationInterval
+                    last_calibration_date,
+                    calibration_interval,
+                    now
                 )
 
-                # تحديد الأولوية النهائية (نأخذ الأعلى أولوية)
-                priority_order = {"طارئة": 4, "عالية": 3, "متوسطة": 2, "ضعيفة": 1, "غير محدد": 0}
                 final_priority = (
                     periodic_priority if priority_order[periodic_priority] > priority_order[calibration_priority]
                     else calibration_priority
                 )
 
-                # الحصول على تاريخ آخر معايرة
-                last_calibration_date = MaintenanceService.get_last_calibration_date(device.Id)
-
                 devices_data.append({
-                    "device_id": device.Id,
-                    "device_name": device.Name,
-                    "last_maintenance_date": device.LastMaintenanceDate.strftime("%Y-%m-%d") if device.LastMaintenanceDate else None,
-                    "current_hours": device.CurrentHour,
+                    "device_id": device_id,
+                    "device_name": name,
+                    "last_maintenance_date": last_maintenance_date.strftime("%Y-%m-%d") if last_maintenance_date else None,
+                    "current_hours": current_hours,
                     "priority": final_priority,
                     "periodic_maintenance_details": {
-                        "current_hours": device.CurrentHour,
-                        "maximum_hours": device.MaximumHour,
+                        "current_hours": current_hours,
+                        "maximum_hours": maximum_hours,
                         "priority": periodic_priority
                     },
                     "calibration_maintenance_details": {
                         "last_calibration_date": last_calibration_date.strftime("%Y-%m-%d") if last_calibration_date else None,
-                        "calibration_interval_months": device.CalibrationInterval,
+                        "calibration_interval_months": calibration_interval,
                         "priority": calibration_priority
                     }
                 })
 
             # ترتيب الأجهزة حسب الأولوية
-            priority_order = {"طارئة": 4, "عالية": 3, "متوسطة": 2, "ضعيفة": 1, "غير محدد": 0}
-            devices_data.sort(key=lambda x: priority_order[x["priority"]], reverse=True)
+            devices_data.sort(key=MaintenanceService.report_sort_key)
 
             return True, devices_data
 
         except Exception as e:
             return False, f"حدث خطأ أثناء جلب بيانات الأجهزة: {str(e)}" 
 
+class SparePartMovementService:
+    """
+    حركات مخزون قطع الغيار ومعدل استهلاكها الفعلي
+    
+    كل حركة تعدل كمية القطعة بجملة UPDATE واحدة مشروطة بألا تصبح سالبة، وتضاف إلى السجل وتحدث
+    إحصائيات استهلاك القطعة في نفس المعاملة، فيقرأ تقرير الاحتياجات المعدل من صف الإحصائيات
+    مباشرة بدلاً من تقديره. المعدل متوسط يومي موزون بتضاؤل أسي (نصف عمر
+    SPARE_PART_RATE_HALF_LIFE_DAYS يوم) فيتبع تغير الاستهلاك دون الحاجة لقراءة السجل.
+    """
+    RESTOCK = "restock"
+    CONSUME = "consume"
+    ADJUST = "adjust"
+    KINDS = (RESTOCK, CONSUME, ADJUST)
+    MAX_LIMIT = 500
+    # أقل مدة يوزع عليها الاستهلاك، حتى لا تظهر أول حركة بعد بدء التسجيل كمعدل يومي كامل
+    MIN_OBSERVED_DAYS = 7
+
+    @staticmethod
+    def decay_per_day():
+        half_life = current_app.config.get('SPARE_PART_RATE_HALF_LIFE_DAYS', 30)
+        return math.log(2) / half_life
+
+    @staticmethod
+    def daily_rate(decayed_consumed, rate_at, first_movement_at, now):
+        """
+        معدل الاستهلاك اليومي عند now من صف الإحصائيات
+        
+        مجموع الاستهلاك الموزون مقسوماً على مجموع أوزان الأيام منذ أول حركة (MIN_OBSERVED_DAYS
+        على الأقل)، فلا يبالغ في معدل القطع التي بدأ تسجيل حركاتها حديثاً.
+        """
+        decay = SparePartMovementService.decay_per_day()
+        elapsed = max((now - rate_at).total_seconds() / 86400, 0)
+        observed = max((now - first_movement_at).total_seconds() / 86400, SparePartMovementService.MIN_OBSERVED_DAYS)
+        return decayed_consumed * math.exp(-decay * elapsed) * decay / (1 - math.exp(-decay * observed))
+
+    @staticmethod
+    def movement_to_dict(movement):
+        return {
+            "id": movement.Id,
+            "part_id": movement.PartId,
+            "kind": movement.Kind,
+            "quantity": movement.Quantity,
+            "balance_after": movement.BalanceAfter,
+            "user_id": movement.UserId,
+            "notes": movement.Notes,
+            "created_at": movement.CreatedAt.strftime('%Y-%m-%d %H:%M:%S')
+        }
+
+    @staticmethod
+    def record_movement(part_id, kind, quantity, user_id=None, notes=None):
+        """
+        تسجيل حركة مخزون لقطعة غيار
+        
+        :param kind: restock للتوريد، consume للاستهلاك، adjust لتعديل الجرد
+        :param quantity: الكمية الموردة أو المستهلكة (موجبة)، أو فرق الجرد (موجب أو سالب) للتعديل
+        :return: (نجاح العملية، الحركة أو رسالة الخطأ)
+        """
+        if kind not in SparePartMovementService.KINDS:
+            return False, f"نوع الحركة غير صالح، الأنواع المتاحة: {', '.join(SparePartMovementService.KINDS)}"
+        if not isinstance(quantity, int) or isinstance(quantity, bool):
+            return False, "الكمية يجب أن تكون عدداً صحيحاً"
+        if kind == SparePartMovementService.ADJUST:
+            if quantity == 0:
+                return False, "فرق الجرد يجب ألا يكون صفراً"
+        elif quantity <= 0:
+            return False, "الكمية يجب أن تكون أكبر من صفر"
+        if user_id is not None and db.session.get(Users, user_id) is None:
+            return False, "المستخدم غير موجود"
+
+        change = -quantity if kind == SparePartMovementService.CONSUME else quantity
+        now = datetime.now()
+        values = {"Quantity": SpareParts.Quantity + change}
+        if kind == SparePartMovementService.RESTOCK:
+            values["LastRestockDate"] = now
+        try:
+            # التعديل والتحقق في جملة واحدة، ويبقى صف القطعة مقفلاً حتى نهاية المعاملة
+            updated = db.session.execute(
+                update(SpareParts)
+                .where(SpareParts.PartId == part_id, SpareParts.Quantity + change >= 0)
+                .values(**values)
+                .returning(SpareParts.Quantity, SpareParts.DeviceId)
+                .execution_options(synchronize_session=False)
+            ).first()
+            if updated is None:
+                db.session.rollback()
+                part = db.session.get(SpareParts, part_id)
+                if part is None:
+                    return False, "قطعة الغيار غير موجودة"
+                return False, f"الكمية المتاحة من {part.PartName} هي {part.Quantity} فقط"
+
+            stats = db.session.get(SparePartConsumptionStats, part_id)
+            if stats is None:
+                stats = SparePartConsumptionStats(
+                    PartId=part_id, DecayedConsumed=0.0, RateAt=now, FirstMovementAt=now, TotalConsumed=0
+                )
+                db.session.add(stats)
+            if kind == SparePartMovementService.CONSUME:
+                elapsed = max((now - stats.RateAt).total_seconds() / 86400, 0)
+                decay = SparePartMovementService.decay_per_day()
+                stats.DecayedConsumed = stats.DecayedConsumed * math.exp(-decay * elapsed) + quantity
+                stats.RateAt = now
+                stats.TotalConsumed += quantity
+
+            movement = SparePartMovements(
+                PartId=part_id, Kind=kind, Quantity=change, BalanceAfter=updated.Quantity,
+                UserId=user_id, Notes=notes, CreatedAt=now
+            )
+            db.session.add(movement)
+            ReportSnapshotService.mark_changed(ReportSnapshotService.CHANGED_PART, [part_id])
+            ReportSnapshotService.mark_changed(ReportSnapshotService.CHANGED_DEVICE, [updated.DeviceId])
+            db.session.commit()
+            return True, SparePartMovementService.movement_to_dict(movement)
+        except Exception as e:
+            db.session.rollback()
+            return False, f"حدث خطأ أثناء تسجيل حركة المخزون: {str(e)}"
+
+    @staticmethod
+    def get_movements(part_id, limit=50):
+        """
+        آخر حركات القطعة مع معدل استهلاكها الحالي والأيام المتوقعة حتى نفاد مخزونها
+        
+        :return: (نجاح العملية، البيانات أو رسالة الخطأ)
+        """
+        part = db.session.get(SpareParts, part_id)
+        if part is None:
+            return False, "قطعة الغيار غير موجودة"
+        limit = min(limit, SparePartMovementService.MAX_LIMIT)
+        movements = SparePartMovements.query.filter(
+            SparePartMovements.PartId == part_id
+        ).order_by(SparePartMovements.CreatedAt.desc(), SparePartMovements.Id.desc()).limit(limit).all()
+
+        consumption = None
+        stats = db.session.get(SparePartConsumptionStats, part_id)
+        if stats is not None:
+            rate = SparePartMovementService.daily_rate(
+                stats.DecayedConsumed, stats.RateAt, stats.FirstMovementAt, datetime.now()
+            )
+            consumption = {
+                "daily_rate": round(rate, 4),
+                "days_until_empty": round(part.Quantity / rate, 2) if rate > 0 else None,
+                "total_consumed": stats.TotalConsumed,
+                "tracked_since": stats.FirstMovementAt.strftime('%Y-%m-%d %H:%M:%S')
+            }
+        return True, {
+            "part_id": part.PartId,
+            "name": part.PartName,
+            "current_quantity": part.Quantity,
+            "consumption": consumption,
+            "movements": [SparePartMovementService.movement_to_dict(movement) for movement in movements]
+        }
+
+
 class FutureNeedsService:
     """خدمة تحديد الاحتياجات المستقبلية من قطع الغيار"""
     
+    # أسباب الاحتياج بترتيب فحصها، والقطعة تظهر مرة واحدة بأول سبب ينطبق عليها
+    REASONS = ["منخفض المخزون", "قرب انتهاء الصلاحية", "معدل استهلاك عالي", "مطلوبة للصيانة القادمة"]
+    PRIORITY_ORDER = {"عالية": 0, "متوسطة": 1, "منخفضة": 2}
+    # حالات الصيانات القادمة التي تحتاج قطع غيار
+    UPCOMING_MAINTENANCE_STATUSES = ["مجدولة", "قيد التنفيذ", "تم الجدولة"]
+
+    @staticmethod
+    def report_sort_key(item, maintenance_order=None):
+        """
+        ترتيب القائمة حسب الأولوية ثم عدد الأيام للإجراء، ثم حسب ترتيب السبب ورقم القطعة
+        
+        :param maintenance_order: رقم أول صيانة قادمة لكل جهاز، والقطع المطلوبة للصيانة القادمة
+            تترتب حسب صيانات أجهزتها قبل رقم القطعة
+        """
+        reason = FutureNeedsService.REASONS.index(item["reason"])
+        maintenance = 0
+        if maintenance_order and reason == len(FutureNeedsService.REASONS) - 1:
+            maintenance = maintenance_order.get(item["device_id"], 0)
+        return (
+            FutureNeedsService.PRIORITY_ORDER.get(item["priority"], 3),
+            item["days_to_action"],
+            reason,
+            maintenance,
+            item["id"]
+        )
+
+    @staticmethod
+    def upcoming_maintenances(today):
+        """الأجهزة التي لديها صيانات قادمة في الشهرين القادمين مع رقم أول صيانة منها"""
+        return select(
+            Maintenances.DeviceId,
+            func.min(Maintenances.Id).label("FirstMaintenanceId")
+        ).where(
+            Maintenances.Status.in_(FutureNeedsService.UPCOMING_MAINTENANCE_STATUSES),
+            Maintenances.SchedulingAt > today,
+            Maintenances.SchedulingAt <= today + timedelta(days=60)
+        ).group_by(Maintenances.DeviceId)
+    
     @staticmethod
-    def get_future_spare_parts_needs():
+    def get_future_spare_parts_needs(part_ids=None, device_ids=None):
         """
         تحديد قطع الغيار المطلوب شراؤها مستقبلاً بناءً على المعايير التالية:
         1. قطع الغيار منخفضة المخزون
         2. قطع الغيار التي تقارب انتهاء الصلاحية
-        3. قطع الغيار ذات معدل الاستهلاك العالي
+        3. قطع الغيار ذات معدل الاستهلاك العالي (من سجل حركات المخزون إن وجد)
         4. قطع الغيار المطلوبة للصيانات القادمة
+        
+        :param part_ids: حساب هذه القطع فقط (لدمجها في نسخة التقرير المحسوبة مسبقاً)
+        :param device_ids: وحساب قطع هذه الأجهزة أيضاً
         """
         # تعريف المتغيرات الزمنية
         today = datetime.now()
-        one_month = today + timedelta(days=30)
         two_months = today + timedelta(days=60)
         
-        # 1. قطع الغيار منخفضة المخزون
-        low_stock_parts = SpareParts.query.filter(
-            SpareParts.Quantity <= (SpareParts.MinimumQuantity * 1.2)  # أقل من أو يساوي الحد الأدنى + 20%
-        ).all()
+        # القطع مع اسم الجهاز وأول صيانة قادمة للجهاز في الشهرين القادمين في استعلام واحد
+        upcoming_maintenances = FutureNeedsService.upcoming_maintenances(today).subquery()
+        parts = db.session.query(
+            SpareParts.PartId,
+            SpareParts.PartName,
+            SpareParts.Quantity,
+            SpareParts.MinimumQuantity,
+            SpareParts.DeviceId,
+            SpareParts.LaboratoryId,
+            SpareParts.Unit,
+            SpareParts.Cost,
+            SpareParts.ExpiryDate,
+            SpareParts.LastRestockDate,
+            Devices.Name.label("DeviceName"),
+            upcoming_maintenances.c.FirstMaintenanceId,
+            SparePartConsumptionStats.DecayedConsumed,
+            SparePartConsumptionStats.RateAt,
+            SparePartConsumptionStats.FirstMovementAt
+        ).outerjoin(
+            Devices, Devices.Id == SpareParts.DeviceId
+        ).outerjoin(
+            upcoming_maintenances, upcoming_maintenances.c.DeviceId == SpareParts.DeviceId
+        ).outerjoin(
+            SparePartConsumptionStats, SparePartConsumptionStats.PartId == SpareParts.PartId
+        )
+        if part_ids is not None or device_ids is not None:
+            parts = parts.filter(or_(
+                SpareParts.PartId.in_(list(part_ids or [])),
+                SpareParts.DeviceId.in_(list(device_ids or []))
+            ))
         
-        # 2. قطع الغيار التي تقارب انتهاء الصلاحية
-        expiring_parts = SpareParts.query.filter(
-            SpareParts.ExpiryDate.isnot(None),
-            SpareParts.ExpiryDate <= two_months,
-            SpareParts.Quantity > 0  # فقط القطع التي لا زال هناك مخزون منها
-        ).all()
+        all_parts_list = []
+        maintenance_order = {}
+        for part in parts.all():
+            if part.FirstMaintenanceId is not None:
+                maintenance_order[part.DeviceId] = part.FirstMaintenanceId
+            part_info = FutureNeedsService._classify_part(
+                part, today, two_months,
+                part.DeviceName if part.DeviceName is not None else "غير معروف",
+                part.FirstMaintenanceId is not None,
+                SparePartMovementService.daily_rate(part.DecayedConsumed, part.RateAt, part.FirstMovementAt, today)
+                if part.RateAt is not None else None
+            )
+            if part_info:
+                all_parts_list.append(part_info)
         
-        # 3. قطع الغيار ذات معدل الاستهلاك العالي
-        high_consumption_parts = []
-        parts_with_restock_date = SpareParts.query.filter(
-            SpareParts.LastRestockDate.isnot(None),
-            SpareParts.Quantity > 0
-        ).all()
+        # ترتيب القائمة النهائية حسب الأولوية ثم حسب عدد الأيام للإجراء
+        final_sorted_list = sorted(
+            all_parts_list, key=lambda item: FutureNeedsService.report_sort_key(item, maintenance_order)
+        )
         
-        for part in parts_with_restock_date:
-            if part.LastRestockDate:
-                days_since_restock = (today - part.LastRestockDate).days
-                if days_since_restock > 0:
-                    # تقدير الكمية الأصلية عند آخر تخزين
-                    # (هذا تقدير بسيط، قد تحتاج لتحسينه إذا كان لديك بيانات أكثر دقة)
-                    estimated_original_quantity = part.Quantity * 1.5  # تقدير بسيط
-                    consumed_quantity = estimated_original_quantity - part.Quantity
-                    
-                    # حساب معدل الاستهلاك اليومي
-                    daily_consumption_rate = consumed_quantity / days_since_restock if days_since_restock > 0 else 0
-                    
-                    # تقدير عدد الأيام حتى نفاد المخزون
-                    days_until_empty = part.Quantity / daily_consumption_rate if daily_consumption_rate > 0 else 999
-                    
-                    # إذا كان سينفد في أقل من 45 يوم، أضفه للقائمة
-                    if days_until_empty <= 45:
-                        part.estimated_days = round(days_until_empty, 2)
-                        part.consumption_rate = round(daily_consumption_rate, 2)
-                        high_consumption_parts.append(part)
-        
-        # 4. قطع الغيار المطلوبة للصيانات القادمة
-        # الحصول على الصيانات المجدولة في المستقبل القريب
-        upcoming_maintenances = Maintenances.query.filter(
-            Maintenances.Status.in_(["مجدولة", "قيد التنفيذ", "تم الجدولة"]),
-            Maintenances.SchedulingAt > today,
-            Maintenances.SchedulingAt <= two_months
-        ).all()
+        # تجميع النتائج
+        response = {
+            "summary": FutureNeedsService.summarize(final_sorted_list, today),
+            "parts_to_purchase": final_sorted_list
+        }
         
-        # قطع الغيار المرتبطة بالأجهزة التي لديها صيانات قادمة
-        maintenance_related_parts = []
-        for maintenance in upcoming_maintenances:
-            if maintenance.DeviceId:
-                device_parts = SpareParts.query.filter_by(DeviceId=maintenance.DeviceId).all()
-                for part in device_parts:
-                    # تجنب التكرار
-                    if part not in maintenance_related_parts:
-                        maintenance_related_parts.append(part)
-        
-        # دمج وترتيب النتائج
-        all_parts_list = []
+        return response
+    
+    @staticmethod
+    def summarize(parts_list, today):
+        """إحصائيات إجمالية لقائمة القطع"""
+        total_estimated_cost = sum(item["total_cost_estimation"] for item in parts_list)
+        high_priority_count = sum(1 for item in parts_list if item["priority"] == "عالية")
+        return {
+            "total_parts_needed": len(parts_list),
+            "high_priority_count": high_priority_count,
+            "total_estimated_cost": round(total_estimated_cost, 2),
+            "date_generated": today.strftime('%Y-%m-%d')
+        }
+    
+    @staticmethod
+    def _classify_part(part, today, two_months, device_name, has_upcoming_maintenance, measured_rate=None):
+        """
+        سبب احتياج القطعة وتفاصيله حسب أول معيار ينطبق عليها، أو None إذا لم تكن مطلوبة
+        
+        :param measured_rate: معدل الاستهلاك اليومي من سجل حركات القطعة، أو None للقطع التي
+            ليس لها سجل فيقدر معدلها من تاريخ آخر توريد
+        """
+        part_info = {
+            "id": part.PartId,
+            "name": part.PartName,
+            "current_quantity": part.Quantity,
+            "minimum_quantity": part.MinimumQuantity,
+            "device_id": part.DeviceId,
+            "device_name": device_name,
+            "lab_id": part.LaboratoryId,
+            "unit": part.Unit,
+            "cost": round(float(part.Cost), 2),
+            "expiry_date": part.ExpiryDate.strftime('%Y-%m-%d') if part.ExpiryDate else None
+        }
         
-        # 1. إضافة قطع الغيار منخفضة المخزون مع التفاصيل
-        for part in low_stock_parts:
+        # 1. قطع الغيار منخفضة المخزون: أقل من أو يساوي الحد الأدنى + 20%
+        if part.Quantity <= part.MinimumQuantity * 1.2:
             stock_percentage = (part.Quantity / part.MinimumQuantity * 100) if part.MinimumQuantity > 0 else 0
             
             # تحديد مستوى الأولوية بناءً على نسبة المخزون
@@ -1114,247 +2818,342 @@ class FutureNeedsService:
             # حساب الكمية المقترح شراؤها
             suggested_quantity = max(part.MinimumQuantity * 2 - part.Quantity, 5)
             
-            part_info = {
-                "id": part.PartId,
-                "name": part.PartName,
-                "current_quantity": part.Quantity,
-                "minimum_quantity": part.MinimumQuantity,
-                "device_id": part.DeviceId,
-                "device_name": FutureNeedsService._get_device_name(part.DeviceId),
-                "lab_id": part.LaboratoryId,
-                "unit": part.Unit,
-                "cost": round(float(part.Cost), 2),
-                "expiry_date": part.ExpiryDate.strftime('%Y-%m-%d') if part.ExpiryDate else None,
+            part_info.update({
                 "priority": priority,
                 "reason": "منخفض المخزون",
                 "stock_percentage": round(stock_percentage, 2),
                 "days_to_action": days_to_action,
                 "suggested_quantity": suggested_quantity,
                 "total_cost_estimation": round(float(part.Cost) * suggested_quantity, 2)
-            }
-            all_parts_list.append(part_info)
-        
-        # 2. إضافة قطع الغيار التي تقارب انتهاء الصلاحية
-        for part in expiring_parts:
-            # تجنب التكرار
-            if part.PartId not in [p["id"] for p in all_parts_list]:
-                days_to_expiry = (part.ExpiryDate - today).days if part.ExpiryDate else 999
-                
-                # تحديد الأولوية بناءً على قرب انتهاء الصلاحية
-                if days_to_expiry <= 15:
-                    priority = "عالية"
-                elif days_to_expiry <= 30:
-                    priority = "متوسطة"
-                else:
-                    priority = "منخفضة"
-                
-                # الكمية المقترح شراؤها (لاستبدال المخزون الحالي)
-                suggested_quantity = max(part.Quantity, part.MinimumQuantity)
-                
-                part_info = {
-                    "id": part.PartId,
-                    "name": part.PartName,
-                    "current_quantity": part.Quantity,
-                    "minimum_quantity": part.MinimumQuantity,
-                    "device_id": part.DeviceId,
-                    "device_name": FutureNeedsService._get_device_name(part.DeviceId),
-                    "lab_id": part.LaboratoryId,
-                    "unit": part.Unit,
-                    "cost": round(float(part.Cost), 2),
-                    "expiry_date": part.ExpiryDate.strftime('%Y-%m-%d') if part.ExpiryDate else None,
-                    "priority": priority,
-                    "reason": "قرب انتهاء الصلاحية",
-                    "days_to_action": days_to_expiry,
-                    "suggested_quantity": suggested_quantity,
-                    "total_cost_estimation": round(float(part.Cost) * suggested_quantity, 2)
-                }
-                all_parts_list.append(part_info)
+            })
+            return part_info
         
-        # 3. إضافة قطع الغيار ذات معدل الاستهلاك العالي
-        for part in high_consumption_parts:
-            # تجنب التكرار
-            if part.PartId not in [p["id"] for p in all_parts_list]:
-                days_to_empty = getattr(part, 'estimated_days', 999)
-                
-                # تحديد الأولوية بناءً على سرعة نفاد المخزون
-                if days_to_empty <= 15:
-                    priority = "عالية"
-                elif days_to_empty <= 30:
-                    priority = "متوسطة"
-                else:
-                    priority = "منخفضة"
-                
-                # الكمية المقترح شراؤها بناءً على معدل الاستهلاك
-                consumption_rate = getattr(part, 'consumption_rate', 0.1)
-                suggested_quantity = max(round(consumption_rate * 60), part.MinimumQuantity)  # شراء ما يكفي لمدة شهرين
-                
-                part_info = {
-                    "id": part.PartId,
-                    "name": part.PartName,
-                    "current_quantity": part.Quantity,
-                    "minimum_quantity": part.MinimumQuantity,
-                    "device_id": part.DeviceId,
-                    "device_name": FutureNeedsService._get_device_name(part.DeviceId),
-                    "lab_id": part.LaboratoryId,
-                    "unit": part.Unit,
-                    "cost": round(float(part.Cost), 2),
-                    "expiry_date": part.ExpiryDate.strftime('%Y-%m-%d') if part.ExpiryDate else None,
-                    "priority": priority,
-                    "reason": "معدل استهلاك عالي",
-                    "days_to_action": days_to_empty,
-                    "consumption_rate": getattr(part, 'consumption_rate', 0),
-                    "suggested_quantity": suggested_quantity,
-                    "total_cost_estimation": round(float(part.Cost) * suggested_quantity, 2)
-                }
-                all_parts_list.append(part_info)
+        # 2. قطع الغيار التي تقارب انتهاء الصلاحية (فقط القطع التي لا زال هناك مخزون منها)
+        if part.ExpiryDate is not None and part.ExpiryDate <= two_months and part.Quantity > 0:
+            days_to_expiry = (part.ExpiryDate - today).days
+            
+            # تحديد الأولوية بناءً على قرب انتهاء الصلاحية
+            if days_to_expiry <= 15:
+                priority = "عالية"
+            elif days_to_expiry <= 30:
+                priority = "متوسطة"
+            else:
+                priority = "منخفضة"
+            
+            # الكمية المقترح شراؤها (لاستبدال المخزون الحالي)
+            suggested_quantity = max(part.Quantity, part.MinimumQuantity)
+            
+            part_info.update({
+                "priority": priority,
+                "reason": "قرب انتهاء الصلاحية",
+                "days_to_action": days_to_expiry,
+                "suggested_quantity": suggested_quantity,
+                "total_cost_estimation": round(float(part.Cost) * suggested_quantity, 2)
+            })
+            return part_info
         
-        # 4. إضافة قطع الغيار المطلوبة للصيانات القادمة
-        for part in maintenance_related_parts:
-            # تجنب التكرار
-            if part.PartId not in [p["id"] for p in all_parts_list]:
-                # تحديد حاجة الصيانة للقطع بناءً على المخزون الحالي
-                if part.Quantity < part.MinimumQuantity:
-                    priority = "عالية"
-                    days_to_action = 0
-                elif part.Quantity < part.MinimumQuantity * 1.5:
-                    priority = "متوسطة"
-                    days_to_action = 15
-                else:
-                    priority = "منخفضة"
-                    days_to_action = 30
-                
-                # الكمية المقترح شراؤها (الحد الأدنى + إضافة للصيانة)
-                suggested_quantity = max(part.MinimumQuantity - part.Quantity + 3, 3)
+        # 3. قطع الغيار ذات معدل الاستهلاك العالي
+        if part.Quantity > 0:
+            daily_consumption_rate = measured_rate
+            if daily_consumption_rate is None and part.LastRestockDate is not None:
+                days_since_restock = (today - part.LastRestockDate).days
+                if days_since_restock > 0:
+                    # تقدير الكمية الأصلية عند آخر تخزين للقطع التي ليس لها سجل حركات
+                    estimated_original_quantity = part.Quantity * 1.5  # تقدير بسيط
+                    consumed_quantity = estimated_original_quantity - part.Quantity
+                    
+                    # حساب معدل الاستهلاك اليومي
+                    daily_consumption_rate = consumed_quantity / days_since_restock
+            
+            if daily_consumption_rate is not None:
+                # تقدير عدد الأيام حتى نفاد المخزون
+                days_until_empty = part.Quantity / daily_consumption_rate if daily_consumption_rate > 0 else 999
                 
-                part_info = {
-                    "id": part.PartId,
-                    "name": part.PartName,
-                    "current_quantity": part.Quantity,
-                    "minimum_quantity": part.MinimumQuantity,
-                    "device_id": part.DeviceId,
-                    "device_name": FutureNeedsService._get_device_name(part.DeviceId),
-                    "lab_id": part.LaboratoryId,
-                    "unit": part.Unit,
-                    "cost": round(float(part.Cost), 2),
-                    "expiry_date": part.ExpiryDate.strftime('%Y-%m-%d') if part.ExpiryDate else None,
-                    "priority": priority,
-                    "reason": "مطلوبة للصيانة القادمة",
-                    "days_to_action": days_to_action,
-                    "suggested_quantity": suggested_quantity,
-                    "total_cost_estimation": round(float(part.Cost) * suggested_quantity, 2)
-                }
-                all_parts_list.append(part_info)
+                # إذا كان سينفد في أقل من 45 يوم
+                if days_until_empty <= 45:
+                    days_to_empty = round(days_until_empty, 2)
+                    consumption_rate = round(daily_consumption_rate, 2)
+                    
+                    # تحديد الأولوية بناءً على سرعة نفاد المخزون
+                    if days_to_empty <= 15:
+                        priority = "عالية"
+                    elif days_to_empty <= 30:
+                        priority = "متوسطة"
+                    else:
+                        priority = "منخفضة"
+                    
+                    # الكمية المقترح شراؤها بناءً على معدل الاستهلاك (ما يكفي لمدة شهرين)
+                    suggested_quantity = max(round(consumption_rate * 60), part.MinimumQuantity)
+                    
+                    part_info.update({
+                        "priority": priority,
+                        "reason": "معدل استهلاك عالي",
+                        "days_to_action": days_to_empty,
+                        "consumption_rate": consumption_rate,
+                        "suggested_quantity": suggested_quantity,
+                        "total_cost_estimation": round(float(part.Cost) * suggested_quantity, 2)
+                    })
+                    return part_info
         
-        # ترتيب القائمة النهائية حسب الأولوية ثم حسب عدد الأيام للإجراء
-        priority_order = {"عالية": 0, "متوسطة": 1, "منخفضة": 2}
-        final_sorted_list = sorted(all_parts_list, 
-                                   key=lambda x: (priority_order.get(x["priority"], 3), x["days_to_action"]))
+        # 4. قطع الغيار المرتبطة بالأجهزة التي لديها صيانات قادمة
+        if has_upcoming_maintenance:
+            # تحديد حاجة الصيانة للقطع بناءً على المخزون الحالي
+            if part.Quantity < part.MinimumQuantity:
+                priority = "عالية"
+                days_to_action = 0
+            elif part.Quantity < part.MinimumQuantity * 1.5:
+                priority = "متوسطة"
+                days_to_action = 15
+            else:
+                priority = "منخفضة"
+                days_to_action = 30
+            
+            # الكمية المقترح شراؤها (الحد الأدنى + إضافة للصيانة)
+            suggested_quantity = max(part.MinimumQuantity - part.Quantity + 3, 3)
+            
+            part_info.update({
+                "priority": priority,
+                "reason": "مطلوبة للصيانة القادمة",
+                "days_to_action": days_to_action,
+                "suggested_quantity": suggested_quantity,
+                "total_cost_estimation": round(float(part.Cost) * suggested_quantity, 2)
+            })
+            return part_info
         
-        # إحصائيات إجمالية
-        total_parts_needed = len(final_sorted_list)
-        total_estimated_cost = sum(item["total_cost_estimation"] for item in final_sorted_list)
-        high_priority_count = sum(1 for item in final_sorted_list if item["priority"] == "عالية")
+        return None
+    
+    @staticmethod
+    def get_filtered_needs(priorities=None, reasons=None, lab_ids=None):
+        """
+        قطع الغيار المطلوبة بعد التصفية من التقرير المجمع في الذاكرة بدون إعادة حسابه
         
-        # تجميع النتائج
-        response = {
-            "summary": {
-                "total_parts_needed": total_parts_needed,
-                "high_priority_count": high_priority_count,
-                "total_estimated_cost": round(total_estimated_cost, 2),
-                "date_generated": today.strftime('%Y-%m-%d')
-            },
-            "parts_to_purchase": final_sorted_list
-        }
+        :param priorities: قائمة الأولويات المطلوبة، أو None للكل
+        :param reasons: قائمة الأسباب المطلوبة، أو None للكل
+        :param lab_ids: قائمة أرقام المعامل المطلوبة، أو None للكل
+        """
+        error = FutureNeedsService.filter_error(priorities, reasons)
+        if error:
+            return {"error": error}
+
+        return future_needs_index.filter(priorities, reasons, lab_ids)
+
+    @staticmethod
+    def stream_filtered_needs(priorities=None, reasons=None, lab_ids=None):
+        """
+        مثل get_filtered_needs لكن القطع تعاد كمكرر بترتيب التقرير بدون بناء القائمة (للتصدير)
         
-        return response
-    
+        :return: (الملخص، مكرر القطع)، أو ({"error": ...}، None) إذا كانت التصفية غير صالحة
+        """
+        error = FutureNeedsService.filter_error(priorities, reasons)
+        if error:
+            return {"error": error}, None
+
+        return future_needs_index.select(priorities, reasons, lab_ids)
+
     @staticmethod
-    def _get_device_name(device_id):
-        """الحصول على اسم الجهاز من معرفه"""
-        device = Devices.query.filter_by(Id=device_id).first()
-        return device.Name if device else "غير معروف"
-    
+    def filter_error(priorities, reasons):
+        if priorities is not None and any(priority not in FutureNeedsService.PRIORITY_ORDER for priority in priorities):
+            return "الأولوية غير صالحة"
+        if reasons is not None and any(reason not in FutureNeedsService.REASONS for reason in reasons):
+            return "السبب غير صالح"
+        return None
+
     @staticmethod
     def get_parts_by_priority(priority):
         """استرجاع قطع الغيار المطلوبة حسب الأولوية"""
-        if priority not in ["عالية", "متوسطة", "منخفضة"]:
-            return {"error": "الأولوية غير صالحة"}
-        
-        all_needs = FutureNeedsService.get_future_spare_parts_needs()
-        filtered_parts = [part for part in all_needs["parts_to_purchase"] if part["priority"] == priority]
-        
-        # تحديث الملخص
-        total_estimated_cost = sum(item["total_cost_estimation"] for item in filtered_parts)
-        
-        result = {
-            "summary": {
-                "total_parts_needed": len(filtered_parts),
-                "high_priority_count": len(filtered_parts) if priority == "عالية" else 0,
-                "total_estimated_cost": round(total_estimated_cost, 2),
-                "date_generated": datetime.now().strftime('%Y-%m-%d'),
-                "filter_applied": f"الأولوية: {priority}"
-            },
-            "parts_to_purchase": filtered_parts
-        }
-        
-        return result
+        return FutureNeedsService.get_filtered_needs(priorities=[priority])
     
     @staticmethod
     def get_parts_by_reason(reason):
         """استرجاع قطع الغيار المطلوبة حسب السبب"""
-        valid_reasons = ["منخفض المخزون", "قرب انتهاء الصلاحية", "معدل استهلاك عالي", "مطلوبة للصيانة القادمة"]
-        
-        if reason not in valid_reasons:
-            return {"error": "السبب غير صالح"}
-        
-        all_needs = FutureNeedsService.get_future_spare_parts_needs()
-        filtered_parts = [part for part in all_needs["parts_to_purchase"] if part["reason"] == reason]
-        
-        # تحديث الملخص
-        total_estimated_cost = sum(item["total_cost_estimation"] for item in filtered_parts)
-        high_priority_count = sum(1 for item in filtered_parts if item["priority"] == "عالية")
+        return FutureNeedsService.get_filtered_needs(reasons=[reason])
+
+
+_NeedsGroup = namedtuple('_NeedsGroup', ['positions', 'high_priority_count', 'total_cost'])
+
+
+class FutureNeedsIndex:
+    """
+    تقرير احتياجات قطع الغيار مجمعاً في الذاكرة حسب (الأولوية، السبب، المعمل)
+    
+    يحمل من نسخة التقرير المحسوبة مسبقاً (أو يحسب إذا كانت النسخ معطلة) مرة كل
+    FUTURE_NEEDS_CACHE_SECONDS، ولكل مجموعة مواضع قطعها في ترتيب التقرير مع عدد القطع عالية
+    الأولوية وإجمالي التكلفة، فتخدم أي تصفية بجمع المجموعات المطابقة.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        # (القطع بترتيب التقرير، المجموعات)
+        self._state = ([], {})
+
+    def ensure_loaded(self):
+        ttl = current_app.config.get('FUTURE_NEEDS_CACHE_SECONDS', 60)
+        with self._lock:
+            if self._loaded_at is not None and time.monotonic() - self._loaded_at < ttl:
+                return self._state
+
+            payload, status_code, _, _ = ReportSnapshotService.serve(ReportSnapshotService.FUTURE_NEEDS)
+            if status_code != 200:
+                raise RuntimeError("تعذر حساب احتياجات قطع الغيار")
+            parts = json.loads(payload)["parts_to_purchase"]
+
+            grouped = {}
+            for position, part in enumerate(parts):
+                positions, high_priority_count, total_cost = grouped.get(
+                    (part["priority"], part["reason"], part["lab_id"]), ([], 0, 0.0)
+                )
+                positions.append(position)
+                grouped[(part["priority"], part["reason"], part["lab_id"])] = (
+                    positions,
+                    high_priority_count + (part["priority"] == "عالية"),
+                    total_cost + part["total_cost_estimation"]
+                )
+
+            self._state = (parts, {key: _NeedsGroup(*group) for key, group in grouped.items()})
+            self._loaded_at = time.monotonic()
+            return self._state
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def filter(self, priorities=None, reasons=None, lab_ids=None):
+        """القطع المطابقة بترتيب التقرير مع ملخصها من إجماليات المجموعات"""
+        summary, parts = self.select(priorities, reasons, lab_ids)
+        return {"summary": summary, "parts_to_purchase": list(parts)}
+
+    def select(self, priorities=None, reasons=None, lab_ids=None):
+        """
+        ملخص القطع المطابقة ومكرر عليها بترتيب التقرير
         
-        result = {
-            "summary": {
-                "total_parts_needed": len(filtered_parts),
-                "high_priority_count": high_priority_count,
-                "total_estimated_cost": round(total_estimated_cost, 2),
-                "date_generated": datetime.now().strftime('%Y-%m-%d'),
-                "filter_applied": f"السبب: {reason}"
-            },
-            "parts_to_purchase": filtered_parts
+        المكرر يدمج مواضع المجموعات المرتبة أثناء القراءة ويحتفظ بنسخة التقرير التي حملت عند
+        الاستدعاء، فلا يتأثر بإعادة التحميل ولا ينسخ القطع.
+        """
+        parts, groups = self.ensure_loaded()
+        keys = [
+            key for key in groups
+            if (priorities is None or key[0] in priorities)
+            and (reasons is None or key[1] in reasons)
+            and (lab_ids is None or key[2] in lab_ids)
+        ]
+
+        filters = []
+        if priorities is not None:
+            filters.append(f"الأولوية: {'، '.join(priorities)}")
+        if reasons is not None:
+            filters.append(f"السبب: {'، '.join(reasons)}")
+        if lab_ids is not None:
+            filters.append(f"المعمل: {'، '.join(str(lab_id) for lab_id in lab_ids)}")
+
+        summary = {
+            "total_parts_needed": sum(len(groups[key].positions) for key in keys),
+            "high_priority_count": sum(groups[key].high_priority_count for key in keys),
+            "total_estimated_cost": round(sum(groups[key].total_cost for key in keys), 2),
+            "date_generated": datetime.now().strftime('%Y-%m-%d'),
+            "filter_applied": "؛ ".join(filters)
         }
-        
-        return result 
+        positions = heapq.merge(*(groups[key].positions for key in keys))
+        return summary, (parts[position] for position in positions)
+
 
+future_needs_index = FutureNeedsIndex()
 
 
+# إحصائيات تقييم استبدال الجهاز من الاستعلام المجمع
+_ReplacementStats = namedtuple(
+    '_ReplacementStats', ['repair_count', 'periodic_count', 'maintenance_cost', 'parts_count', 'parts_value']
+)
+
 
 class DevicesReplacementService:
     """خدمة لتقييم الأجهزة التي تحتاج إلى استبدال"""
     
+    # ترتيب الأولويات في قائمة الاستبدال
+    PRIORITY_ORDER = {"طارئة": 0, "عالية": 1, "متوسطه": 2, "ضعيفه": 3}
+
+    @staticmethod
+    def report_sort_key(evaluation):
+        """ترتيب قائمة الاستبدال: حسب الأولوية ثم حسب رقم الجهاز"""
+        return DevicesReplacementService.PRIORITY_ORDER.get(evaluation["priority"], 4), evaluation["device_id"]
+
     @staticmethod
-    def get_devices_for_replacement():
-        """الحصول على قائمة بالأجهزة التي قد تحتاج إلى استبدال مع تحليل لكل جهاز"""
-        # الحصول على كل الأجهزة
-        all_devices = Devices.query.all()
+    def get_devices_for_replacement(device_ids=None):
+        """
+        الحصول على قائمة بالأجهزة التي قد تحتاج إلى استبدال مع تحليل لكل جهاز
         
+        :param device_ids: تقييم هذه الأجهزة فقط (لدمجها في نسخة التقرير المحسوبة مسبقاً)
+        """
+        # الحصول على كل الأجهزة مع إحصائيات صياناتها وقطع غيارها
         results = []
-        for device in all_devices:
-            evaluation = DevicesReplacementService.evaluate_device_replacement(device)
+        for device, stats in DevicesReplacementService.load_devices_with_stats(device_ids):
+            evaluation = DevicesReplacementService.evaluate_device_replacement(device, stats)
             # لإظهار جميع الأجهزة التي تم تقييمها (سواء كانت بحاجة للاستبدال أو لا)
             # قم بتعليق الشرط التالي إذا كنت تريد رؤية كل الأجهزة
             if evaluation["should_retire"]:  # فقط الأجهزة التي تحتاج للاستبدال
                 results.append(evaluation)
                 
         # ترتيب النتائج حسب الأولوية
-        priority_order = {"طارئة": 0, "عالية": 1, "متوسطه": 2, "ضعيفه": 3}
-        results.sort(key=lambda x: priority_order.get(x["priority"], 4))
+        results.sort(key=DevicesReplacementService.report_sort_key)
                 
         return results
     
     @staticmethod
-    def evaluate_device_replacement(device):
+    def load_devices_with_stats(device_ids=None):
+        """
+        الأجهزة بترتيب أرقامها مع إحصائيات الاستبدال لكل جهاز في استعلام واحد مجمع
+        
+        :return: قائمة (الجهاز، _ReplacementStats)
+        """
+        now = datetime.now()
+        six_months_ago = now - timedelta(days=180)
+        one_year_ago = now - timedelta(days=365)
+        
+        # صيانات الإصلاح خلال آخر 6 أشهر، والدورية خلال آخر سنة، وإجمالي تكاليف كل الصيانات
+        maintenance_stats = select(
+            Maintenances.DeviceId,
+            func.sum(case(
+                (and_(Maintenances.Type == "إصلاح", Maintenances.SchedulingAt > six_months_ago), 1), else_=0
+            )).label("RepairCount"),
+            func.sum(case(
+                (and_(Maintenances.Type == "دورية", Maintenances.SchedulingAt > one_year_ago), 1), else_=0
+            )).label("PeriodicCount"),
+            func.sum(Maintenances.Cost).label("MaintenanceCost")
+        ).group_by(Maintenances.DeviceId).subquery()
+        
+        # قيمة قطع الغيار المتبقية لكل جهاز
+        parts_stats = select(
+            SpareParts.DeviceId,
+            func.count(SpareParts.PartId).label("PartsCount"),
+            func.sum(SpareParts.Cost * SpareParts.Quantity).label("PartsValue")
+        ).group_by(SpareParts.DeviceId).subquery()
+        
+        query = db.session.query(
+            Devices,
+            maintenance_stats.c.RepairCount,
+            maintenance_stats.c.PeriodicCount,
+            maintenance_stats.c.MaintenanceCost,
+            parts_stats.c.PartsCount,
+            parts_stats.c.PartsValue
+        ).outerjoin(
+            maintenance_stats, maintenance_stats.c.DeviceId == Devices.Id
+        ).outerjoin(
+            parts_stats, parts_stats.c.DeviceId == Devices.Id
+        )
+        if device_ids is not None:
+            query = query.filter(Devices.Id.in_(device_ids))
+        
+        return [
+            (device, _ReplacementStats(
+                int(repair_count or 0), int(periodic_count or 0), float(maintenance_cost or 0),
+                int(parts_count or 0), float(parts_value or 0)
+            ))
+            for device, repair_count, periodic_count, maintenance_cost, parts_count, parts_value
+            in query.order_by(Devices.Id).all()
+        ]
+    
+    @staticmethod
+    def evaluate_device_replacement(device, stats=None):
         """
         تقييم ما إذا كان الجهاز بحاجة إلى الاستبدال
         
@@ -1362,7 +3161,12 @@ class DevicesReplacementService:
         1. العمر الافتراضي للجهاز (Lifespan) بالسنوات
         2. تكرار الصيانات في فترة قصيرة
         3. تكلفة الصيانة مقارنة بتكلفة الشراء
+        
+        :param stats: إحصائيات الجهاز من load_devices_with_stats، وتحمل للجهاز وحده إذا لم ترسل
         """
+        if stats is None:
+            stats = DevicesReplacementService.load_devices_with_stats([device.Id])[0][1]
+        
         # البدء بافتراض عدم الحاجة للاستبدال
         result = {
             "device_id": device.Id,
@@ -1383,14 +3187,16 @@ class DevicesReplacementService:
                 result["should_retire"] = True
         
         # المعيار 2: تكرار الصيانات في فترة قصيرة
-        maintenance_score = DevicesReplacementService._evaluate_by_maintenance_frequency(device)
+        maintenance_score = DevicesReplacementService._evaluate_by_maintenance_frequency(
+            stats.repair_count, stats.periodic_count
+        )
         if maintenance_score:
             result["reasons"].append(maintenance_score["reason"])
             if maintenance_score["retire"]:
                 result["should_retire"] = True
         
         # المعيار 3: تكلفة الصيانة مقارنة بتكلفة الشراء
-        cost_score = DevicesReplacementService._evaluate_by_maintenance_cost(device)
+        cost_score = DevicesReplacementService._evaluate_by_maintenance_cost(device, stats.maintenance_cost)
         if cost_score:
             result["reasons"].append(cost_score["reason"])
             result["financial_analysis"] = cost_score["financial_analysis"]
@@ -1423,7 +3229,7 @@ class DevicesReplacementService:
                 result["priority"] = "ضعيفه"
         
         # إضافة نصائح وتوصيات
-        result["recommendations"] = DevicesReplacementService._get_recommendations(device, result)
+        result["recommendations"] = DevicesReplacementService._get_recommendations(device, result, stats)
         
         return result
     
@@ -1476,29 +3282,13 @@ class DevicesReplacementService:
         return result
     
     @staticmethod
-    def _evaluate_by_maintenance_frequency(device):
-        """تقييم بناء على تكرار الصيانات في فترة قصيرة"""
-        # الحصول على تاريخ صيانات الجهاز 
-        six_months_ago = datetime.now() - timedelta(days=180)
-        one_year_ago = datetime.now() - timedelta(days=365)
-        
-        # البحث عن صيانات الإصلاح خلال آخر 6 أشهر
-        repair_maintenances = Maintenances.query.filter(
-            Maintenances.DeviceId == device.Id,
-            Maintenances.SchedulingAt > six_months_ago,
-            Maintenances.Type == "إصلاح"
-        ).all()
-        
-        # البحث عن صيانات الدورية خلال آخر سنة
-        periodic_maintenances = Maintenances.query.filter(
-            Maintenances.DeviceId == device.Id,
-            Maintenances.SchedulingAt > one_year_ago,
-            Maintenances.Type == "دورية"
-        ).all()
-        
-        repair_count = len(repair_maintenances)
-        periodic_count = len(periodic_maintenances)
+    def _evaluate_by_maintenance_frequency(repair_count, periodic_count):
+        """
+        تقييم بناء على تكرار الصيانات في فترة قصيرة
         
+        :param repair_count: عدد صيانات الإصلاح خلال آخر 6 أشهر
+        :param periodic_count: عدد الصيانات الدورية خلال آخر سنة
+        """
         result = {
             "retire": False,
             "reason": "",
@@ -1550,16 +3340,11 @@ class DevicesReplacementService:
         return None
     
     @staticmethod
-    def _evaluate_by_maintenance_cost(device):
-        """تقييم بناء على تكلفة الصيانة مقارنة بتكلفة الشراء"""
+    def _evaluate_by_maintenance_cost(device, maintenance_costs):
+        """تقييم بناء على تكلفة الصيانة (إجمالي تكاليف صيانات الجهاز) مقارنة بتكلفة الشراء"""
         if device.PurchaseCost <= 0:
             return None
         
-        # حساب إجمالي تكاليف الصيانة
-        maintenance_costs = db.session.query(func.sum(Maintenances.Cost)).filter(
-            Maintenances.DeviceId == device.Id
-        ).scalar() or 0
-        
         # حساب نسبة تكاليف الصيانة إلى تكلفة الشراء
         cost_ratio = (float(maintenance_costs) / float(device.PurchaseCost)) * 100
         
@@ -1604,7 +3389,7 @@ class DevicesReplacementService:
         return result
     
     @staticmethod
-    def _get_recommendations(device, evaluation_result):
+    def _get_recommendations(device, evaluation_result, stats):
         """توليد نصائح وتوصيات بناء على نتائج التقييم"""
         recommendations = []
         
@@ -1612,11 +3397,9 @@ class DevicesReplacementService:
             recommendations.append("يوصى باستبدال الجهاز بدلاً من إجراء المزيد من الصيانات")
             
             # تحقق من قطع الغيار المتبقية
-            spare_parts = SpareParts.query.filter_by(DeviceId=device.Id).all()
-            if spare_parts:
-                total_parts_value = sum(float(part.Cost) * part.Quantity for part in spare_parts)
+            if stats.parts_count:
                 # تقريب قيمة قطع الغيار لأقرب رقمين عشريين
-                total_parts_value = round(total_parts_value, 2)
+                total_parts_value = round(stats.parts_value, 2)
                 recommendations.append(f"يرجى ملاحظة أن هناك قطع غيار متبقية للجهاز بقيمة إجمالية {total_parts_value:.2f}")
             
             # تحقق من ساعات التشغيل
@@ -1642,19 +3425,12 @@ class DeviceSuggestionService:
             if not device:
                 return False, "الجهاز غير موجود"
             
-            excluded_statuses = [
-                "قيد الصيانة", " قيد الصيانة", "قيد الصيانة ", " قيد الصيانة ",
-                "غير متاح", " غير متاح", "غير متاح ", " غير متاح ",
-                "في الصيانة", " في الصيانة", "في الصيانة ", " في الصيانة ",
-                "فى الصيانة", " فى الصيانة", "فى الصيانة ", " فى الصيانة "
-            ]
-            
             similar_devices = Devices.query.filter(
                 and_(
                     func.lower(Devices.CategoryName) == func.lower(device.CategoryName),
                     func.lower(Devices.JobDescription) == func.lower(device.JobDescription),
                     Devices.Id != device_id,
-                    ~Devices.Status.in_(excluded_statuses)
+                    DeviceStatusService.excluding(DeviceStatusService.OUT_OF_SERVICE)
                 )
             ).all()
             
@@ -1753,4 +3529,702 @@ class DeviceSuggestionService:
             return True, {"suggested_devices": all_suggested_devices}
             
         except Exception as e:
-            return False, f"حدث خطأ أثناء البحث عن أجهزة مماثلة: {str(e)}"
\ No newline at end of file
+            return False, f"حدث خطأ أثناء البحث عن أجهزة مماثلة: {str(e)}"
+
+
+class AlertService:
+    """
+    تنبيهات الصيانة في جدول Alerts تحسبها مهمة مجدولة
+    
+    المعايرات المستحقة والمتأخرة وحدود ساعات التشغيل تحسب لكل الأجهزة باستعلام واحد، ولا يضاف
+    تنبيه لجهاز له تنبيه لم تنته صلاحيته من نفس النوع، فتقرأ الواجهات التنبيهات الجاهزة بدلاً
+    من حساب توقعات الصيانة في كل طلب.
+    """
+
+    CALIBRATION_OVERDUE = "معايرة متأخرة"
+    CALIBRATION_DUE = "معايرة مستحقة"
+    HOURS_EXCEEDED = "تجاوز ساعات التشغيل"
+    HOURS_NEAR_LIMIT = "اقتراب حد ساعات التشغيل"
+    CRITICAL = "حرج"
+    WARNING = "تحذير"
+    # نفس حدود توقعات الصيانة: 90% من الحد الأقصى للساعات، والمعايرة خلال 30 يوم
+    HOURS_THRESHOLD = 0.9
+    CALIBRATION_DUE_DAYS = 30
+    MAX_LIST_SIZE = 500
+    # اسم الحجز المؤقت في ReportSnapshots الذي يضمن أن عملية واحدة فقط تضيف التنبيهات
+    LEASE_NAME = "alerts_generation"
+
+    @staticmethod
+    def compute_due(now):
+        """
+        التنبيهات المستحقة الآن للأجهزة المتاحة
+        
+        :return: قائمة بعناصر (الجهاز، النوع، المستوى، العنوان، الرسالة)
+        """
+        MaintenanceSummaryService.ensure_built()
+        rows = db.session.query(
+            Devices.Id,
+            Devices.Name,
+            Devices.CurrentHour,
+            Devices.MaximumHour,
+            Devices.CalibrationInterval,
+            MaintenanceSummaries.LastEndAt
+        ).outerjoin(
+            MaintenanceSummaries,
+            and_(
+                MaintenanceSummaries.DeviceId == Devices.Id,
+                MaintenanceSummaries.Type == MaintenancePredictionService.CALIBRATION
+            )
+        ).filter(
+            DeviceStatusService.excluding(DeviceStatusService.OUT_OF_SERVICE),
+            or_(
+                Devices.CurrentHour >= Devices.MaximumHour * AlertService.HOURS_THRESHOLD,
+                and_(
+                    Devices.CalibrationInterval.isnot(None),
+                    Devices.LastMaintenanceDate.isnot(None),
+                    MaintenanceSummaries.LastEndAt.isnot(None)
+                )
+            )
+        ).order_by(Devices.Id).all()
+
+        due = []
+        for device_id, name, current_hour, maximum_hour, interval, last_calibration in rows:
+            if current_hour >= maximum_hour:
+                due.append((
+                    device_id, AlertService.HOURS_EXCEEDED, AlertService.CRITICAL,
+                    f"الجهاز {name} تجاوز الحد الأقصى لساعات التشغيل",
+                    f"ساعات التشغيل {current_hour} من أصل {maximum_hour}، يحتاج الجهاز صيانة دورية"
+                ))
+            elif current_hour >= maximum_hour * AlertService.HOURS_THRESHOLD:
+                due.append((
+                    device_id, AlertService.HOURS_NEAR_LIMIT, AlertService.WARNING,
+                    f"الجهاز {name} يقترب من الحد الأقصى لساعات التشغيل",
+                    f"ساعات التشغيل {current_hour} من أصل {maximum_hour}"
+                ))
+
+            if interval is None or last_calibration is None:
+                continue
+            next_calibration = last_calibration + timedelta(days=interval * 30)
+            days_left = (next_calibration - now).days
+            if days_left <= 0:
+                due.append((
+                    device_id, AlertService.CALIBRATION_OVERDUE, AlertService.CRITICAL,
+                    f"معايرة الجهاز {name} متأخرة",
+                    f"كان موعد المعايرة {next_calibration.strftime('%Y-%m-%d')}"
+                ))
+            elif days_left <= AlertService.CALIBRATION_DUE_DAYS:
+                due.append((
+                    device_id, AlertService.CALIBRATION_DUE, AlertService.WARNING,
+                    f"معايرة الجهاز {name} مستحقة قريباً",
+                    f"موعد المعايرة {next_calibration.strftime('%Y-%m-%d')} (بعد {days_left} يوم)"
+                ))
+        return due
+
+    @staticmethod
+    def recipients():
+        """
+        مستلمو التنبيهات: مستخدمو الأنواع المحددة في ALERT_RECIPIENT_USER_TYPES لكل الأجهزة،
+        ومشرفو المعامل التي يتبع لها كل جهاز
+        
+        :return: (المستلمون لكل الأجهزة، {الجهاز: مشرفو معامله})
+        """
+        user_types = current_app.config.get('ALERT_RECIPIENT_USER_TYPES', [])
+        common = set()
+        if user_types:
+            common = {user_id for (user_id,) in db.session.query(Users.Id).filter(Users.UserType.in_(user_types)).all()}
+
+        supervisors = {}
+        for device_id, supervisor_id in db.session.query(
+            DeviceLabs.DeviceId, Laboratories.SupervisorId
+        ).join(Laboratories, Laboratories.LabId == DeviceLabs.LabId).filter(
+            Laboratories.SupervisorId.isnot(None)
+        ).all():
+            supervisors.setdefault(device_id, set()).add(supervisor_id)
+        return common, supervisors
+
+    @staticmethod
+    def generate():
+        """
+        إضافة التنبيهات المستحقة غير المكررة وتوزيعها على المستلمين في معاملة واحدة
+        
+        عملية واحدة فقط تضيف التنبيهات في كل مرة (بحجز مؤقت مثل حساب التقارير)، لأن منع التكرار
+        وأرقام المستلمين المحسوبة من أكبر رقم يعتمدان على ما قرأته العملية قبل الإضافة.
+        
+        :return: عدد التنبيهات الجديدة، أو None إذا كانت عملية أخرى تضيفها الآن
+        """
+        if not ReportSnapshotService.try_acquire(AlertService.LEASE_NAME):
+            logger.info("إضافة تنبيهات الصيانة تعمل في عملية أخرى")
+            return None
+        try:
+            return AlertService._generate()
+        finally:
+            ReportSnapshotService.release(AlertService.LEASE_NAME)
+
+    @staticmethod
+    def _generate():
+        now = datetime.now()
+        due = AlertService.compute_due(now)
+
+        # كل نوع تنبيه يضاف للجهاز مرة واحدة حتى تنتهي صلاحية التنبيه السابق
+        active = set(db.session.query(Alerts.DeviceId, Alerts.Type).filter(Alerts.ExpiresAt > now).all())
+        expires_at = now + timedelta(hours=current_app.config.get('ALERT_EXPIRY_HOURS', 24))
+        rows = []
+        for device_id, alert_type, level, title, message in due:
+            if (device_id, alert_type) in active:
+                continue
+            active.add((device_id, alert_type))
+            rows.append(dict(
+                Type=alert_type, Level=level, Title=title, Message=message,
+                CreatedAt=now, ExpiresAt=expires_at, DeviceId=device_id
+            ))
+
+        try:
+            if rows:
+                created = db.session.execute(insert(Alerts).returning(Alerts.Id, Alerts.DeviceId), rows).all()
+
+                common, supervisors = AlertService.recipients()
+                # عمود Id في AlertRecipients ليس مفتاحاً ولا يولد تلقائياً، وأكبر رقم آمن داخل الحجز المؤقت
+                next_id = (db.session.query(func.max(AlertRecipients.Id)).scalar() or 0) + 1
+                recipient_rows = []
+                for alert_id, device_id in created:
+                    for user_id in sorted(common | supervisors.get(device_id, set())):
+                        recipient_rows.append(dict(UserId=user_id, AlertId=alert_id, Id=next_id))
+                        next_id += 1
+                if recipient_rows:
+                    db.session.execute(insert(AlertRecipients), recipient_rows)
+
+            AlertService.purge_expired(now - timedelta(days=current_app.config.get('ALERT_RETENTION_DAYS', 30)))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        logger.info(f"تم إضافة {len(rows)} تنبيه صيانة من أصل {len(due)} مستحق")
+        return len(rows)
+
+    @staticmethod
+    def purge_expired(before):
+        """حذف التنبيهات التي انتهت صلاحيتها قبل الوقت المحدد مع مستلميها"""
+        expired = select(Alerts.Id).where(Alerts.ExpiresAt < before)
+        db.session.execute(
+            delete(AlertRecipients).where(AlertRecipients.AlertId.in_(expired)),
+            execution_options={"synchronize_session": False}
+        )
+        db.session.execute(
+            delete(Alerts).where(Alerts.ExpiresAt < before),
+            execution_options={"synchronize_session": False}
+        )
+
+    @staticmethod
+    def get_alerts(user_id=None, device_id=None, since_str=None, include_expired=False):
+        """
+        التنبيهات الحالية (أو كلها) الأحدث أولاً
+        
+        :param user_id: تنبيهات هذا المستلم فقط
+        :param since_str: التنبيهات المضافة بعد هذا الوقت فقط (YYYY-MM-DD أو YYYY-MM-DDTHH:MM:SS)
+        :return: (نجاح العملية، قائمة التنبيهات أو رسالة الخطأ)
+        """
+        try:
+            since = datetime.fromisoformat(since_str) if since_str else None
+        except ValueError:
+            return False, "صيغة الوقت غير صحيحة، استخدم YYYY-MM-DD أو YYYY-MM-DDTHH:MM:SS"
+
+        try:
+            query = db.session.query(
+                Alerts.Id, Alerts.Type, Alerts.Level, Alerts.Title, Alerts.Message,
+                Alerts.CreatedAt, Alerts.ExpiresAt, Alerts.DeviceId
+            )
+            if user_id:
+                query = query.join(AlertRecipients, AlertRecipients.AlertId == Alerts.Id).filter(
+                    AlertRecipients.UserId == user_id
+                )
+            if device_id:
+                query = query.filter(Alerts.DeviceId == device_id)
+            if since:
+                query = query.filter(Alerts.CreatedAt > since)
+            if not include_expired:
+                query = query.filter(Alerts.ExpiresAt > datetime.now())
+            rows = query.order_by(Alerts.CreatedAt.desc(), Alerts.Id.desc()).limit(AlertService.MAX_LIST_SIZE).all()
+
+            return True, [
+                {
+                    "id": row.Id,
+                    "type": row.Type,
+                    "level": row.Level,
+                    "title": row.Title,
+                    "message": row.Message,
+                    "device_id": row.DeviceId,
+                    "created_at": row.CreatedAt.strftime("%Y-%m-%d %H:%M:%S"),
+                    "expires_at": row.ExpiresAt.strftime("%Y-%m-%d %H:%M:%S")
+                }
+                for row in rows
+            ]
+
+        except Exception as e:
+            return False, f"حدث خطأ أثناء جلب التنبيهات: {str(e)}"
+
+
+class ReportSnapshotService:
+    """
+    التقارير المحسوبة مسبقاً: تقرير الصيانة المطلوبة وتوقعات الصيانة والأجهزة التي تحتاج إلى استبدال
+    والاحتياجات المستقبلية من قطع الغيار
+    
+    مهمة مجدولة تحسب كل تقرير وتحفظه في ReportSnapshots كـ JSON جاهز للإرسال، فترد الواجهات
+    بقراءة صف واحد بدلاً من إعادة الحساب. كل عملية gunicorn تشغل المهمة، لكن الحساب يتم في عملية
+    واحدة فقط لكل فترة بحجز الصف بتحديث مشروط في قاعدة البيانات.
+    
+    بين الحسابات الكاملة تسجل الأجهزة وقطع الغيار المتغيرة في ReportChanges مع كل تعديل، ومهمة
+    أقصر فترة تعيد حساب صفوفها فقط وتدمجها في نسخة التقرير.
+    """
+
+    MAINTENANCE_NEEDED = "maintenance_needed"
+    MAINTENANCE_PREDICTION = "maintenance_prediction"
+    DEVICES_REPLACEMENT = "devices_replacement"
+    FUTURE_NEEDS = "future_needs"
+
+    # ترسل بترتيب المفاتيح كما بنيت (كما كانت ترسلها flask-restful)، والبقية مرتبة كما في jsonify
+    UNSORTED_REPORTS = (MAINTENANCE_NEEDED,)
+
+    # مدة الحجز، فإذا توقفت العملية أثناء الحساب تستطيع عملية أخرى الحساب بعد انتهائها
+    LEASE = timedelta(minutes=30)
+
+    # لا تستخدم اللقطة إذا مر عليها أكثر من هذا العدد من الفترات (مثلاً عند توقف المهمة المجدولة)
+    STALE_AFTER_INTERVALS = 3
+
+    # أنواع التغييرات التي تعاد بسببها صفوف التقارير
+    CHANGED_DEVICE = "device"  # بيانات الجهاز أو حجوزاته أو قطع غياره
+    CHANGED_MAINTENANCE = "maintenance"  # صيانات الجهاز أو فئته، وتؤثر أيضاً على التكلفة المتوقعة لأجهزة أخرى
+    CHANGED_PART = "part"
+
+    REPORT_CHANGE_KINDS = {
+        MAINTENANCE_NEEDED: (CHANGED_DEVICE, CHANGED_MAINTENANCE),
+        MAINTENANCE_PREDICTION: (CHANGED_DEVICE, CHANGED_MAINTENANCE),
+        DEVICES_REPLACEMENT: (CHANGED_DEVICE, CHANGED_MAINTENANCE),
+        FUTURE_NEEDS: (CHANGED_DEVICE, CHANGED_MAINTENANCE, CHANGED_PART),
+    }
+
+    # (نوع التغيير، العمود الذي يحدد الجهاز أو القطعة) لكل نموذج
+    TRACKED_ATTRIBUTES = {
+        Devices: ((CHANGED_DEVICE, 'Id'),),
+        Reservations: ((CHANGED_DEVICE, 'DeviceId'),),
+        Maintenances: ((CHANGED_MAINTENANCE, 'DeviceId'),),
+        SpareParts: ((CHANGED_PART, 'PartId'), (CHANGED_DEVICE, 'DeviceId')),
+    }
+
+    # عند تغير عدد أكبر من الأجهزة والقطع يعاد حساب التقرير بالكامل بدلاً من الدمج
+    MAX_SPLICE_KEYS = 500
+    # عدد المعرفات في كل جملة حذف (حدود عدد المعاملات في SQL Server)
+    DELETE_BATCH_SIZE = 500
+
+    @staticmethod
+    def build_maintenance_needed():
+        success, result = MaintenanceService.get_devices_needing_maintenance()
+        if not success:
+            return {"success": False, "message": result}, 500
+        return {
+            "success": True,
+            "message": "تم جلب بيانات الأجهزة وأولويات الصيانة بنجاح",
+            "devices": result
+        }, 200
+
+    @staticmethod
+    def build_maintenance_prediction():
+        return {
+            "status": "success",
+            "data": MaintenancePredictionService.predict_device_maintenance(),
+            "message": "تم استرجاع توقعات الصيانة بنجاح"
+        }, 200
+
+    @staticmethod
+    def build_devices_replacement():
+        return {
+            "status": "نجاح",
+            "data": DevicesReplacementService.get_devices_for_replacement(),
+            "message": "تم استرجاع قائمة الأجهزة التي تحتاج إلى استبدال بنجاح"
+        }, 200
+
+    @staticmethod
+    def build_future_needs():
+        return FutureNeedsService.get_future_spare_parts_needs(), 200
+
+    @staticmethod
+    def builders():
+        return {
+            ReportSnapshotService.MAINTENANCE_NEEDED: ReportSnapshotService.build_maintenance_needed,
+            ReportSnapshotService.MAINTENANCE_PREDICTION: ReportSnapshotService.build_maintenance_prediction,
+            ReportSnapshotService.DEVICES_REPLACEMENT: ReportSnapshotService.build_devices_replacement,
+            ReportSnapshotService.FUTURE_NEEDS: ReportSnapshotService.build_future_needs,
+        }
+
+    @staticmethod
+    def replace_entries(entries, replacements, is_changed, sort_key):
+        """استبدال صفوف الأجهزة أو القطع المتغيرة في قائمة التقرير بصفوفها المحسوبة من جديد"""
+        entries = [entry for entry in entries if not is_changed(entry)] + replacements
+        entries.sort(key=sort_key)
+        return entries
+
+    @staticmethod
+    def splice_maintenance_needed(body, changes):
+        device_ids = changes[ReportSnapshotService.CHANGED_DEVICE] | changes[ReportSnapshotService.CHANGED_MAINTENANCE]
+        success, devices = MaintenanceService.get_devices_needing_maintenance(device_ids)
+        if not success:
+            return None
+        body["devices"] = ReportSnapshotService.replace_entries(
+            body["devices"], devices,
+            lambda device: device["device_id"] in device_ids,
+            MaintenanceService.report_sort_key
+        )
+        return body
+
+    @staticmethod
+    def splice_maintenance_prediction(body, changes):
+        # تغير صيانات جهاز يغير التكلفة المتوقعة لأجهزة فئته ومتوسط التكلفة للجميع
+        if changes[ReportSnapshotService.CHANGED_MAINTENANCE]:
+            return None
+        device_ids = changes[ReportSnapshotService.CHANGED_DEVICE]
+        body["data"] = ReportSnapshotService.replace_entries(
+            body["data"], MaintenancePredictionService.predict_device_maintenance(device_ids),
+            lambda prediction: prediction["Id"] in device_ids,
+            lambda prediction: prediction["Id"]
+        )
+        return body
+
+    @staticmethod
+    def splice_devices_replacement(body, changes):
+        device_ids = changes[ReportSnapshotService.CHANGED_DEVICE] | changes[ReportSnapshotService.CHANGED_MAINTENANCE]
+        body["data"] = ReportSnapshotService.replace_entries(
+            body["data"], DevicesReplacementService.get_devices_for_replacement(device_ids),
+            lambda evaluation: evaluation["device_id"] in device_ids,
+            DevicesReplacementService.report_sort_key
+        )
+        return body
+
+    @staticmethod
+    def splice_future_needs(body, changes):
+        # القطع المتغيرة وقطع الأجهزة التي تغير اسمها أو صياناتها القادمة
+        part_ids = changes[ReportSnapshotService.CHANGED_PART]
+        device_ids = changes[ReportSnapshotService.CHANGED_DEVICE] | changes[ReportSnapshotService.CHANGED_MAINTENANCE]
+        needs = FutureNeedsService.get_future_spare_parts_needs(part_ids, device_ids)
+        maintenance_order = dict(db.session.execute(FutureNeedsService.upcoming_maintenances(datetime.now())).all())
+        body["parts_to_purchase"] = ReportSnapshotService.replace_entries(
+            body["parts_to_purchase"], needs["parts_to_purchase"],
+            lambda part: part["id"] in part_ids or part["device_id"] in device_ids,
+            lambda part: FutureNeedsService.report_sort_key(part, maintenance_order)
+        )
+        body["summary"] = FutureNeedsService.summarize(body["parts_to_purchase"], datetime.now())
+        return body
+
+    @staticmethod
+    def splicers():
+        """دوال دمج الصفوف المتغيرة لكل تقرير، وترجع None إذا كان يجب حساب التقرير بالكامل"""
+        return {
+            ReportSnapshotService.MAINTENANCE_NEEDED: ReportSnapshotService.splice_maintenance_needed,
+            ReportSnapshotService.MAINTENANCE_PREDICTION: ReportSnapshotService.splice_maintenance_prediction,
+            ReportSnapshotService.DEVICES_REPLACEMENT: ReportSnapshotService.splice_devices_replacement,
+            ReportSnapshotService.FUTURE_NEEDS: ReportSnapshotService.splice_future_needs,
+        }
+
+    @staticmethod
+    def interval():
+        """فترة إعادة الحساب، أو None إذا كانت اللقطات معطلة"""
+        minutes = current_app.config.get('REPORT_SNAPSHOT_INTERVAL_MINUTES')
+        return timedelta(minutes=minutes) if minutes else None
+
+    @staticmethod
+    def tracking_enabled():
+        """تسجيل التغييرات فقط عند تفعيل اللقطات ودمج التغييرات"""
+        return has_app_context() and bool(
+            current_app.config.get('REPORT_SNAPSHOT_INTERVAL_MINUTES')
+            and current_app.config.get('REPORT_SNAPSHOT_SPLICE_SECONDS')
+        )
+
+    @staticmethod
+    def worker_id():
+        # تحسب عند الاستخدام لأن gunicorn ينشئ العمليات بعد استيراد التطبيق
+        return f"{socket.gethostname()}:{os.getpid()}"[:100]
+
+    @staticmethod
+    def serialize(name, body):
+        sort_keys = name not in ReportSnapshotService.UNSORTED_REPORTS
+        return current_app.json.dumps(body, sort_keys=sort_keys).encode('utf-8')
+
+    @staticmethod
+    def build(name):
+        """
+        حساب التقرير الآن
+        
+        :return: (JSON كبايتات، رمز الحالة، وقت الحساب، مدة الحساب بالثواني)
+        """
+        generated_at = datetime.now()
+        started = time.perf_counter()
+        body, status_code = ReportSnapshotService.builders()[name]()
+        payload = ReportSnapshotService.serialize(name, body)
+        return payload, status_code, generated_at, time.perf_counter() - started
+
+    @staticmethod
+    def get(name):
+        """اللقطة المحفوظة للتقرير إذا كانت اللقطات مفعلة واللقطة غير قديمة، وإلا None"""
+        interval = ReportSnapshotService.interval()
+        if not interval:
+            return None
+        snapshot = db.session.query(
+            ReportSnapshots.Payload,
+            ReportSnapshots.StatusCode,
+            ReportSnapshots.GeneratedAt,
+            ReportSnapshots.UpdatedAt
+        ).filter(ReportSnapshots.Name == name).first()
+        if snapshot is None or snapshot.Payload is None:
+            return None
+        if snapshot.GeneratedAt < datetime.now() - interval * ReportSnapshotService.STALE_AFTER_INTERVALS:
+            return None
+        return snapshot
+
+    @staticmethod
+    def ensure_row(name):
+        if db.session.query(ReportSnapshots.Name).filter(ReportSnapshots.Name == name).first() is not None:
+            return
+        try:
+            db.session.add(ReportSnapshots(Name=name))
+            db.session.commit()
+        except IntegrityError:
+            # أضافته عملية أخرى في نفس اللحظة
+            db.session.rollback()
+
+    @staticmethod
+    def store(name, payload, status_code, generated_at, build_seconds):
+        """حفظ نسخة التقرير المحسوبة بالكامل"""
+        ReportSnapshotService.ensure_row(name)
+        db.session.execute(
+            update(ReportSnapshots)
+            .where(
+                ReportSnapshots.Name == name,
+                # لا تستبدل نسخة أحدث حفظتها عملية أخرى
+                or_(ReportSnapshots.GeneratedAt.is_(None), ReportSnapshots.GeneratedAt <= generated_at)
+            )
+            .values(
+                Payload=payload, StatusCode=status_code, GeneratedAt=generated_at,
+                BuildSeconds=build_seconds, UpdatedAt=generated_at
+            )
+        )
+        db.session.commit()
+
+    @staticmethod
+    def try_acquire(name, min_age=None):
+        """
+        حجز التقرير لتعديله، وينجح لعملية واحدة فقط إذا لم يكن محجوزاً
+        
+        :param min_age: وإذا لم يحسب بالكامل خلال هذه المدة
+        """
+        ReportSnapshotService.ensure_row(name)
+        now = datetime.now()
+        conditions = [
+            ReportSnapshots.Name == name,
+            or_(ReportSnapshots.LockedUntil.is_(None), ReportSnapshots.LockedUntil < now)
+        ]
+        if min_age is not None:
+            conditions.append(or_(ReportSnapshots.GeneratedAt.is_(None), ReportSnapshots.GeneratedAt <= now - min_age))
+        result = db.session.execute(
+            update(ReportSnapshots)
+            .where(*conditions)
+            .values(LockedBy=ReportSnapshotService.worker_id(), LockedUntil=now + ReportSnapshotService.LEASE)
+        )
+        db.session.commit()
+        return result.rowcount == 1
+
+    @staticmethod
+    def release(name):
+        db.session.execute(
+            update(ReportSnapshots)
+            .where(ReportSnapshots.Name == name, ReportSnapshots.LockedBy == ReportSnapshotService.worker_id())
+            .values(LockedBy=None, LockedUntil=None)
+        )
+        db.session.commit()
+
+    @staticmethod
+    def write_changes(connection, changes):
+        """كتابة التغييرات {(النوع، المعرف)} لكل تقرير يتأثر بها داخل المعاملة الحالية"""
+        now = datetime.now()
+        rows = [
+            dict(Report=name, Kind=kind, EntityId=entity_id, CreatedAt=now)
+            for name, kinds in ReportSnapshotService.REPORT_CHANGE_KINDS.items()
+            for kind, entity_id in changes
+            if kind in kinds
+        ]
+        if rows:
+            connection.execute(insert(ReportChanges), rows)
+
+    @staticmethod
+    def mark_changed(kind, entity_ids):
+        """تسجيل تغييرات تمت بجمل UPDATE مباشرة (لا تمر بأحداث النماذج) في المعاملة الحالية"""
+        if ReportSnapshotService.tracking_enabled():
+            ReportSnapshotService.write_changes(
+                db.session.connection(),
+                {(kind, entity_id) for entity_id in entity_ids if entity_id is not None}
+            )
+
+    @staticmethod
+    def pending_changes(name):
+        """
+        التغييرات غير المدمجة في التقرير
+        
+        :return: (أرقام صفوف ReportChanges، {النوع: مجموعة المعرفات})
+        """
+        rows = db.session.query(
+            ReportChanges.Id, ReportChanges.Kind, ReportChanges.EntityId
+        ).filter(ReportChanges.Report == name).all()
+        changes = {kind: set() for kind in ReportSnapshotService.REPORT_CHANGE_KINDS[name]}
+        for _, kind, entity_id in rows:
+            changes.setdefault(kind, set()).add(entity_id)
+        return [row.Id for row in rows], changes
+
+    @staticmethod
+    def delete_changes(change_ids):
+        """
+        حذف التغييرات التي تم دمجها بأرقامها (وليس بأكبر رقم)، حتى لا تضيع تغييرات معاملات
+        أخذت أرقاماً أصغر ولم تكن قد حفظت بعد عند القراءة
+        """
+        batch_size = ReportSnapshotService.DELETE_BATCH_SIZE
+        for start in range(0, len(change_ids), batch_size):
+            db.session.execute(delete(ReportChanges).where(ReportChanges.Id.in_(change_ids[start:start + batch_size])))
+        db.session.commit()
+
+    @staticmethod
+    def refresh(name):
+        """
+        إعادة حساب التقرير بالكامل وحفظه إذا حصلت هذه العملية على الحجز
+        
+        :return: True إذا تم الحساب في هذه العملية
+        """
+        interval = ReportSnapshotService.interval()
+        if not interval or not ReportSnapshotService.try_acquire(name, min_age=interval / 2):
+            return False
+        try:
+            # التغييرات المسجلة قبل بدء الحساب تصبح مدمجة فيه
+            change_ids, _ = ReportSnapshotService.pending_changes(name)
+            payload, status_code, generated_at, build_seconds = ReportSnapshotService.build(name)
+            if status_code != 200:
+                # تبقى النسخة السابقة الناجحة
+                logger.warning(f"لم يحفظ التقرير {name}: رمز الحالة {status_code}")
+                return False
+            ReportSnapshotService.store(name, payload, status_code, generated_at, build_seconds)
+            ReportSnapshotService.delete_changes(change_ids)
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            ReportSnapshotService.release(name)
+        logger.info(f"تم حساب التقرير {name} خلال {build_seconds:.2f} ثانية ({len(payload)} بايت)")
+        return True
+
+    @staticmethod
+    def splice(name):
+        """
+        إعادة حساب صفوف الأجهزة والقطع المتغيرة فقط ودمجها في نسخة التقرير المحفوظة
+        
+        :return: True إذا تم تعديل النسخة
+        """
+        if not ReportSnapshotService.interval():
+            return False
+        if db.session.query(ReportChanges.Id).filter(ReportChanges.Report == name).first() is None:
+            return False
+        if not ReportSnapshotService.try_acquire(name):
+            return False
+        try:
+            snapshot = db.session.query(
+                ReportSnapshots.Payload, ReportSnapshots.StatusCode, ReportSnapshots.UpdatedAt
+            ).filter(ReportSnapshots.Name == name).first()
+            if snapshot is None or snapshot.Payload is None or snapshot.StatusCode != 200:
+                # لا توجد نسخة للدمج فيها، والحساب الكامل القادم يشمل هذه التغييرات
+                return False
+            change_ids, changes = ReportSnapshotService.pending_changes(name)
+            if not change_ids:
+                return False
+
+            started = time.perf_counter()
+            body = None
+            if sum(len(ids) for ids in changes.values()) <= ReportSnapshotService.MAX_SPLICE_KEYS:
+                body = ReportSnapshotService.splicers()[name](json.loads(snapshot.Payload), changes)
+            if body is None:
+                payload, status_code, generated_at, build_seconds = ReportSnapshotService.build(name)
+                if status_code != 200:
+                    logger.warning(f"لم يحفظ التقرير {name}: رمز الحالة {status_code}")
+                    return False
+                ReportSnapshotService.store(name, payload, status_code, generated_at, build_seconds)
+            else:
+                result = db.session.execute(
+                    update(ReportSnapshots)
+                    .where(ReportSnapshots.Name == name, ReportSnapshots.UpdatedAt == snapshot.UpdatedAt)
+                    .values(Payload=ReportSnapshotService.serialize(name, body), UpdatedAt=datetime.now())
+                )
+                db.session.commit()
+                if result.rowcount != 1:
+                    # استبدلها طلب ?fresh=1 أثناء الدمج، فتدمج التغييرات في المرة القادمة
+                    return False
+            ReportSnapshotService.delete_changes(change_ids)
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            ReportSnapshotService.release(name)
+        logger.debug(
+            f"تم تحديث التقرير {name} بـ {len(change_ids)} تغيير خلال {time.perf_counter() - started:.3f} ثانية"
+            + (" (حساب كامل)" if body is None else "")
+        )
+        return True
+
+    @staticmethod
+    def refresh_all():
+        for name in ReportSnapshotService.builders():
+            try:
+                ReportSnapshotService.refresh(name)
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"فشل حساب التقرير {name}: {str(e)}")
+
+    @staticmethod
+    def splice_all():
+        for name in ReportSnapshotService.builders():
+            try:
+                ReportSnapshotService.splice(name)
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"فشل تحديث التقرير {name}: {str(e)}")
+
+    @staticmethod
+    def serve(name, fresh=False):
+        """
+        التقرير للواجهة: من اللقطة المحفوظة، أو بحسابه الآن عند طلب fresh أو عدم وجود لقطة صالحة
+        
+        :return: (JSON كبايتات، رمز الحالة، وقت الحساب الكامل، وقت آخر تعديل)
+        """
+        snapshot = None if fresh else ReportSnapshotService.get(name)
+        if snapshot is not None:
+            return snapshot.Payload, snapshot.StatusCode, snapshot.GeneratedAt, snapshot.UpdatedAt or snapshot.GeneratedAt
+        payload, status_code, generated_at, build_seconds = ReportSnapshotService.build(name)
+        if status_code == 200 and ReportSnapshotService.interval():
+            ReportSnapshotService.store(name, payload, status_code, generated_at, build_seconds)
+        return payload, status_code, generated_at, generated_at
+
+
+@event.listens_for(db.session, 'after_flush')
+def _write_report_changes(session, flush_context):
+    """
+    تسجيل الأجهزة والقطع المتغيرة (القيم الحالية والسابقة) في ReportChanges مع الـ flush
+    
+    مسجل على جلسة التطبيق فقط، وبعد الـ flush تبقى قوائم الكائنات المتغيرة وتاريخ قيمها كما كانت قبله.
+    """
+    if not ReportSnapshotService.tracking_enabled():
+        return
+    changes = set()
+    for target in list(session.new) + list(session.dirty) + list(session.deleted):
+        attributes = ReportSnapshotService.TRACKED_ATTRIBUTES.get(type(target))
+        if attributes is None:
+            continue
+        state = inspect(target)
+        for kind, attribute in attributes:
+            changes.update((kind, value) for value in state.attrs[attribute].history.sum() if value is not None)
+        # تغير فئة الجهاز يغير التكلفة المتوقعة من صيانات الفئة
+        if isinstance(target, Devices) and state.attrs.CategoryName.history.deleted:
+            changes.add((ReportSnapshotService.CHANGED_MAINTENANCE, target.Id))
+    if changes:
+        ReportSnapshotService.write_changes(session.connection(), changes)
@@ -19,8 +19,13 @@ logging.basicConfig(
 
 try:
     from app import app as application
+    from extensions import scheduler
     logger = logging.getLogger(__name__)
     logger.info("تم تحميل التطبيق بنجاح من app.py")
+    
+    # تشغيل المهام المجدولة داخل عملية gunicorn
+    if not scheduler.running:
+        scheduler.start()
 except ImportError as e:
     logger = logging.getLogger(__name__)
     logger.error(f"خطأ في استيراد التطبيق: {e}")